@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from datetime import datetime, timedelta
+from os.path import basename
+from typing import Dict, Iterator, Tuple
+
+import pytz
+
+from django.db import transaction
+from django.db.models import F, QuerySet
+from django.utils.timezone import make_aware
+
+from camera.capture import FileManager, Video
+from camera.models import ActivityLogPosition, HourlyActivity, Recording
+
+
+class ActivityIndex:
+    """Recordings started and seconds recorded per hour, and the recordings
+    indexed by time, so that the activity of any period is found without
+    going through the capture folder. The index is kept up to date from the
+    activity log the capture daemon writes as videos are added and removed
+    """
+
+    def __init__(self, file_manager: FileManager):
+        self._file_manager = file_manager
+        self._log_path = file_manager.complete_path(FileManager.ACTIVITY_FILE)
+
+    @staticmethod
+    def parse(name: str) -> Tuple[str, datetime, int]:
+        """Returns the timestamp key, start time and duration in seconds of
+        a video given its name
+        """
+        name_parts = Video.NAME_RE.match(name)
+        timestamp = make_aware(datetime.strptime(name_parts.group(1), '%Y-%m-%d_%H%M%S'), pytz.utc)
+        return name_parts.group(1), timestamp, int(name_parts.group(2))
+
+    @staticmethod
+    def hours(start: datetime, duration: int) -> Iterator[Tuple[datetime, int]]:
+        """Splits a recording in the hours it spans
+        :return the start of each hour and the seconds recorded in it
+        """
+        hour = start.replace(minute=0, second=0, microsecond=0)
+        end = start + timedelta(seconds=duration)
+        while True:
+            next_hour = hour + timedelta(hours=1)
+            yield hour, int((min(end, next_hour) - max(start, hour)).total_seconds())
+            if end <= next_hour:
+                break
+            hour = next_hour
+
+    def add(self, name: str):
+        """Indexes a video. A video with the same start time, e.g. the same
+        one re-encoded, only changes its name
+        """
+        _, timestamp, duration = self.parse(name)
+        if Recording.objects.filter(timestamp=timestamp).update(file=name):
+            return
+        Recording.objects.create(file=name, timestamp=timestamp, duration=duration)
+        for index, (hour, seconds) in enumerate(self.hours(timestamp, duration)):
+            HourlyActivity.objects.get_or_create(hour=hour)
+            HourlyActivity.objects.filter(hour=hour).update(recordings=F('recordings') + (index == 0),
+                                                            seconds=F('seconds') + seconds)
+
+    @staticmethod
+    def remove(name: str):
+        """Takes a video out of the list of recordings, its activity stays
+        """
+        Recording.objects.filter(file=name).delete()
+
+    def update(self) -> int:
+        """Indexes the videos added to and removed from the capture folder
+        since the last update
+        :return the number of changes indexed
+        """
+        with transaction.atomic():
+            position, _ = ActivityLogPosition.objects.select_for_update().get_or_create(pk=1)
+            try:
+                with open(self._log_path, 'rb') as log:
+                    log.seek(position.offset)
+                    changes = log.read()
+            except IOError:
+                return 0
+            # A line being written right now is left for the next time
+            changes = changes[:changes.rfind(b'\n') + 1]
+            lines = changes.decode('utf-8', 'replace').splitlines()
+            for line in lines:
+                try:
+                    if line.startswith('+'):
+                        self.add(line[1:])
+                    elif line.startswith('-'):
+                        self.remove(line[1:])
+                except AttributeError:   # Not a video
+                    pass
+            position.offset += len(changes)
+            position.save()
+        return len(lines)
+
+    def rebuild(self):
+        """Indexes the videos of the capture folder again, from scratch. The
+        activity of the videos already deleted is lost
+        """
+        with transaction.atomic():
+            Recording.objects.all().delete()
+            HourlyActivity.objects.all().delete()
+            position, _ = ActivityLogPosition.objects.get_or_create(pk=1)
+            try:
+                position.offset = os.path.getsize(self._log_path)
+            except IOError:
+                position.offset = 0
+            position.save()
+            for _, videos in self._file_manager.list_videos():
+                for video in videos:
+                    self.add(basename(video.file))
+
+    def heatmap(self, start: datetime, end: datetime) -> Dict[datetime, Tuple[int, int]]:
+        """Returns the hours of a period with activity
+        :return the recordings started and seconds recorded by hour
+        """
+        self.update()
+        return {hour: (recordings, seconds)
+                for hour, recordings, seconds in HourlyActivity.objects.filter(
+                    hour__gte=start, hour__lt=end).values_list('hour', 'recordings', 'seconds')}
+
+    def recordings(self, start: datetime, end: datetime) -> QuerySet:
+        """Returns the recordings started in a period, oldest first
+        """
+        self.update()
+        return Recording.objects.filter(timestamp__gte=start, timestamp__lt=end).order_by('timestamp')
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import http.client
+import json
+import urllib.request
+
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.dateparse import parse_datetime
+
+from camera.capture import Video
+
+
+class Node(namedtuple('Node', ('name', 'url', 'token'))):
+    """A tusacam server whose recordings and live preview are shown by the
+    aggregator, see settings.CAMERA_AGGREGATOR_NODES
+    """
+
+    @classmethod
+    def configured(cls) -> List['Node']:
+        return [cls(**node) for node in settings.CAMERA_AGGREGATOR_NODES]
+
+    @classmethod
+    def get(cls, name: str) -> 'Node':
+        """Returns the node with the given name, or None if there is none
+        """
+        for node in cls.configured():
+            if node.name == name:
+                return node
+        return None
+
+    def open(self, path: str, timeout: float=None) -> http.client.HTTPResponse:
+        """Sends a request to the API of the node
+        :param path: the path of the request, relative to the node API
+        """
+        request = urllib.request.Request('{}/api/{}'.format(self.url.rstrip('/'), path),
+                                         headers={'Authorization': 'Token {}'.format(self.token)})
+        return urllib.request.urlopen(request, timeout=timeout or settings.CAMERA_AGGREGATOR_TIMEOUT)
+
+    def fetch(self, path: str, timeout: float=None) -> bytes:
+        with self.open(path, timeout) as response:
+            return response.read()
+
+
+def fan_out(nodes: List[Node], path: str, timeout: float=None) -> Dict[str, bytes]:
+    """Sends the same request to several nodes at the same time, so that it
+    takes as long as the slowest node that answers in time
+    :param timeout: seconds each node has to answer, by default
+    settings.CAMERA_AGGREGATOR_TIMEOUT
+    :return the response of each node by name, None for the nodes that
+    failed or did not answer in time
+    """
+    if not nodes:
+        return dict()
+    timeout = timeout or settings.CAMERA_AGGREGATOR_TIMEOUT
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(len(nodes))
+
+    async def fetch(node: Node) -> bytes:
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(executor, node.fetch, path, timeout),
+                                          timeout)
+        except (asyncio.TimeoutError, IOError, http.client.HTTPException):
+            return None
+
+    async def fetch_all() -> List[bytes]:
+        return await asyncio.gather(*(fetch(node) for node in nodes))
+
+    try:
+        responses = loop.run_until_complete(fetch_all())
+    finally:
+        # Requests that timed out finish by themselves in the background
+        executor.shutdown(wait=False)
+        loop.close()
+    return {node.name: response for node, response in zip(nodes, responses)}
+
+
+def parse_videos(content: bytes) -> List[Video]:
+    """Reads the list of videos of a node, as returned by its api/videos
+    """
+    return [Video(parse_datetime(video['timestamp']),
+                  video['file'],
+                  timedelta(seconds=video['duration']),
+                  video['thumbnail'])
+            for video in json.loads(content.decode())['videos']]
+
+
+def timeline(nodes: List[Node]) -> Tuple[List[Tuple], List[str]]:
+    """Merges the videos of several nodes. The list of each node is kept in
+    the cache for settings.CAMERA_AGGREGATOR_CACHE_TIMEOUT seconds, only the
+    nodes not in the cache are asked
+    :return a list of tuples sorted in descending order by date with the
+    date and the list of tuples (node name, video) of the day, most recent
+    first, and the names of the nodes that did not answer
+    """
+    node_videos = dict()
+    for node in nodes:
+        node_videos[node.name] = cache.get('aggregator:videos:{}'.format(node.name))
+    missing = [node for node in nodes if node_videos[node.name] is None]
+    failed = []
+    for name, content in fan_out(missing, 'videos').items():
+        try:
+            node_videos[name] = parse_videos(content)
+            cache.set('aggregator:videos:{}'.format(name), node_videos[name],
+                      settings.CAMERA_AGGREGATOR_CACHE_TIMEOUT)
+        except (AttributeError, ValueError, KeyError, TypeError):
+            failed.append(name)
+    days = defaultdict(list)
+    for name, videos in node_videos.items():
+        for video in videos or ():
+            days[video.timestamp.date()].append((name, video))
+    return ([(day, sorted(days[day], key=lambda v: v[1].timestamp, reverse=True))
+             for day in sorted(days, reverse=True)],
+            failed)
+
+
+def node_frame(node: Node, size: str) -> bytes:
+    """Returns the latest live preview frame of a node. Frames are kept in
+    the cache for settings.CAMERA_AGGREGATOR_FRAME_CACHE_TIMEOUT seconds, so
+    that a node is asked once for everybody watching it
+    :return the frame, empty if there is none, or None if the node did not
+    answer
+    """
+    cache_key = 'aggregator:frame:{}:{}'.format(node.name, size)
+    frame = cache.get(cache_key)
+    if frame is None:
+        try:
+            frame = node.fetch('still_frame?size={}'.format(size))
+        except (IOError, http.client.HTTPException):
+            return None
+        cache.set(cache_key, frame, settings.CAMERA_AGGREGATOR_FRAME_CACHE_TIMEOUT)
+    return frame
@@ -7,24 +7,39 @@ import pathlib
 import pytz
 import re
 import shutil
+import signal
 import subprocess
 import struct
-from time import sleep
-from typing import Tuple, List
+from time import monotonic, process_time, sleep, time
+from typing import Callable, Tuple, List
 from pathlib import Path
 
 from collections import defaultdict, namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from django.conf import settings
 from django.utils.timezone import localtime, now, make_aware
 
 from os.path import expanduser, basename, splitext
 import RPi.GPIO as GPIO
-from multiprocessing import Process, Queue, Lock, RawArray, RawValue
+from multiprocessing import Process, Queue, Lock, RLock, RawArray, RawValue, Value
+from multiprocessing.sharedctypes import synchronized
 
 from pathlib import Path
 import picamera
 
+from camera.clips import KeyframeIndex
+from camera.fmp4 import TIMESCALE, AccessUnitSplitter
+from camera.housekeeping import Housekeeper, HousekeepingStats
+from camera.motion import MotionTrack, MotionVectorOutput
+from camera.thumbnails import ThumbnailPack
+from camera.timelapse import Timelapse
+
+try:
+    import numpy
+except ImportError:     # The adaptive live preview is disabled without numpy
+    numpy = None
+
 
 class GPIOBoard:
 
@@ -57,57 +72,264 @@ class GPIOInput(GPIOSensor):
         return GPIO.wait_for_edge(self._pin, edge_type, timeout=ms_timeout)
 
 
-class Video(namedtuple('Video', ('timestamp', 'file', 'duration', 'thumbnail'))):
+class Video(namedtuple('Video', ('timestamp', 'file', 'duration', 'thumbnail', 'proxy'))):
 
     # Regex for parsing video files. File name format is
-    # <YYYY>-<MM>-<DD>_HHMMSS_<duration in seconds>.mp4
-    # the regex splits this in two groups, one with date and time and another
-    # with the duration
-    NAME_RE = re.compile('(\\d{4}-\\d{2}-\\d{2}_\\d{6})_(\\d+)\.mp4')
+    # <YYYY>-<MM>-<DD>_HHMMSS_<duration in seconds>[.<profile>].mp4
+    # the regex splits this in three groups, one with date and time, another
+    # with the duration and the last one with the profile the video was
+    # re-encoded to, if any
+    NAME_RE = re.compile('(\\d{4}-\\d{2}-\\d{2}_\\d{6})_(\\d+)(?:\.([a-z]+))?\.mp4')
+
+
+# Videos have no proxy unless told otherwise, see FileManager.PROXY_SUFFIX
+Video.__new__.__defaults__ = (None,)
 
 
 class FileManager:
 
+    # Regex for the date part of the capture files, used to find the folder
+    # of the file in the sharded layout, <YYYY>/<MM>/<DD>
+    SHARD_RE = re.compile('(\\d{4})-(\\d{2})-(\\d{2})_')
+    # File holding the generation of the list of videos, which changes every
+    # time a video is added or deleted
+    GENERATION_FILE = '.generation'
+    # Log of the videos added and removed, one per line, +<name> or -<name>,
+    # that the activity index is built from
+    ACTIVITY_FILE = '.activity'
+    # Regex for the files that are never modified once they have their name,
+    # that is the videos and their thumbnails, proxies and motion tracks
+    FINISHED_RE = re.compile(Video.NAME_RE.pattern + '(\\.jpg|\\.proxy\\.mp4|\\.motion)?$')
+    # Suffix of the files that are still being written
+    PARTIAL_SUFFIX = '.part'
+    # Regex for the temporary files written by a process before they are
+    # renamed into place, <file>.<pid>, see KeyframeIndex and MotionTrack
+    TEMPORARY_RE = re.compile('.*\\.\\d+$')
+    # Suffix of the low resolution copy of a video recorded next to it, see
+    # settings.CAMERA_PROXY
+    PROXY_SUFFIX = '.proxy.mp4'
+
     def remove_even_thumbnail(self, file_path):
-        for f in (file_path, '{}.jpg'.format(file_path)):
+        for f in (file_path, '{}.jpg'.format(file_path), file_path + KeyframeIndex.SUFFIX,
+                  file_path + self.PROXY_SUFFIX, file_path + MotionTrack.SUFFIX):
             try:
                 os.unlink(f)
             except IOError as e:
                 pass
+        self.log_activity(False, file_path)
 
-    def __init__(self, folder: str=None):
+    def log_activity(self, added: bool, file_path: str):
+        """Adds a video to the activity log, see camera.activity. Lines are
+        appended with a single write so that processes do not mix them
+        :param added: whether the video was added or removed
+        :param file_path: the path of the video, anything else is ignored
+        """
+        name = basename(file_path)
+        if Video.NAME_RE.fullmatch(name):
+            with open(os.path.join(self._folder, self.ACTIVITY_FILE), 'a') as f:
+                f.write('{}{}\n'.format('+' if added else '-', name))
+
+    def __init__(self, folder: str=None, sharded: bool=None,
+                 cleanup: bool=True):
+        """Manages the capture folder
+        :param folder: the capture folder, ~/capture by default
+        :param sharded: whether files are stored in one folder per day,
+        <YYYY>/<MM>/<DD>, or all together in the capture folder. By default
+        settings.CAMERA_STORAGE_SHARDED. In the sharded layout files still
+        in the capture folder are found too, so that the folder can be
+        migrated while it is in use
+        :param cleanup: whether temporary files left by a previous run are
+        removed. Only the capture daemon may do it, anybody else would be
+        removing the recording in progress
+        """
         self._folder = folder or os.path.join(expanduser('~'), 'capture')
+        if sharded is None:
+            sharded = settings.CAMERA_STORAGE_SHARDED
+        self._sharded = sharded
         pathlib.Path(self._folder).mkdir(parents=True, exist_ok=True)
-        for temp_video in pathlib.Path(self._folder).glob('*.h264'):
-            self.remove_even_thumbnail(str(temp_video.absolute()))
+        if cleanup:
+            self.cleanup()
+
+    def cleanup(self, before: float=None):
+        """Removes the temporary files left by a previous run
+        :param before: the time the files must have last been modified
+        before, so that the recordings in progress are left alone. By
+        default every temporary file is removed
+        """
+        for temp_file in self.glob('*.h264') + self.glob('*' + self.PARTIAL_SUFFIX):
+            try:
+                if before is not None and temp_file.stat().st_mtime >= before:
+                    continue
+            except OSError:
+                continue    # Converted meanwhile
+            if temp_file.name.endswith('.h264'):
+                self.remove_even_thumbnail(str(temp_file.absolute()))
+            else:
+                temp_file.unlink()
+
+    def generation(self) -> Tuple[int, float]:
+        """Returns the generation of the list of videos and the time it
+        changed, or (0, None) if it has never changed
+        """
+        generation_path = os.path.join(self._folder, self.GENERATION_FILE)
+        try:
+            with open(generation_path) as f:
+                return int(f.read() or 0), os.fstat(f.fileno()).st_mtime
+        except (IOError, ValueError):
+            return 0, None
+
+    def bump_generation(self):
+        """Flags that the list of videos changed. Several processes may do
+        it at the same time, so rather than a plain counter the generation
+        is the time in microseconds, that never repeats a previous value
+        """
+        generation_path = os.path.join(self._folder, self.GENERATION_FILE)
+        generation = max(self.generation()[0] + 1, int(time() * 1000000))
+        temp_path = '{}.{}'.format(generation_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write(str(generation))
+        os.replace(temp_path, generation_path)
+
+    @classmethod
+    def is_finished(cls, file_path: str) -> bool:
+        """Tells whether a file is a video or thumbnail that is complete and
+        so will not change anymore, time-lapses included
+        """
+        return cls.FINISHED_RE.match(basename(file_path)) is not None or \
+            Timelapse.NAME_RE.fullmatch(basename(file_path)) is not None
+
+    def glob(self, pattern: str) -> List[Path]:
+        """Returns the files in the capture folder that match the pattern,
+        looking in the day folders as well in the sharded layout
+        """
+        folder = Path(self._folder)
+        files = list(folder.glob(pattern))
+        if self._sharded:
+            files.extend(folder.glob(os.path.join('*', '*', '*', pattern)))
+        return files
+
+    def thumbnail_pack(self, file_name: str) -> ThumbnailPack:
+        """Returns the pack with the thumbnails of the day of a file, which
+        is kept next to the videos of that day
+        :param file_name: the name of a file starting with its date
+        """
+        day = basename(file_name)[:len('YYYY-MM-DD')]
+        return ThumbnailPack(self.complete_path('{}_thumbnails'.format(day)))
+
+    def pack_thumbnail(self, thumbnail_file: str, video_fname: str):
+        """Moves the thumbnail of a video into the pack of its day
+        :param thumbnail_file: the path of the thumbnail
+        :param video_fname: the name of the video
+        """
+        name_parts = Video.NAME_RE.match(basename(video_fname))
+        with open(thumbnail_file, 'rb') as f:
+            self.thumbnail_pack(video_fname).append(name_parts.group(1), f.read())
+        os.unlink(thumbnail_file)
+
+    @classmethod
+    def day_folder(cls, file_name: str) -> str:
+        """Returns the day folder of a file in the sharded layout, relative
+        to the capture folder, or an empty string if the file name does not
+        start with a date
+        """
+        name_parts = cls.SHARD_RE.match(basename(file_name))
+        if not name_parts:
+            return ''
+        return os.path.join(*name_parts.groups())
+
+    def shard(self, file_name: str) -> str:
+        """Returns the folder, relative to the capture folder, where a file
+        is stored, which is the capture folder itself in the flat layout
+        """
+        return self.day_folder(file_name) if self._sharded else ''
 
     def new_filename(self) -> str:
         timestamp = now().strftime('%Y-%m-%d_%H%M%S')
-        return os.path.join(self._folder, '{}.h264'.format(timestamp))
+        file_name = '{}.h264'.format(timestamp)
+        folder = os.path.join(self._folder, self.shard(file_name))
+        pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
+        return os.path.join(folder, file_name)
 
     def complete_path(self, file_name: str) -> str:
-        return os.path.join(self._folder, file_name)
+        """Returns the full path of a file given its name, or its path
+        relative to the capture folder
+        """
+        if os.path.dirname(file_name):
+            return os.path.join(self._folder, file_name)
+        return os.path.join(self._folder, self.shard(file_name), file_name)
+
+    def resolve(self, file_name: str) -> str:
+        """Like complete_path but, if the file is not there, looks for it
+        in the other layout, so that links keep working while the capture
+        folder is migrated
+        """
+        file_path = self.complete_path(file_name)
+        if not os.path.exists(file_path):
+            name = basename(file_name)
+            for alternative in (os.path.join(self._folder, name),
+                                os.path.join(self._folder, self.day_folder(name), name)):
+                if os.path.exists(alternative):
+                    return alternative
+        return file_path
+
+    def shard_files(self, delay: float=0) -> int:
+        """Moves the files in the capture folder to their day folders. Files
+        are renamed one by one, each video right after its companion files,
+        so that this can run while the camera and the web app are working.
+        Recordings, conversions and files being written are left alone
+        :param delay: seconds to wait after each file moved, to leave the
+        storage alone for recording
+        :return the number of files moved
+        """
+        folder = Path(self._folder)
+        files = [f for f in folder.iterdir()
+                 if f.is_file() and self.day_folder(f.name) and
+                 '.h264' not in f.name and
+                 not f.name.endswith(self.PARTIAL_SUFFIX) and
+                 not self.TEMPORARY_RE.match(f.name)]
+        # Companion files, <video>.mp4.<something>, go before their video
+        files.sort(key=lambda f: (f.name.split('.')[0], -len(f.name)))
+        moved = 0
+        for f in files:
+            day_folder = folder.joinpath(self.day_folder(f.name))
+            day_folder.mkdir(parents=True, exist_ok=True)
+            try:
+                os.rename(str(f), str(day_folder.joinpath(f.name)))
+                moved += 1
+            except OSError:
+                pass
+            if delay:
+                sleep(delay)
+        if moved:
+            self.bump_generation()
+        return moved
 
     def list_videos(self) -> List[Tuple[datetime.date, List[Video]]]:
         """Returns a list of tuples sorted in descending order by date
         with the first item the date and the second the list of video files
-        available
+        available. Video files are given by their path relative to the
+        capture folder
         :return a list of tuples with (date, <list of video instances>)
         """
         folder = Path(self._folder)
         videos = defaultdict(list)
-        for video in folder.glob('*.mp4'):
-            name_parts = Video.NAME_RE.match(video.name)
+        files = self.glob('*.mp4')
+        proxies = {f.name for f in files if f.name.endswith(self.PROXY_SUFFIX)}
+        for video in files:
+            name_parts = Video.NAME_RE.fullmatch(video.name)
             if name_parts:
                 try:
                     timestamp = datetime.strptime(name_parts.group(1),
                                                   '%Y-%m-%d_%H%M%S')
                     timestamp = make_aware(timestamp, pytz.utc)
                     duration = int(name_parts.group(2))
+                    video_file = video.relative_to(folder).as_posix()
                     video_inst = Video(timestamp,
-                                       video.name,
+                                       video_file,
                                        timedelta(seconds=duration),
-                                       '{}.jpg'.format(video.name))
+                                       '{}.jpg'.format(video_file),
+                                       video_file + self.PROXY_SUFFIX
+                                       if video.name + self.PROXY_SUFFIX in proxies else None)
                     videos[video_inst.timestamp.date()].append(video_inst)
                 except ValueError:
                     pass
@@ -117,45 +339,243 @@ class FileManager:
                                reverse=True)
         return [(k, videos[k]) for k in video_keys]
 
-    def apply_storage_policy(self, max_mbytes: int, max_days_kept: int):
+    def list_timelapses(self) -> List[Tuple[datetime.date, str]]:
+        """Returns the daily time-lapses, see camera.timelapse, newest first
+        :return a list of tuples with the day and the path of its time-lapse
+        relative to the capture folder
+        """
+        folder = Path(self._folder)
+        timelapses = []
+        for timelapse in self.glob('*' + Timelapse.SUFFIX):
+            name_parts = Timelapse.NAME_RE.fullmatch(timelapse.name)
+            if name_parts:
+                try:
+                    day = datetime.strptime(name_parts.group(1), '%Y-%m-%d').date()
+                except ValueError:
+                    continue
+                timelapses.append((day, timelapse.relative_to(folder).as_posix()))
+        return sorted(timelapses, reverse=True)
+
+    def plan_storage(self, max_mbytes: int, bitrate: int=None) -> dict:
+        """Predicts how many days of recordings fit in the given space from
+        the videos recorded so far, leaving out the re-encoded ones
+        :param max_mbytes: the space available for videos in MBytes
+        :param bitrate: the bitrate in kbps the videos will be recorded at,
+        to predict the days for it as well
+        :return a dict with the bytes per recorded second, the recordings
+        and recorded seconds per day, and the days predicted for the space
+        at the observed rate and at the given bitrate, or None if nothing
+        was recorded yet
+        """
+        days = set()
+        recordings = recorded_seconds = recorded_bytes = 0
+        for video_date, videos in self.list_videos():
+            for video in videos:
+                if Video.NAME_RE.match(basename(video.file)).group(3):
+                    continue
+                try:
+                    recorded_bytes += os.stat(os.path.join(self._folder, video.file)).st_size
+                except IOError:
+                    continue
+                days.add(video_date)
+                recordings += 1
+                recorded_seconds += video.duration.total_seconds()
+        if not recorded_seconds:
+            return None
+        # Days with no recordings count too
+        day_count = (max(days) - min(days)).days + 1
+        seconds_per_day = recorded_seconds / day_count
+        bytes_per_second = recorded_bytes / recorded_seconds
+        max_bytes = max_mbytes * (1024 * 1024)
+        plan = dict(bytes_per_second=bytes_per_second,
+                    recordings_per_day=recordings / day_count,
+                    seconds_per_day=seconds_per_day,
+                    days=max_bytes / (bytes_per_second * seconds_per_day),
+                    days_at_bitrate=None)
+        if bitrate:
+            plan['days_at_bitrate'] = max_bytes / (bitrate * 1000 / 8 * seconds_per_day)
+        return plan
+
+    def day_in_use(self, day_folder: str) -> bool:
+        """Tells whether a day folder of the sharded layout may still be
+        written to, that is whether it is the current day or it holds a
+        video being recorded or converted
+        :param day_folder: the folder, relative to the capture folder
+        """
+        if day_folder == self.day_folder(now().strftime('%Y-%m-%d_')):
+            return True
+        for _, _, files in os.walk(os.path.join(self._folder, day_folder)):
+            if any(f.endswith('.h264') or f.endswith(self.PARTIAL_SUFFIX) for f in files):
+                return True
+        return False
+
+    def remove_day(self, videos: List[Video], pace: Callable[[], None]=None):
+        """Removes the videos of a day. In the sharded layout the whole day
+        folder goes at once, together with any other file in it, unless the
+        day is still in use, see day_in_use, in which case the videos go one
+        by one
+        :param pace: called after each video removed, to leave the storage
+        alone for recording
+        """
+        day_folder = None
+        if self._sharded and videos:
+            day_folder = self.shard(basename(videos[0].file))
+            if self.day_in_use(day_folder):
+                day_folder = None
+        for video in videos:
+            if day_folder is None or not os.path.dirname(video.file):
+                self.remove_even_thumbnail(os.path.join(self._folder, video.file))
+            else:
+                self.log_activity(False, video.file)
+            if pace is not None:
+                pace()
+        if videos:
+            self.thumbnail_pack(basename(videos[0].file)).remove()
+        if day_folder is not None:
+            day_folder = os.path.join(self._folder, day_folder)
+            shutil.rmtree(day_folder, ignore_errors=True)
+            # Month and year folders go as well once they are empty
+            for parent in (os.path.dirname(day_folder),
+                           os.path.dirname(os.path.dirname(day_folder))):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+
+    def apply_storage_policy(self, max_mbytes: int, max_days_kept: int,
+                             pace: Callable[[], None]=None):
         """Checks that all videos in the list of available videos are
         compliant with the storage policies
         :param max_mbytes: maximum space taken up by videos in MBytes
         :param max_days_kept: maximum number of days kept
+        :param pace: called after each file operation, to leave the storage
+        alone for recording, see camera.housekeeping.Housekeeper.pace
         """
         # First apply maximum number of days
         video_list = self.list_videos()
-        if not video_list:
+        timelapses = self.list_timelapses()
+        if not video_list and not timelapses:
             return
-        first_date = video_list[0][0]
-        for video_date, videos in self.list_videos():
+        first_date = max(day for day, _ in video_list[:1] + timelapses[:1])
+        removed = False
+        for video_date, videos in video_list:
             if (first_date - video_date).days > max_days_kept:
-                for video in videos:
-                    file_path = os.path.join(self._folder, video.file)
-                    self.remove_even_thumbnail(file_path)
+                self.remove_day(videos, pace)
+                removed = True
+        # Time-lapses are kept as long as the recordings
+        for day, timelapse_file in timelapses:
+            if (first_date - day).days > max_days_kept:
+                self.remove_timelapse(timelapse_file)
+                removed = True
         # Then delete videos, oldest first, until the space used is less
-        # than the max_mbytes
-        video_list = self.list_videos()
+        # than the max_mbytes. Whole days go at once when possible
+        if removed:
+            video_list = self.list_videos()
         max_size_in_bytes = max_mbytes * (1024 * 1024)
-        total_size = 0
+        video_sizes = dict()
         for _, video_files in video_list:
             for v in video_files:
                 try:
-                    video_size = os.stat(os.path.join(self._folder, v.file)).st_size
-                    total_size += video_size
+                    video_sizes[v.file] = os.stat(os.path.join(self._folder, v.file)).st_size
                 except IOError:
                     pass
-        while len(video_list) > 0 and total_size > max_size_in_bytes:
-            last_video = video_list[-1][1][-1]
+                if pace is not None:
+                    pace()
+        timelapse_sizes = []
+        for day, timelapse_file in timelapses:
+            try:
+                timelapse_sizes.append((day, timelapse_file,
+                                        os.stat(os.path.join(self._folder, timelapse_file)).st_size))
+            except IOError:
+                pass
+        total_size = sum(video_sizes.values()) + sum(size for _, _, size in timelapse_sizes)
+        while (video_list or timelapse_sizes) and total_size > max_size_in_bytes:
+            # A time-lapse goes once the recordings of its day are gone
+            if timelapse_sizes and (not video_list or timelapse_sizes[-1][0] < video_list[-1][0]):
+                _, timelapse_file, size = timelapse_sizes.pop()
+                self.remove_timelapse(timelapse_file)
+                total_size -= size
+                removed = True
+                continue
+            oldest_videos = video_list[-1][1]
+            day_size = sum(video_sizes.get(v.file, 0) for v in oldest_videos)
+            newest_size = video_sizes.get(oldest_videos[0].file, 0)
+            removed = True
+            # The day goes entirely if even its newest video has to go
+            if self._sharded and total_size - day_size + newest_size > max_size_in_bytes:
+                self.remove_day(oldest_videos, pace)
+                total_size -= day_size
+                # Its time-lapse went with the day folder
+                if timelapse_sizes and timelapse_sizes[-1][0] == video_list[-1][0]:
+                    total_size -= timelapse_sizes.pop()[2]
+                video_list = video_list[:-1]
+                continue
+            last_video = oldest_videos[-1]
             file_path = os.path.join(self._folder, last_video.file)
-            size_to_delete = os.stat(file_path).st_size
             # We may fail for whatever IO reason but we assume we've
             # deleted the file(s)
             self.remove_even_thumbnail(file_path)
-            total_size -= size_to_delete
-            video_list[-1] = (video_list[-1][0], video_list[-1][1][:-1])
+            if pace is not None:
+                pace()
+            total_size -= video_sizes.get(last_video.file, 0)
+            video_list[-1] = (video_list[-1][0], oldest_videos[:-1])
             if len(video_list[-1][1]) == 0:
+                self.thumbnail_pack(basename(last_video.file)).remove()
                 video_list = video_list[:-1]
+        if removed:
+            self.bump_generation()
+
+    def remove_timelapse(self, timelapse_file: str):
+        """Removes a daily time-lapse
+        :param timelapse_file: its path relative to the capture folder
+        """
+        try:
+            os.unlink(os.path.join(self._folder, timelapse_file))
+        except IOError:
+            pass
+
+
+class FrameTooLarge(IOError):
+    """Raised when a frame does not fit in the buffer it is written to
+    """
+
+
+class SharedBufferWriter(io.RawIOBase):
+    """Writable file-like object over one of the shared live feed buffers,
+    so that the camera encodes the snapshot straight into shared memory.
+    The first four bytes of the buffer are kept for the length of the data,
+    which is only written when the snapshot is sealed. Writers are meant to
+    be reused, nothing is allocated per snapshot
+    """
+
+    def __init__(self, buffer: RawArray):
+        super().__init__()
+        self._view = memoryview(buffer).cast('B')
+        self._position = 4
+
+    def writable(self) -> bool:
+        return True
+
+    def rewind(self):
+        """Starts a new snapshot, discarding whatever was written before
+        """
+        self._position = 4
+
+    def write(self, data) -> int:
+        end = self._position + len(data)
+        if end > len(self._view):
+            raise FrameTooLarge('Frame does not fit in a {} bytes buffer'.format(len(self._view)))
+        self._view[self._position:end] = data
+        self._position = end
+        return len(data)
+
+    def seal(self) -> int:
+        """Writes the length of the snapshot at the beginning of the buffer
+        :return the length of the snapshot
+        """
+        length = self._position - 4
+        struct.pack_into('I', self._view, 0, length)
+        return length
 
 
 class LiveFeed:
@@ -164,7 +584,13 @@ class LiveFeed:
                  usage_lock: Lock,
                  usage_counter: RawValue,
                  buffer_index: RawValue,
-                 buffers: List[RawArray]):
+                 buffers: List[RawArray],
+                 overflow_counter: RawValue=None,
+                 quality: int=None,
+                 resize: Tuple[int, int]=None,
+                 sequence: RawValue=None,
+                 frame_time: RawValue=None,
+                 read_time: RawValue=None):
         """Creates a LiveFeed object that can update the images in a
         buffer list. The buffer_index parameter indicates which buffer
         is available in each moment, or -1 if there is none.
@@ -180,24 +606,131 @@ class LiveFeed:
         Each one has to be big enough to contain a snapshot plus four bytes
         at the beggining that contain the length of the image file that is
         dumped in the buffer
+        :param overflow_counter: the shared counter of snapshots that were
+        dropped because they did not fit in the buffers
+        :param quality: the JPEG quality used for the snapshots, defaults
+        to settings.CAMERA_PREVIEW_QUALITY
+        :param resize: the (width, height) the camera hardware resizer
+        scales the snapshots to, or None to keep the camera resolution
+        :param sequence: the shared counter increased every time a new
+        snapshot is published, so that readers can tell snapshots apart
+        :param frame_time: the shared time.monotonic() of the last time the
+        latest snapshot was known to show the scene, see age
+        :param read_time: the shared time.monotonic() of the last time a
+        snapshot was asked for, see read_age
         """
         self._buffers = buffers
+        self._writers = [SharedBufferWriter(b) for b in buffers]
         self._usage_lock = usage_lock
         self._usage_counter = usage_counter
         self._buffer_index = buffer_index
+        if overflow_counter is None:
+            overflow_counter = RawValue(ctypes.c_uint)
+        self._overflow_counter = overflow_counter
+        self._quality = quality or settings.CAMERA_PREVIEW_QUALITY
+        self._resize = resize
+        if sequence is None:
+            sequence = RawValue(ctypes.c_uint)
+        self._sequence = sequence
+        if frame_time is None:
+            frame_time = RawValue(ctypes.c_double)
+        self._frame_time = frame_time
+        if read_time is None:
+            read_time = RawValue(ctypes.c_double)
+        self._read_time = read_time
+
+    @classmethod
+    def allocate(cls, buffer_size: int, buffer_count: int=2,
+                 quality: int=None, resize: Tuple[int, int]=None):
+        """Creates a LiveFeed together with the shared objects it needs
+        :param buffer_size: the size of each one of the buffers
+        :param buffer_count: the number of buffers rotated on
+        """
+        buffer_index = RawValue(ctypes.c_int)
+        buffer_index.value = -1
+        # Sequences start from the current time so that they are not repeated
+        # after a restart and can be used as HTTP validators
+        sequence = RawValue(ctypes.c_uint)
+        sequence.value = int(time()) & 0xffffffff
+        return cls(Lock(),
+                   RawValue(ctypes.c_uint),
+                   buffer_index,
+                   [RawArray(ctypes.c_byte, buffer_size) for i in range(buffer_count)],
+                   RawValue(ctypes.c_uint),
+                   quality,
+                   resize,
+                   sequence,
+                   RawValue(ctypes.c_double),
+                   RawValue(ctypes.c_double))
+
+    @property
+    def buffer_size(self) -> int:
+        return len(self._buffers[0])
+
+    @property
+    def memory(self) -> int:
+        return sum(len(b) for b in self._buffers)
+
+    @property
+    def overflows(self) -> int:
+        return self._overflow_counter.value
+
+    @property
+    def sequence(self) -> int:
+        return self._sequence.value
+
+    @property
+    def age(self) -> float:
+        """Seconds since the latest snapshot was last known to show the
+        scene, None if no snapshot has been taken yet. The monotonic clock is
+        the same in every process
+        """
+        if self._buffer_index.value == -1:
+            return None
+        return max(0., monotonic() - self._frame_time.value)
+
+    @property
+    def read_age(self) -> float:
+        """Seconds since a snapshot was last asked for
+        """
+        return monotonic() - self._read_time.value
+
+    def mark_read(self):
+        self._read_time.value = monotonic()
+
+    def confirm(self):
+        """Tells that the latest snapshot still shows the scene, as when the
+        scene has not changed since it was taken
+        """
+        self._frame_time.value = monotonic()
+
+    def recover(self, timeout: float=1):
+        """Releases the usage lock if a capture daemon died holding it, so
+        that the buffers can be used by the next one. Everybody else holds it
+        for an instant
+        """
+        self._usage_lock.acquire(timeout=timeout)
+        self._usage_lock.release()
 
     def take_snapshot(self, cam: picamera.PiCamera, new_buffer_index: int):
         """Talks a snapshot and stores it in the shared buffer. Assumes that
-        the buffer is not being used
+        the buffer is not being used. Snapshots that do not fit in the buffer
+        are dropped and counted in the overflow counter, leaving the last
+        good snapshot as the current one
         :param cam: the PiCamera instance that is used
         :param new_buffer_index: the buffer that will hold the snapshot image
         """
-        iobuff = io.BytesIO()
-        cam.capture(iobuff, 'jpeg', use_video_port=True)
-        buffer = iobuff.getvalue()
-        buffer_len = len(buffer)
-        self._buffers[new_buffer_index][:4] = struct.pack('I', buffer_len)
-        self._buffers[new_buffer_index][4:4 + buffer_len] = buffer[:]
+        writer = self._writers[new_buffer_index]
+        writer.rewind()
+        try:
+            cam.capture(writer, 'jpeg', use_video_port=True,
+                        quality=self._quality, resize=self._resize)
+        except FrameTooLarge:
+            self._overflow_counter.value += 1
+            return
+        writer.seal()
+        self._sequence.value = (self._sequence.value + 1) & 0xffffffff
+        self._frame_time.value = monotonic()
         self._buffer_index.value = new_buffer_index
 
     def capture_frame(self, cam: picamera.PiCamera):
@@ -213,33 +746,677 @@ class LiveFeed:
                 new_buffer_index = (1 + self._buffer_index.value) % len(self._buffers)
                 self.take_snapshot(cam, new_buffer_index)
 
+    @contextmanager
+    def latest_snapshot(self, timeout: float=1):
+        """Context manager that yields a memoryview over the latest snapshot,
+        its four bytes length prefix included, or None if no snapshot has been
+        taken yet. The snapshot, and so the sequence, are not changed until
+        the context is left
+        :param timeout: seconds to wait for the capture daemon to release the
+        buffers, which it holds while it takes a snapshot. None is yielded
+        if it does not release them in time, as when it is stuck or died
+        holding them
+        """
+        if not self._usage_lock.acquire(timeout=timeout):
+            yield None
+            return
+        try:
+            self._usage_counter.value += 1
+        finally:
+            self._usage_lock.release()
+        try:
+            buffer_index = self._buffer_index.value
+            if buffer_index == -1:
+                yield None
+            else:
+                view = memoryview(self._buffers[buffer_index]).cast('B')
+                yield view[:4 + struct.unpack_from('I', view)[0]]
+        finally:
+            with self._usage_lock:
+                self._usage_counter.value -= 1
+
+
+class SceneStats(ctypes.Structure):
+    """Shared figures of the adaptive live preview. Times are in seconds and
+    are split between the active mode, when the scene keeps changing, and
+    the static mode
+    """
+    _fields_ = (('static', ctypes.c_bool),
+                ('probes', ctypes.c_uint),
+                ('published', ctypes.c_uint),
+                ('deduplicated', ctypes.c_uint),
+                ('time_active', ctypes.c_double),
+                ('time_static', ctypes.c_double),
+                ('cpu_active', ctypes.c_double),
+                ('cpu_static', ctypes.c_double),
+                ('bytes_active', ctypes.c_ulonglong),
+                ('bytes_static', ctypes.c_ulonglong))
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name, _ in self._fields_}
+
+
+class SceneMonitor:
+
+    def __init__(self, resolution: Tuple[int, int]=None, threshold: float=None):
+        """Tells whether the scene changed by comparing the luma of tiny YUV
+        captures taken through the camera hardware resizer. All the arrays
+        are allocated once
+        :param resolution: the (width, height) of the probes, by default
+        settings.CAMERA_SCENE_PROBE_RESOLUTION. Width has to be a multiple of
+        32 and height a multiple of 16 so that YUV captures are not padded
+        :param threshold: the mean absolute luma difference above which the
+        scene has changed, by default settings.CAMERA_SCENE_CHANGE_THRESHOLD
+        """
+        width, height = resolution or settings.CAMERA_SCENE_PROBE_RESOLUTION
+        self._resize = (width, height)
+        self._threshold = threshold or settings.CAMERA_SCENE_CHANGE_THRESHOLD
+        # YUV420 is a full resolution Y plane followed by quarter U and V ones
+        self._probe = numpy.zeros(width * height * 3 // 2, dtype=numpy.uint8)
+        self._luma = self._probe[:width * height]
+        self._reference = numpy.zeros(width * height, dtype=numpy.int16)
+        self._difference = numpy.zeros(width * height, dtype=numpy.int16)
+        self._primed = False
+
+    def changed(self, cam: picamera.PiCamera) -> bool:
+        """Takes a new probe and compares it with the one taken when the
+        scene last changed, which is when a frame was last published, so
+        that slow changes add up until they count. The first probe always
+        counts as a change
+        """
+        cam.capture(self._probe, 'yuv', use_video_port=True, resize=self._resize)
+        numpy.subtract(self._luma, self._reference, out=self._difference)
+        numpy.abs(self._difference, out=self._difference)
+        if self._primed and self._difference.mean() <= self._threshold:
+            return False
+        self._primed = True
+        self._reference[:] = self._luma
+        return True
+
+
+class Heartbeat(ctypes.Structure):
+    """Shared pulse of the capture loop, so that the camera server can tell
+    a loop that is stuck, for instance in the camera or waiting for the
+    sensor, from one that has nothing new to show. Every iteration of the
+    loop sets the deadline of the next one, and lag is how late the last
+    one was. Times are time.monotonic() seconds, the same clock in every
+    process
+    """
+    _fields_ = (('beat', ctypes.c_double),
+                ('deadline', ctypes.c_double),
+                ('beats', ctypes.c_ulonglong),
+                ('lag', ctypes.c_double),
+                ('max_lag', ctypes.c_double),
+                ('stalled', ctypes.c_bool),
+                ('stalls', ctypes.c_uint),
+                ('restarts', ctypes.c_uint),
+                ('recovery', ctypes.c_double),
+                ('max_recovery', ctypes.c_double))
+
+    def reset(self, grace: float):
+        """Arms the heartbeat for a capture loop that is starting
+        :param grace: the seconds the loop has to start beating
+        """
+        self.beat = monotonic()
+        self.deadline = self.beat + grace
+        self.beats = 0
+        self.stalled = False
+
+    def pulse(self, interval: float):
+        """Tells that the loop is alive
+        :param interval: the seconds until the next iteration is due
+        """
+        tick = monotonic()
+        if self.beats:
+            self.lag = max(0., tick - self.deadline)
+            self.max_lag = max(self.max_lag, self.lag)
+        self.beat = tick
+        self.deadline = tick + interval
+        self.beats += 1
+
+    def overdue(self) -> float:
+        """Seconds the loop is late on its deadline, 0 if it is on time or
+        was never started
+        """
+        if not self.deadline:
+            return 0.
+        return max(0., monotonic() - self.deadline)
+
+    def check(self, timeout: float) -> bool:
+        """Flags the loop as stalled when it is more than timeout seconds
+        late, and clears the flag once it beats again
+        :return True if the loop has just stalled
+        """
+        stalled = self.overdue() > timeout
+        stalling = stalled and not self.stalled
+        if stalling:
+            self.stalls += 1
+        self.stalled = stalled
+        return stalling
+
+    def add_recovery(self, seconds: float):
+        """Keeps the time from a failure of the loop to the first beat of
+        the one that replaced it
+        """
+        self.recovery = seconds
+        self.max_recovery = max(self.max_recovery, seconds)
+
+    def as_dict(self) -> dict:
+        figures = {name: getattr(self, name) for name, _ in self._fields_ if name not in ('beat', 'deadline')}
+        figures['age'] = max(0., monotonic() - self.beat) if self.deadline else None
+        figures['overdue'] = self.overdue()
+        return figures
+
+
+class LivePreview:
+
+    def __init__(self, live_feeds: List[LiveFeed],
+                 scene_monitor: SceneMonitor=None,
+                 scene_stats: RawValue=None,
+                 timelapse: Timelapse=None,
+                 heartbeat: RawValue=None):
+        """Groups the live feeds of every preview rendition so that they are
+        all refreshed together. With a scene monitor the preview rate adapts
+        to the scene: every time the scene is found unchanged the interval
+        between frames doubles, up to settings.CAMERA_PREVIEW_STATIC_FREQ,
+        and nothing is published. As soon as it changes the interval goes
+        back to settings.CAMERA_PREVIEW_FREQ
+        :param live_feeds: the live feeds, one per rendition
+        :param scene_monitor: the scene monitor, None to refresh the feeds
+        every time
+        :param scene_stats: the shared SceneStats updated with the time and
+        CPU spent in each mode
+        :param timelapse: the daily time-lapse that samples the frames
+        :param heartbeat: the shared Heartbeat of the capture loop, which
+        captures a frame at least every CAMERA_PREVIEW_FREQ seconds while
+        recording and every MOTION_SENSOR_TIMEOUT otherwise
+        """
+        self._live_feeds = live_feeds
+        self._scene_monitor = scene_monitor
+        if scene_stats is None:
+            scene_stats = RawValue(SceneStats)
+        self._stats = scene_stats
+        self._timelapse = timelapse
+        if heartbeat is None:
+            heartbeat = RawValue(Heartbeat)
+        self._heartbeat = heartbeat
+        self._loop_interval = max(settings.CAMERA_PREVIEW_FREQ, settings.MOTION_SENSOR_TIMEOUT / 1000)
+        self._interval = settings.CAMERA_PREVIEW_FREQ
+        self._next_frame = 0
+        self._last_tick = None
+        # When the renditions nobody watches are refreshed next, and whether
+        # each rendition shows the scene as it was last probed
+        self._next_idle_frames = [0] * len(live_feeds)
+        self._current = [False] * len(live_feeds)
+
+    def activate(self):
+        """Goes back to the full preview rate, for instance because motion
+        has been detected
+        """
+        self._interval = settings.CAMERA_PREVIEW_FREQ
+        self._next_frame = 0
+
+    def publish(self, cam: picamera.PiCamera, tick: float=None):
+        """Captures a frame, and so encodes a JPEG, for every rendition
+        asked for in the last settings.CAMERA_PREVIEW_IDLE_AFTER seconds. The
+        others are only refreshed every CAMERA_PREVIEW_STATIC_FREQ seconds
+        """
+        tick = tick if tick is not None else monotonic()
+        for index, live_feed in enumerate(self._live_feeds):
+            if live_feed.read_age < settings.CAMERA_PREVIEW_IDLE_AFTER or tick >= self._next_idle_frames[index]:
+                self.publish_rendition(cam, index, tick)
+            else:
+                self._current[index] = False
+
+    def publish_rendition(self, cam: picamera.PiCamera, index: int, tick: float):
+        self._live_feeds[index].capture_frame(cam)
+        self._next_idle_frames[index] = tick + settings.CAMERA_PREVIEW_STATIC_FREQ
+        self._current[index] = True
+
+    def pulse(self):
+        self._heartbeat.pulse(self._loop_interval)
+
+    def capture_frame(self, cam: picamera.PiCamera):
+        self.refresh(cam)
+        if self._timelapse is not None:
+            self._timelapse.sample()
+        self.pulse()
 
-def video_conversion(framerate: int, capture_file: str, full_video_fname: str):
+    def refresh(self, cam: picamera.PiCamera):
+        if self._scene_monitor is None:
+            self.publish(cam)
+            return
+        tick = monotonic()
+        if self._last_tick is not None:
+            if self._stats.static:
+                self._stats.time_static += tick - self._last_tick
+            else:
+                self._stats.time_active += tick - self._last_tick
+        self._last_tick = tick
+        if tick < self._next_frame:
+            return
+        cpu_start = process_time()
+        self._stats.probes += 1
+        if self._scene_monitor.changed(cam):
+            self._interval = settings.CAMERA_PREVIEW_FREQ
+            self._stats.static = False
+            self.publish(cam, tick)
+            self._stats.published += 1
+            self._stats.cpu_active += process_time() - cpu_start
+        else:
+            self._interval = min(2 * self._interval, settings.CAMERA_PREVIEW_STATIC_FREQ)
+            # What is being shown is still live, but for the renditions
+            # that were not refreshed on the last change. Those are published
+            # now if somebody started watching them meanwhile
+            for index, live_feed in enumerate(self._live_feeds):
+                if self._current[index]:
+                    live_feed.confirm()
+                elif live_feed.read_age < settings.CAMERA_PREVIEW_IDLE_AFTER:
+                    self.publish_rendition(cam, index, tick)
+            self._stats.static = True
+            self._stats.deduplicated += 1
+            self._stats.cpu_static += process_time() - cpu_start
+        self._next_frame = tick + self._interval
+
+
+class StreamBuffer:
+    """Shared ring buffer with the latest frames of the live H.264 stream,
+    written by the capture daemon and read by any number of readers in other
+    processes, see StreamReader. Each frame is stored as a header followed by
+    its Annex B bytes. Positions are counted in bytes since the beginning of
+    the stream, so that a reader can tell when the frames it was going to
+    read have been overwritten
+    """
+
+    # Length, timestamp and duration in fmp4.TIMESCALE units, key frame flag
+    RECORD_HEADER = struct.Struct('<IQIB')
+
+    def __init__(self, buffer: RawArray, write_position: RawValue, reserved_position: RawValue,
+                 keyframe_position: RawValue, latest_timestamp: RawValue, frames: RawValue):
+        """
+        :param write_position: the end of the last frame written
+        :param reserved_position: the end of the frame being written, data
+        before it and after write_position may be overwritten meanwhile
+        :param keyframe_position: the beginning of the latest key frame, or
+        -1 if there is none yet
+        :param latest_timestamp: the timestamp of the latest frame
+        :param frames: the number of frames written
+        """
+        self._buffer = buffer
+        self._view = memoryview(buffer).cast('B')
+        self._write_position = write_position
+        self._reserved_position = reserved_position
+        self._keyframe_position = keyframe_position
+        self._latest_timestamp = latest_timestamp
+        self._frames = frames
+
+    @classmethod
+    def allocate(cls, size: int):
+        keyframe_position = RawValue(ctypes.c_longlong)
+        keyframe_position.value = -1
+        return cls(RawArray(ctypes.c_byte, size), RawValue(ctypes.c_ulonglong), RawValue(ctypes.c_ulonglong),
+                   keyframe_position, RawValue(ctypes.c_ulonglong), RawValue(ctypes.c_uint))
+
+    @property
+    def size(self) -> int:
+        return len(self._view)
+
+    @property
+    def write_position(self) -> int:
+        return self._write_position.value
+
+    @property
+    def keyframe_position(self) -> int:
+        return self._keyframe_position.value
+
+    @property
+    def latest_timestamp(self) -> int:
+        return self._latest_timestamp.value
+
+    @property
+    def frames(self) -> int:
+        return self._frames.value
+
+    def _copy_in(self, position: int, data: bytes):
+        start = position % self.size
+        first = min(len(data), self.size - start)
+        self._view[start:start + first] = data[:first]
+        self._view[:len(data) - first] = data[first:]
+
+    def copy_out(self, position: int, length: int) -> bytes:
+        start = position % self.size
+        first = min(length, self.size - start)
+        return bytes(self._view[start:start + first]) + bytes(self._view[:length - first])
+
+    def valid(self, position: int) -> bool:
+        """Whether the data from the given position on has not been
+        overwritten, nor is being overwritten
+        """
+        return position >= self._reserved_position.value - self.size
+
+    def write(self, frame: bytes, timestamp: int, duration: int, keyframe: bool):
+        """Adds a frame. Frames larger than the buffer are dropped
+        """
+        record = self.RECORD_HEADER.pack(len(frame), timestamp, duration, keyframe) + frame
+        if len(record) > self.size:
+            return
+        position = self._write_position.value
+        self._reserved_position.value = position + len(record)
+        self._copy_in(position, record)
+        self._write_position.value = position + len(record)
+        self._latest_timestamp.value = timestamp
+        self._frames.value += 1
+        if keyframe:
+            self._keyframe_position.value = position
+        elif self._keyframe_position.value != -1 and not self.valid(self._keyframe_position.value):
+            self._keyframe_position.value = -1
+
+
+class StreamReader:
+    """Reads the frames of a StreamBuffer, from the latest key frame on. A
+    reader that falls behind, because the frames it was going to read were
+    overwritten or are older than the lag allowed, skips to the latest key
+    frame, so that it never gets more than that behind the camera
+    """
+
+    def __init__(self, stream: StreamBuffer, max_lag: float=None):
+        """
+        :param max_lag: the seconds a reader may fall behind the latest
+        frame, by default settings.CAMERA_LIVE_STREAM_MAX_LAG
+        """
+        self._stream = stream
+        self._max_lag = int((max_lag or settings.CAMERA_LIVE_STREAM_MAX_LAG) * TIMESCALE)
+        self._position = -1
+        self.skips = 0
+
+    def _skip_to_keyframe(self) -> bool:
+        if self._position != -1:
+            self.skips += 1
+        self._position = self._stream.keyframe_position
+        return self._position != -1
+
+    def read(self) -> List[Tuple[bytes, int, int, bool]]:
+        """Returns the frames written since the last read, each one as its
+        Annex B bytes, its timestamp, its duration and whether it is a key
+        frame
+        """
+        frames = []
+        header_size = StreamBuffer.RECORD_HEADER.size
+        while True:
+            if (self._position == -1 or not self._stream.valid(self._position)) and \
+                    not self._skip_to_keyframe():
+                return frames
+            if self._position >= self._stream.write_position:
+                return frames
+            length, timestamp, duration, keyframe = StreamBuffer.RECORD_HEADER.unpack(
+                self._stream.copy_out(self._position, header_size))
+            frame = self._stream.copy_out(self._position + header_size, length)
+            if not self._stream.valid(self._position):
+                continue
+            if self._stream.latest_timestamp - timestamp > self._max_lag and \
+                    self._stream.keyframe_position > self._position:
+                self._skip_to_keyframe()
+                continue
+            frames.append((frame, timestamp, duration, bool(keyframe)))
+            self._position += header_size + length
+
+
+class LiveStreamOutput(io.RawIOBase):
+    """Output of the live H.264 encoder, which splits the stream in frames
+    and stores them in a StreamBuffer as they are complete
+    """
+
+    # Splitter port of the live encoder, the recordings use the first one
+    SPLITTER_PORT = 3
+
+    def __init__(self, stream: StreamBuffer):
+        super().__init__()
+        self._stream = stream
+        self._splitter = AccessUnitSplitter()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        for frame, timestamp, duration, keyframe in self._splitter.feed(bytes(data), int(monotonic() * TIMESCALE)):
+            self._stream.write(frame, timestamp, duration, keyframe)
+        return len(data)
+
+
+class FlashStats(ctypes.Structure):
+    """Shared figures of the writes of the recordings to the SD card, see
+    StagingArea. Flushes are the copies of staged files to the card, direct
+    writes are the files that were written straight to the card
+    """
+    _fields_ = (('bytes_written', ctypes.c_ulonglong),
+                ('flushes', ctypes.c_uint),
+                ('flush_seconds', ctypes.c_double),
+                ('max_flush_seconds', ctypes.c_double),
+                ('direct_writes', ctypes.c_uint),
+                ('fallbacks', ctypes.c_uint))
+
+    def as_dict(self) -> dict:
+        figures = {name: getattr(self, name) for name, _ in self._fields_}
+        figures['mean_flush_seconds'] = self.flush_seconds / self.flushes if self.flushes else None
+        return figures
+
+
+class StagingArea:
+    """Folder in RAM, usually on a tmpfs, where the recordings are written
+    and converted so that the SD card only gets their final files, copied
+    in large sequential writes. The card takes neither the small writes of
+    the encoder nor the raw video. The folder has an upper bound, what does
+    not fit goes to the card as it does without staging
+    """
+    # Size of each write of the copies to the card
+    FLUSH_CHUNK_SIZE = 1024 * 1024
+    # Seconds of video at the recording bitrate that must fit for a
+    # recording to keep going to the staging folder
+    HEADROOM_SECONDS = 2
+    # Bitrate of the encoder when the recording options do not give one,
+    # the default of PiCamera.start_recording
+    DEFAULT_BITRATE = 17000000
+
+    def __init__(self, folder: str=None, max_mbytes: int=None, stats=None):
+        """
+        :param folder: the staging folder, by default
+        settings.CAMERA_STAGING_FOLDER. Staging is disabled without one
+        :param max_mbytes: the upper bound of the staging folder, by default
+        settings.CAMERA_STAGING_MAX_MB
+        :param stats: the shared FlashStats to update, as a
+        multiprocessing.Value
+        """
+        self._folder = folder if folder is not None else settings.CAMERA_STAGING_FOLDER
+        if max_mbytes is None:
+            max_mbytes = settings.CAMERA_STAGING_MAX_MB
+        self._max_bytes = max_mbytes * 1024 * 1024
+        self._stats = stats if stats is not None else Value(FlashStats)
+        if self._folder:
+            pathlib.Path(self._folder).mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._folder)
+
+    @staticmethod
+    def size(file_path: str) -> int:
+        """Returns the size of a file, 0 if it does not exist
+        """
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+    def room(self) -> int:
+        """Returns the bytes that still fit in the staging folder
+        """
+        if not self.enabled:
+            return 0
+        used = sum(self.size(entry.path) for entry in os.scandir(self._folder))
+        return max(0, self._max_bytes - used)
+
+    def headroom(self, bitrate: int=None) -> int:
+        """Returns the room a recording needs to go on in the staging folder
+        :param bitrate: the bitrate of the recording
+        """
+        return (bitrate or self.DEFAULT_BITRATE) // 8 * self.HEADROOM_SECONDS
+
+    def glob(self, pattern: str) -> List[str]:
+        """Returns the paths of the staged files matching a glob pattern
+        """
+        if not self.enabled:
+            return []
+        return [str(f) for f in Path(self._folder).glob(pattern)]
+
+    def staged(self, file_path: str) -> bool:
+        return self.enabled and os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(self._folder)
+
+    def fits(self, size: int) -> bool:
+        """Tells whether the given bytes still fit in the staging folder,
+        counting a fall back to the card if they do not
+        """
+        if self.room() >= size:
+            return True
+        with self._stats.get_lock():
+            self._stats.get_obj().fallbacks += 1
+        return False
+
+    def path(self, file_path: str, size: int) -> str:
+        """Returns where to write a file in the staging folder
+        :param file_path: the path of the file on the card
+        :param size: the room the file needs
+        :return the path of the file in the staging folder, or None if it
+        does not fit and has to be written to the card
+        """
+        if not self.enabled or not self.fits(size):
+            return None
+        return os.path.join(self._folder, basename(file_path))
+
+    def flush(self, staged_path: str, file_path: str):
+        """Moves a staged file to the card in large sequential writes, and
+        only returns once it is there
+        """
+        start = monotonic()
+        with open(staged_path, 'rb') as source, open(file_path, 'wb') as target:
+            shutil.copyfileobj(source, target, self.FLUSH_CHUNK_SIZE)
+            target.flush()
+            os.fsync(target.fileno())
+            size = target.tell()
+        os.unlink(staged_path)
+        elapsed = monotonic() - start
+        with self._stats.get_lock():
+            stats = self._stats.get_obj()
+            stats.bytes_written += size
+            stats.flushes += 1
+            stats.flush_seconds += elapsed
+            stats.max_flush_seconds = max(stats.max_flush_seconds, elapsed)
+
+    def written(self, file_path: str):
+        """Accounts for a file that was written straight to the card
+        """
+        size = self.size(file_path)
+        with self._stats.get_lock():
+            stats = self._stats.get_obj()
+            stats.bytes_written += size
+            stats.direct_writes += 1
+
+    def clear(self, before: float=None):
+        """Removes the files left in the staging folder by a previous run,
+        only the capture daemon may do it
+        :param before: the time the files must have last been modified
+        before, so that the recordings in progress are left alone. By
+        default every file is removed
+        """
+        if self.enabled:
+            for entry in os.scandir(self._folder):
+                try:
+                    if before is None or entry.stat().st_mtime < before:
+                        os.unlink(entry.path)
+                except OSError:
+                    pass    # Converted meanwhile
+
+
+def video_conversion(framerate: int, capture_file: str, full_video_fname: str,
+                     file_manager: FileManager=None, staging: StagingArea=None,
+                     card_part: str=None, key_frames: bool=True):
     """Perform the ffmpeg conversion in an independent thread and delete the
     capture file on termination. ffmpeg is very verbose but we do not hide
-    its output so that potential problems are easier to diagnose.
+    its output so that potential problems are easier to diagnose. The video
+    is written under a temporary name and only gets its final one when it
+    is complete, so a video file never changes once it has its name. Its
+    key frame index is built right after, for clips to be cut from it
     :param framerate: the intended frame rate
     :param capture_file: the source file
     :param full_video_fname: the resulting file
+    :param file_manager: the file manager told about the new video
+    :param staging: the staging area where the video is converted if it
+    fits, by default the one in the settings
+    :param card_part: the rest of the source, continued on the card when
+    the staging area filled up
+    :param key_frames: whether the key frame index is built, proxies do
+    not need one
     """
+    staging = staging if staging is not None else StagingArea()
+    capture_files = [capture_file] + ([card_part] if card_part else [])
+    for part in capture_files:
+        if not staging.staged(part):
+            staging.written(part)
+    partial_fname = full_video_fname + FileManager.PARTIAL_SUFFIX
+    output_fname = staging.path(partial_fname, sum(staging.size(part) for part in capture_files)) or \
+        partial_fname
     subprocess.run(('ffmpeg',
                     '-framerate', str(framerate),
                     '-r', str(framerate),
-                    '-i', capture_file,
+                    # The raw H.264 parts are just concatenated
+                    '-i', 'concat:' + '|'.join(capture_files) if card_part else capture_file,
                     '-vcodec', 'copy',
-                    full_video_fname))
-    os.remove(capture_file)
+                    '-f', 'mp4',
+                    output_fname))
+    if os.path.exists(output_fname):
+        if output_fname != partial_fname:
+            staging.flush(output_fname, partial_fname)
+        else:
+            staging.written(partial_fname)
+        os.replace(partial_fname, full_video_fname)
+        if key_frames:
+            KeyframeIndex(full_video_fname).build()
+        if file_manager is not None:
+            file_manager.log_activity(True, full_video_fname)
+    for part in capture_files:
+        os.remove(part)
+    if file_manager is not None:
+        file_manager.bump_generation()
 
 
 class VideoCapture:
 
+    # Splitter port of the proxy recording, see settings.CAMERA_PROXY
+    PROXY_SPLITTER_PORT = 2
+
     def __init__(self, cam: picamera.PiCamera, preview_freq: int,
-                 file_manager: FileManager, live_feed: LiveFeed):
+                 file_manager: FileManager, live_feed: LivePreview,
+                 recording_options: dict=None, staging: StagingArea=None,
+                 housekeeper: Housekeeper=None):
+        """
+        :param recording_options: the encoder options, bitrate, quality and
+        intra_period, given to PiCamera.start_recording
+        :param staging: the staging area where the recording is written while
+        it fits, by default the one in the settings
+        :param housekeeper: the housekeeper that stores the thumbnail, by
+        default it is stored when the recording stops
+        """
         self._camera = cam
         self._preview_frequency = preview_freq
         self._file_manager = file_manager
         self._capture_file = None
         self._live_feed = live_feed
+        self._recording_options = recording_options or dict()
+        self._staging = staging if staging is not None else StagingArea()
+        self._housekeeper = housekeeper if housekeeper is not None else Housekeeper()
+        self._recording_files = []
+        self._proxy_file = None
+        self._proxy_files = []
+        self._motion_track = None
 
     def start_recording(self):
         """Start recording and grab a thumbnail frame
@@ -248,11 +1425,53 @@ class VideoCapture:
         timestamp = localtime(now())
         self._camera.annotate_text = timestamp.strftime('%Y-%m-%d %H:%M:%S')
         self._capture_file = self._file_manager.new_filename()
-        self._camera.start_recording(self._capture_file)
-        self._thumbnail_file = '{}.jpg'.format(self._capture_file)
+        self._recording_files = [self._staging.path(self._capture_file, self._headroom()) or
+                                 self._capture_file]
+        recording_options = dict(self._recording_options)
+        if settings.CAMERA_MOTION_TRACK:
+            self._motion_track = MotionTrack(int(self._camera.framerate))
+            # The sensor fired on the first frame
+            self._motion_track.sensor()
+            recording_options['motion_output'] = MotionVectorOutput(settings.CAMERA_RESOLUTION,
+                                                                    self._motion_track)
+        self._camera.start_recording(self._recording_files[0], **recording_options)
+        if settings.CAMERA_PROXY:
+            # On its own encoder, the CPU does not notice it
+            self._proxy_file = '{}.proxy.h264'.format(splitext(self._capture_file)[0])
+            self._proxy_files = [self._staging.path(self._proxy_file, self._proxy_headroom()) or
+                                 self._proxy_file]
+            self._camera.start_recording(self._proxy_files[0], splitter_port=self.PROXY_SPLITTER_PORT,
+                                         **settings.CAMERA_PROXY)
+        self._thumbnail_file = '{}.jpg'.format(self._recording_files[0])
         self._camera.capture(self._thumbnail_file, use_video_port=True)
         self._start_record_time = now()
 
+    def _headroom(self) -> int:
+        return self._staging.headroom(self._recording_options.get('bitrate'))
+
+    def _proxy_headroom(self) -> int:
+        return self._staging.headroom(settings.CAMERA_PROXY.get('bitrate'))
+
+    def spill(self):
+        """Continues the recording, and its proxy, on the card if the staging
+        area is filling up. Each one is checked against its own headroom, as
+        the proxy may still be staged when the recording is not. The encoder
+        switches files at the next key frame
+        """
+        if self._recording_files[-1] != self._capture_file and not self._staging.fits(self._headroom()):
+            self._camera.split_recording(self._capture_file)
+            self._recording_files.append(self._capture_file)
+        if self._proxy_files and self._proxy_files[-1] != self._proxy_file and \
+                not self._staging.fits(self._proxy_headroom()):
+            self._camera.split_recording(self._proxy_file, splitter_port=self.PROXY_SPLITTER_PORT)
+            self._proxy_files.append(self._proxy_file)
+
+    def motion_detected(self):
+        """Marks the motion sensor firing again in the motion track
+        """
+        if self._motion_track is not None:
+            self._motion_track.sensor()
+
     def keep_recording(self, seconds: int):
         """Enter a loop that ensures a still frame is captured for live preview
         up to the specified time lapse. At least one still frame is guaranteed to
@@ -264,56 +1483,142 @@ class VideoCapture:
             self._camera.wait_recording(self._preview_frequency)
             elapsed_time += self._preview_frequency
             self._live_feed.capture_frame(self._camera)
+            self.spill()
+
+    def store_thumbnail(self, thumbnail_file: str, video_fname: str):
+        """Moves the thumbnail of a video to the card, next to the video or
+        into the pack of its day. The sprite sheet of the pack is built
+        right away so that browsing does not wait for ffmpeg
+        """
+        if settings.CAMERA_THUMBNAIL_PACK:
+            self._staging.written(thumbnail_file)
+            self._file_manager.pack_thumbnail(thumbnail_file, video_fname)
+            self._housekeeper.schedule(self._file_manager.thumbnail_pack(video_fname).sprite,
+                                       settings.CAMERA_THUMBNAIL_SPRITE_TILE,
+                                       settings.CAMERA_THUMBNAIL_SPRITE_COLUMNS,
+                                       priority=Housekeeper.BACKGROUND,
+                                       key='sprite_{}'.format(video_fname[:len('YYYY-MM-DD')]))
+            return
+        thumbnail_fname = self._file_manager.complete_path('{}.jpg'.format(video_fname))
+        if self._staging.staged(thumbnail_file):
+            self._staging.flush(thumbnail_file, thumbnail_fname)
+        else:
+            shutil.move(thumbnail_file, thumbnail_fname)
+            self._staging.written(thumbnail_fname)
+
+    def store_motion_track(self, motion_track: MotionTrack, video_fname: str):
+        """Writes the motion track of a video next to it, it takes a byte per
+        frame so it goes straight to the card
+        """
+        track_fname = self._file_manager.complete_path(video_fname + MotionTrack.SUFFIX)
+        motion_track.save(track_fname)
+        self._staging.written(track_fname)
 
     def stop_recording(self):
+        if self._proxy_files:
+            self._camera.stop_recording(splitter_port=self.PROXY_SPLITTER_PORT)
         self._camera.stop_recording()
         self._camera.annotate_text = None
         video_duration = (now() - self._start_record_time).seconds
         video_fname = '{}_{}.mp4'.format(splitext(basename(self._capture_file))[0], str(video_duration))
-        shutil.move(self._thumbnail_file, self._file_manager.complete_path('{}.jpg'.format(video_fname)))
+        self._housekeeper.schedule(self.store_thumbnail, self._thumbnail_file, video_fname,
+                                   priority=Housekeeper.URGENT)
+        if self._motion_track is not None:
+            self._housekeeper.schedule(self.store_motion_track, self._motion_track, video_fname)
         full_video_fname = self._file_manager.complete_path(video_fname)
         Process(target=video_conversion,
                 args=(self._camera.framerate,
-                      self._capture_file,
-                      full_video_fname)).start()
+                      self._recording_files[0],
+                      full_video_fname,
+                      self._file_manager,
+                      self._staging,
+                      self._recording_files[1] if len(self._recording_files) > 1 else None)).start()
+        if self._proxy_files:
+            Process(target=video_conversion,
+                    args=(self._camera.framerate,
+                          self._proxy_files[0],
+                          full_video_fname + FileManager.PROXY_SUFFIX,
+                          self._file_manager,
+                          self._staging,
+                          self._proxy_files[1] if len(self._proxy_files) > 1 else None,
+                          False)).start()
 
 
 def capture_loop(file_manager: FileManager,
                  stop_queue: Queue,
                  settings_queue: Queue,
-                 usage_lock: Lock,
-                 usage_counter: RawValue,
-                 buff_index: RawValue,
-                 buffer1: RawArray,
-                 buffer2: RawArray):
-    with GPIOBoard():
+                 live_feeds: List[LiveFeed],
+                 scene_stats: RawValue=None,
+                 live_stream: StreamBuffer=None,
+                 flash_stats: Value=None,
+                 housekeeping_stats: RawValue=None,
+                 heartbeat: RawValue=None,
+                 start_time: float=None):
+    """
+    :param start_time: the time the first capture daemon of the server
+    started, the files older than that are leftovers of a previous run and
+    removed. By default now. A daemon restarted by the server must not take
+    its own start time, the conversions of the daemon it replaces may still
+    be going on
+    """
+    start_time = start_time or time()
+    staging = StagingArea(stats=flash_stats)
+    # Whatever touches the files but the recording itself, such as the
+    # storage policy, is left to the housekeeper so that it never delays a
+    # recording
+    with GPIOBoard(), Housekeeper(stats=housekeeping_stats) as housekeeper:
+        # Leftovers of a previous run, not of this run's recordings
+        housekeeper.schedule(file_manager.cleanup, start_time, priority=Housekeeper.URGENT)
+        housekeeper.schedule(staging.clear, start_time, priority=Housekeeper.URGENT)
         with picamera.PiCamera() as camera:
             camera.resolution = settings.CAMERA_RESOLUTION
             camera.framerate = settings.CAMERA_FRAMERATE
             movement = GPIOInput(settings.MOTION_SENSOR_IOPORT)
-            live_feed = LiveFeed(usage_lock, usage_counter, buff_index,
-                                 [buffer1, buffer2])
+            scene_monitor = None
+            if settings.CAMERA_PREVIEW_ADAPTIVE and numpy is not None:
+                scene_monitor = SceneMonitor()
+            timelapse = None
+            if settings.CAMERA_TIMELAPSE:
+                rendition_index = Capture.rendition_index(settings.CAMERA_TIMELAPSE.get('rendition'))
+                timelapse = Timelapse(file_manager, live_feeds[rendition_index], housekeeper)
+                housekeeper.schedule(timelapse.finish_pending, priority=Housekeeper.BACKGROUND)
+            live_feed = LivePreview(live_feeds, scene_monitor, scene_stats, timelapse, heartbeat)
+            if live_stream is not None:
+                # Runs all the time, on its own encoder, next to the recordings
+                camera.start_recording(LiveStreamOutput(live_stream), format='h264',
+                                       splitter_port=LiveStreamOutput.SPLITTER_PORT,
+                                       inline_headers=True, **settings.CAMERA_LIVE_STREAM)
             # Wait for camera settings to arrive before starting the actual
             # capture loop
             while settings_queue.empty():
+                live_feed.pulse()
                 sleep(.5)
             while stop_queue.empty():
                 camera_settings = settings_queue.get()
                 camera_settings.apply_to(camera)
                 while stop_queue.empty() and settings_queue.empty():
                     if movement.wait(GPIO.BOTH, ms_timeout=settings.MOTION_SENSOR_TIMEOUT) is not None:
+                        edge_time = monotonic()
                         print("Motion Detected!")
+                        live_feed.activate()
                         file_name = file_manager.new_filename()
                         capture = VideoCapture(camera,
                                                settings.CAMERA_PREVIEW_FREQ,
                                                file_manager,
-                                               live_feed)
-                        capture.start_recording()
+                                               live_feed,
+                                               camera_settings.recording_options(),
+                                               staging,
+                                               housekeeper)
+                        with housekeeper.paused():
+                            capture.start_recording()
+                        housekeeper.stats.add_edge_latency(monotonic() - edge_time)
                         capture.keep_recording(settings.MOTION_SENSOR_SETTLE)
                         missed_movements = 0
                         while stop_queue.empty() and missed_movements < settings.MOTION_SENSOR_RETRIES:
                             if movement.wait(GPIO.BOTH, ms_timeout=settings.MOTION_SENSOR_TIMEOUT) is not None:
                                 print('Motion detected again')
+                                live_feed.activate()
+                                capture.motion_detected()
                                 missed_movements = 0
                                 capture.keep_recording(settings.MOTION_SENSOR_SETTLE)
                             else:
@@ -321,28 +1626,212 @@ def capture_loop(file_manager: FileManager,
                                 missed_movements += 1
                                 capture.keep_recording(0)   # Force still frame
                         capture.stop_recording()
-                        file_manager.apply_storage_policy(camera_settings.max_mb, camera_settings.days_kept)
+                        housekeeper.schedule(file_manager.apply_storage_policy,
+                                             camera_settings.max_mb, camera_settings.days_kept,
+                                             housekeeper.pace,
+                                             priority=Housekeeper.BACKGROUND, key='storage_policy')
                     live_feed.capture_frame(camera)
+            if timelapse is not None:
+                # The frames taken since the last flush
+                timelapse.flush()
 
 
 class Capture:
 
-    MAX_BUFFER_SIZE = 2592 * 1944 * 3 + 4
+    # Room reserved in each buffer for the JPEG headers, EXIF data included
+    JPEG_HEADERS_SIZE = 64 * 1024
+    FEED_BUFFER_COUNT = 2
     CAMERA_CONTENT_MANAGER = None
+    CAMERA_DAEMON = None
+    CAMERA_START_TIME = None
     CAMERA_STOP_DAEMON_QUEUE = Queue()
     CAMERA_SETTINGS_QUEUE = Queue()
-    CAMERA_FEED_BUFFERS = None
-    CAMERA_CURRENT_FEED_LOCK = Lock()
-    CAMERA_CURRENT_FEED_USAGE = RawValue(ctypes.c_uint)
-    CAMERA_CURRENT_FEED_BUFFER = RawValue(ctypes.c_int)
+    CAMERA_SETTINGS = None
+    CAMERA_LIVE_FEEDS = None
+    CAMERA_SCENE_STATS = RawValue(SceneStats)
+    CAMERA_LIVE_STREAM = None
+    CAMERA_FLASH_STATS = Value(FlashStats)
+    CAMERA_HOUSEKEEPING_STATS = RawValue(HousekeepingStats)
+    CAMERA_HEARTBEAT = RawValue(Heartbeat)
 
     @classmethod
-    def init_buffers(cls):
-        cls.CAMERA_FEED_BUFFERS = list()
-        for i in range(2):
-            cls.CAMERA_FEED_BUFFERS.append(RawArray(ctypes.c_byte,
-                                           cls.MAX_BUFFER_SIZE))
-        cls.CAMERA_CURRENT_FEED_BUFFER.value = -1
+    def buffer_size(cls, resolution: Tuple[int, int], quality: int) -> int:
+        """Returns the size of a live feed buffer able to hold a JPEG
+        snapshot of the given resolution and quality plus its length prefix.
+        JPEG files with 4:2:0 subsampling stay well below 3 bytes per pixel
+        even at quality 100 and shrink roughly with the square of the quality,
+        so that is used as the estimate. The result never exceeds
+        max_buffer_size
+        :param resolution: the (width, height) of the snapshots
+        :param quality: the JPEG quality of the snapshots
+        """
+        return min(cls.snapshot_size(resolution, quality), cls.max_buffer_size())
+
+    @classmethod
+    def snapshot_size(cls, resolution: Tuple[int, int], quality: int) -> int:
+        width, height = resolution
+        bytes_per_pixel = max(.5, 3 * (quality / 100) ** 2)
+        return 4 + cls.JPEG_HEADERS_SIZE + int(width * height * bytes_per_pixel)
+
+    @classmethod
+    def max_buffer_size(cls) -> int:
+        """Returns the largest size of a live feed buffer, which is
+        settings.CAMERA_PREVIEW_MAX_BUFFER_SIZE or, if not set, the size the
+        largest rendition of the camera resolution and preview quality in the
+        settings needs
+        """
+        if settings.CAMERA_PREVIEW_MAX_BUFFER_SIZE:
+            return settings.CAMERA_PREVIEW_MAX_BUFFER_SIZE
+        return max(cls.snapshot_size(resize or settings.CAMERA_RESOLUTION,
+                                     rendition_quality or settings.CAMERA_PREVIEW_QUALITY)
+                   for _, resize, rendition_quality in settings.CAMERA_PREVIEW_RENDITIONS)
+
+    @staticmethod
+    def rendition_index(name: str=None) -> int:
+        """Returns the position of a live preview rendition in
+        settings.CAMERA_PREVIEW_RENDITIONS, which is also the position of its
+        live feed, or None if there is no rendition with such name
+        :param name: the rendition name, settings.CAMERA_PREVIEW_RENDITION
+        if None
+        """
+        name = name or settings.CAMERA_PREVIEW_RENDITION
+        for index, (rendition_name, _, _) in enumerate(settings.CAMERA_PREVIEW_RENDITIONS):
+            if rendition_name == name:
+                return index
+        return None
+
+    @classmethod
+    def rendition_sizes(cls, resolution: Tuple[int, int],
+                        quality: int) -> List[Tuple[int, int, Tuple[int, int]]]:
+        """Returns the buffer size, JPEG quality and resize parameter of
+        each one of the live preview renditions
+        :param resolution: the camera resolution, used by the renditions
+        that are not resized
+        :param quality: the JPEG quality of the renditions that do not
+        define their own
+        """
+        sizes = list()
+        for _, resize, rendition_quality in settings.CAMERA_PREVIEW_RENDITIONS:
+            rendition_quality = rendition_quality or quality
+            sizes.append((cls.buffer_size(resize or resolution, rendition_quality),
+                          rendition_quality,
+                          resize))
+        return sizes
+
+    @classmethod
+    def init_buffers(cls, resolution: Tuple[int, int]=None,
+                     quality: int=None):
+        """Allocates the live feeds of every rendition, with buffers sized
+        for the given resolution and quality, by default the ones in the
+        settings
+        """
+        sizes = cls.rendition_sizes(resolution or settings.CAMERA_RESOLUTION,
+                                    quality or settings.CAMERA_PREVIEW_QUALITY)
+        cls.CAMERA_LIVE_FEEDS = [LiveFeed.allocate(size, cls.FEED_BUFFER_COUNT,
+                                                   rendition_quality, resize)
+                                 for size, rendition_quality, resize in sizes]
+        if settings.CAMERA_LIVE_STREAM and cls.CAMERA_LIVE_STREAM is None:
+            cls.CAMERA_LIVE_STREAM = StreamBuffer.allocate(settings.CAMERA_LIVE_STREAM_BUFFER_SIZE)
+
+    @classmethod
+    def grow_buffers(cls, resolution: Tuple[int, int], quality: int) -> bool:
+        """Reallocates the live feed buffers if the current ones are too
+        small for the given resolution and quality. Buffers never shrink.
+        Note that a capture daemon that is already running keeps using the
+        buffers it was started with, so it has to be restarted to benefit
+        from the new ones
+        :return True if the buffers were reallocated
+        """
+        if cls.CAMERA_LIVE_FEEDS is not None and \
+                all(size <= live_feed.buffer_size
+                    for (size, _, _), live_feed in zip(cls.rendition_sizes(resolution, quality),
+                                                       cls.CAMERA_LIVE_FEEDS)):
+            return False
+        cls.init_buffers(resolution, quality)
+        return True
+
+    @classmethod
+    def feed_memory_footprint(cls) -> Tuple[int, int]:
+        """Returns the memory taken by the live feed buffers and the upper
+        bound that it can ever reach, both in bytes
+        """
+        used = sum(live_feed.memory for live_feed in cls.CAMERA_LIVE_FEEDS or ())
+        upper_bound = len(settings.CAMERA_PREVIEW_RENDITIONS) * \
+            cls.FEED_BUFFER_COUNT * cls.max_buffer_size()
+        return used, upper_bound
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Returns a dictionary with the current figures of the live feed
+        """
+        used, upper_bound = cls.feed_memory_footprint()
+        with cls.CAMERA_FLASH_STATS.get_lock():
+            flash = cls.CAMERA_FLASH_STATS.get_obj().as_dict()
+        renditions = dict()
+        for (name, _, _), live_feed in zip(settings.CAMERA_PREVIEW_RENDITIONS,
+                                           cls.CAMERA_LIVE_FEEDS or ()):
+            renditions[name] = dict(buffer_size=live_feed.buffer_size,
+                                    overflows=live_feed.overflows)
+        return dict(feed_memory=used,
+                    feed_memory_bound=upper_bound,
+                    feed_overflows=sum(r['overflows'] for r in renditions.values()),
+                    renditions=renditions,
+                    scene=cls.CAMERA_SCENE_STATS.as_dict(),
+                    live_stream=dict(frames=cls.CAMERA_LIVE_STREAM.frames,
+                                     bytes=cls.CAMERA_LIVE_STREAM.write_position)
+                    if cls.CAMERA_LIVE_STREAM is not None else None,
+                    flash=flash,
+                    housekeeping=cls.CAMERA_HOUSEKEEPING_STATS.as_dict(),
+                    heartbeat=cls.CAMERA_HEARTBEAT.as_dict())
+
+    @classmethod
+    def health(cls) -> dict:
+        """Returns whether the capture loop is alive and how old the live
+        preview is. The live preview is stale when the loop stalled or the
+        frame of a rendition being watched is older than
+        settings.CAMERA_LIVE_STALE_AFTER seconds, and then it must not be
+        shown as live. The renditions nobody watches are refreshed less
+        often, so they only count, through their newest frame, when no
+        rendition is watched
+        """
+        ages = dict()
+        watched_ages = []
+        for (name, _, _), live_feed in zip(settings.CAMERA_PREVIEW_RENDITIONS,
+                                           cls.CAMERA_LIVE_FEEDS or ()):
+            ages[name] = live_feed.age
+            if live_feed.read_age < settings.CAMERA_PREVIEW_IDLE_AFTER:
+                watched_ages.append(live_feed.age)
+        known_ages = [age for age in ages.values() if age is not None]
+        if watched_ages:
+            frame_age = None if None in watched_ages else max(watched_ages)
+        else:
+            frame_age = min(known_ages) if known_ages else None
+        heartbeat = cls.CAMERA_HEARTBEAT.as_dict()
+        return dict(heartbeat=heartbeat,
+                    frame_age=frame_age,
+                    frame_ages=ages,
+                    stale=heartbeat['stalled'] or frame_age is None or
+                    frame_age > settings.CAMERA_LIVE_STALE_AFTER)
+
+    @classmethod
+    def spawn_daemon(cls):
+        """Starts a capture daemon over the shared buffers, figures and
+        queues already allocated, so that whoever reads them does not notice
+        """
+        cls.CAMERA_HEARTBEAT.reset(settings.CAMERA_WATCHDOG_TIMEOUT)
+        cls.CAMERA_DAEMON = Process(target=capture_loop,
+                                    args=(cls.CAMERA_CONTENT_MANAGER,
+                                          cls.CAMERA_STOP_DAEMON_QUEUE,
+                                          cls.CAMERA_SETTINGS_QUEUE,
+                                          cls.CAMERA_LIVE_FEEDS,
+                                          cls.CAMERA_SCENE_STATS,
+                                          cls.CAMERA_LIVE_STREAM,
+                                          cls.CAMERA_FLASH_STATS,
+                                          cls.CAMERA_HOUSEKEEPING_STATS,
+                                          cls.CAMERA_HEARTBEAT,
+                                          cls.CAMERA_START_TIME),
+                                    daemon=False)
+        cls.CAMERA_DAEMON.start()
 
     @classmethod
     def start_daemon(cls, content_folder):
@@ -354,17 +1843,46 @@ class Capture:
         """
         if cls.CAMERA_CONTENT_MANAGER is None:
             cls.init_buffers()
-            cls.CAMERA_CONTENT_MANAGER = FileManager(content_folder)
-            Process(target=capture_loop,
-                    args=(cls.CAMERA_CONTENT_MANAGER,
-                          cls.CAMERA_STOP_DAEMON_QUEUE,
-                          cls.CAMERA_SETTINGS_QUEUE,
-                          cls.CAMERA_CURRENT_FEED_LOCK,
-                          cls.CAMERA_CURRENT_FEED_USAGE,
-                          cls.CAMERA_CURRENT_FEED_BUFFER,
-                          cls.CAMERA_FEED_BUFFERS[0],
-                          cls.CAMERA_FEED_BUFFERS[1]),
-                    daemon=False).start()
+            # The capture daemon cleans up in the background
+            cls.CAMERA_CONTENT_MANAGER = FileManager(content_folder, cleanup=False)
+            cls.CAMERA_START_TIME = time()
+            cls.spawn_daemon()
+
+    @classmethod
+    def restart_daemon(cls, timeout: float=5):
+        """Replaces the capture daemon, which is killed if it is still
+        running, as when it is stuck in the camera. The new one gets the last
+        settings again and the same shared buffers, once the locks the old
+        one may have died holding are released. The flash figures get a new
+        lock, theirs can only be released by its owner. A recording that was
+        being made is lost, its leftovers are cleaned up at the next start of
+        the server, as the new daemon leaves alone the files of the
+        conversions still going on
+        :param timeout: the seconds the daemon has to stop before it is killed
+        """
+        daemon = cls.CAMERA_DAEMON
+        if daemon is not None and daemon.is_alive():
+            daemon.terminate()
+            daemon.join(timeout)
+            if daemon.is_alive():
+                os.kill(daemon.pid, signal.SIGKILL)
+                daemon.join()
+        for live_feed in cls.CAMERA_LIVE_FEEDS or ():
+            live_feed.recover()
+        cls.CAMERA_FLASH_STATS = synchronized(cls.CAMERA_FLASH_STATS.get_obj(), RLock())
+        if cls.CAMERA_SETTINGS is not None and cls.CAMERA_SETTINGS_QUEUE.empty():
+            cls.CAMERA_SETTINGS_QUEUE.put(cls.CAMERA_SETTINGS)
+        cls.CAMERA_HEARTBEAT.restarts += 1
+        cls.spawn_daemon()
+
+    @classmethod
+    def apply_settings(cls, camera_settings):
+        """Queues new settings for the capture daemon, which applies them
+        when it is not recording. They are kept for the daemons started after
+        a failure
+        """
+        cls.CAMERA_SETTINGS = camera_settings
+        cls.CAMERA_SETTINGS_QUEUE.put(camera_settings)
 
     @classmethod
     def stop_daemon(cls):
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import json
 import socket
 import sys
 import struct
@@ -7,32 +8,112 @@ import struct
 
 from django.conf import settings
 
+from camera.capture import Capture
 from camera.management.commands.camera_server import Command
 
 
 class CameraClient:
 
-    def __init__(self, command: str):
+    def __init__(self, command: str, timeout: float=None):
+        """Sends a command to the camera server
+        :param timeout: seconds to wait for the camera server on every
+        operation of the socket, by default settings.CAMERA_SERVER_TIMEOUT.
+        socket.timeout is raised when it does not answer in time
+        """
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout or settings.CAMERA_SERVER_TIMEOUT)
         self._socket.connect(('localhost', settings.CAMERA_SERVER_PORT))
         self._socket.sendall(command)
 
+    def read_block(self) -> bytearray:
+        """Reads a block of data preceded by its length as sent by the
+        camera server
+        :return the block read or None if there is none
+        """
+        buffer_length_buff = self._socket.recv(4)
+        if buffer_length_buff and len(buffer_length_buff) < 4:
+            # Long lived streams may split the length too
+            buffer_length_buff += self._socket.recv(4 - len(buffer_length_buff), socket.MSG_WAITALL)
+        if not buffer_length_buff or len(buffer_length_buff) != 4:
+            return None
+        buffer_length = struct.unpack('I', buffer_length_buff[:4])[0]
+        if not buffer_length:
+            return None
+        block = bytearray(buffer_length)
+        total_read = 0
+        remaining = buffer_length
+        while remaining:
+            b = memoryview(block)
+            received = self._socket.recv_into(b[total_read:], remaining)
+            if not received:
+                return None     # Connection closed halfway
+            total_read += received
+            remaining -= received
+        return block
+
 
 class FeedCommand(CameraClient):
 
+    def __init__(self, rendition: str=None, sequence: int=None):
+        """Retrieves the latest live preview frame
+        :param rendition: the name of the preview rendition wanted, the
+        default rendition if None
+        :param sequence: the sequence number of the frame already known, if
+        it is still the latest one the frame is not sent and the response
+        is None. The age of the frame, in seconds, is told either way
+        """
+        rendition_index = Capture.rendition_index(rendition)
+        if rendition_index is None:
+            raise ValueError('Unknown live preview rendition {}'.format(rendition))
+        super().__init__(Command.SERVER_LIVE_FEED + bytes((rendition_index,)) +
+                         struct.pack('I', sequence or 0))
+        self.sequence = None
+        self.age = None
+        header_buff = self._socket.recv(8)
+        if header_buff and len(header_buff) == 8:
+            self.sequence, age = struct.unpack('II', header_buff)
+            self.age = age / 1000
+        self.response = self.read_block()
+
+
+class PingCommand(CameraClient):
+
     def __init__(self):
-        super().__init__(Command.SERVER_LIVE_FEED)
-        self.response = None
-        buffer_length_buff = self._socket.recv(4)
-        if not buffer_length_buff or len(buffer_length_buff) != 4:
-            return
-        buffer_length = struct.unpack('I', buffer_length_buff[:4])[0]
-        if buffer_length:
-            self.response = bytearray(buffer_length)
-            total_read = 0
-            remaining = buffer_length
-            while remaining:
-                b = memoryview(self.response)
-                received = self._socket.recv_into(b[total_read:], remaining)
-                total_read += received
-                remaining -= received
+        """Tells whether the capture loop is alive and how old the live
+        preview is, see Capture.health
+        """
+        super().__init__(Command.SERVER_PING)
+        block = self.read_block()
+        self.response = json.loads(block.decode('utf-8')) if block else None
+
+
+class StatsCommand(CameraClient):
+
+    def __init__(self):
+        super().__init__(Command.SERVER_STATS)
+        block = self.read_block()
+        self.response = json.loads(block.decode('utf-8')) if block else None
+
+
+class StreamCommand(CameraClient):
+
+    def __init__(self):
+        """Receives the live H.264 stream as fragmented MP4
+        """
+        super().__init__(Command.SERVER_LIVE_STREAM)
+
+    def segments(self):
+        """Yields the segments of the stream as they arrive, until the
+        stream ends, stalls or the generator is closed
+        """
+        try:
+            while True:
+                try:
+                    block = self.read_block()
+                except socket.timeout:
+                    return
+                if block is None:
+                    return
+                yield bytes(block)
+        finally:
+            self._socket.close()
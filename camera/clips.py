@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+
+from bisect import bisect_left, bisect_right
+from typing import Iterator, List, Tuple
+
+
+class KeyframeIndex:
+    """Times of the key frames of a video, kept in a file next to it. A clip
+    that starts and ends at key frames can be cut by copying whole groups of
+    pictures, without decoding or encoding anything
+    """
+
+    SUFFIX = '.keyframes'
+
+    def __init__(self, video_path: str):
+        self._video_path = video_path
+        self._index_path = video_path + self.SUFFIX
+
+    def build(self) -> List[float]:
+        """Finds the key frames of the video with ffprobe, which only has to
+        read the packet headers, and saves their times
+        :return the times in seconds of the key frames
+        """
+        process = subprocess.run(('ffprobe',
+                                  '-v', 'error',
+                                  '-select_streams', 'v:0',
+                                  '-show_entries', 'packet=pts_time,flags',
+                                  '-of', 'csv=p=0',
+                                  self._video_path),
+                                 stdout=subprocess.PIPE)
+        keyframes = []
+        for line in (process.stdout or b'').decode('ascii', 'ignore').splitlines():
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags:
+                try:
+                    keyframes.append(float(pts_time))
+                except ValueError:
+                    pass
+        keyframes.sort()
+        if keyframes:
+            temp_path = '{}.{}'.format(self._index_path, os.getpid())
+            with open(temp_path, 'w') as f:
+                f.write('\n'.join('{:.6f}'.format(keyframe) for keyframe in keyframes))
+            os.replace(temp_path, self._index_path)
+        return keyframes
+
+    def keyframes(self) -> List[float]:
+        """Returns the times in seconds of the key frames, building the index
+        if the video does not have one yet
+        """
+        try:
+            with open(self._index_path) as f:
+                return [float(line) for line in f if line.strip()]
+        except (IOError, ValueError):
+            return self.build()
+
+    def gop_bounds(self, start: float, end: float=None) -> Tuple[float, float]:
+        """Returns the key frames around an interval of the video, so that
+        the clip between them holds the whole interval
+        :param start: the start of the interval in seconds
+        :param end: the end of the interval in seconds, or None for the end
+        of the video
+        :return the start of the clip and its end, None for the end of the
+        video
+        """
+        keyframes = self.keyframes()
+        clip_start = keyframes[max(bisect_right(keyframes, start) - 1, 0)] if keyframes else 0
+        clip_end = None
+        if end is not None:
+            end_index = bisect_left(keyframes, end)
+            if end_index < len(keyframes):
+                clip_end = keyframes[end_index]
+        return clip_start, clip_end
+
+
+def clip_stream(video_path: str, start: float, duration: float=None,
+                chunk_size: int=64 * 1024) -> Iterator[bytes]:
+    """Yields a clip of a video, copying its frames into a fragmented MP4
+    that can be sent while it is written. The clip should start at a key
+    frame, see KeyframeIndex.gop_bounds
+    :param video_path: the video the clip is cut from
+    :param start: the start of the clip in seconds
+    :param duration: the duration of the clip in seconds, or None to go to
+    the end of the video
+    :param chunk_size: the size of the chunks yielded
+    """
+    args = ('ffmpeg', '-loglevel', 'error', '-ss', '{:.6f}'.format(start), '-i', video_path)
+    if duration is not None:
+        args += ('-t', '{:.6f}'.format(duration))
+    args += ('-c', 'copy', '-an', '-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4', 'pipe:1')
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_size), b''):
+            yield chunk
+    finally:
+        # The client may have gone away before the end of the clip
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
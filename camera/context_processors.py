@@ -0,0 +1,7 @@
+from django.conf import settings
+
+
+def aggregator(request):
+    """Tells the templates whether this server aggregates other ones
+    """
+    return dict(aggregator=bool(settings.CAMERA_AGGREGATOR_NODES))
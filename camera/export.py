@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import tarfile
+
+from collections import namedtuple
+from datetime import datetime
+from os.path import basename
+from time import monotonic, sleep
+from typing import Iterator, List
+
+from camera.capture import FileManager, Video
+
+
+# A file in the archive, whose data are the size bytes of the file in path
+# starting at offset
+ArchiveMember = namedtuple('ArchiveMember', ('name', 'mtime', 'size', 'path', 'offset'))
+
+
+def export_members(file_manager: FileManager, start: datetime, end: datetime) -> List[ArchiveMember]:
+    """Returns the videos recorded in a time interval, oldest first, each
+    followed by its thumbnail, whether it has its own file or is packed
+    :param start: the beginning of the interval
+    :param end: the end of the interval, not included
+    """
+    members = []
+    for _, videos in reversed(file_manager.list_videos()):
+        for video in reversed(videos):
+            if not start <= video.timestamp < end:
+                continue
+            video_path = file_manager.complete_path(video.file)
+            try:
+                stat = os.stat(video_path)
+            except IOError:
+                continue
+            members.append(ArchiveMember(video.file, int(stat.st_mtime), stat.st_size, video_path, 0))
+            thumbnail_path = file_manager.complete_path(video.thumbnail)
+            try:
+                stat = os.stat(thumbnail_path)
+                members.append(ArchiveMember(video.thumbnail, int(stat.st_mtime), stat.st_size,
+                                             thumbnail_path, 0))
+                continue
+            except IOError:
+                pass
+            key = Video.NAME_RE.match(basename(video.file)).group(1)
+            pack = file_manager.thumbnail_pack(key)
+            entry = pack.find(key)
+            if entry is not None:
+                members.append(ArchiveMember(video.thumbnail, int(video.timestamp.timestamp()), entry[2],
+                                             pack.pack_path, entry[1]))
+    return members
+
+
+class TarExport:
+    """Tar archive generated while it is sent, without temporary files. The
+    size of every member is known beforehand, so is the size of the archive
+    and the position of every byte in it, which lets any part of it be
+    generated on its own for clients resuming a download
+    """
+
+    def __init__(self, members: List[ArchiveMember]):
+        # The archive is a list of parts, either bytes or the data of a
+        # member
+        self._parts = []
+        for member in members:
+            info = tarfile.TarInfo(member.name)
+            info.size = member.size
+            info.mtime = member.mtime
+            info.mode = 0o644
+            self._parts.append(info.tobuf(format=tarfile.USTAR_FORMAT))
+            self._parts.append(member)
+            if member.size % tarfile.BLOCKSIZE:
+                self._parts.append(bytes(tarfile.BLOCKSIZE - member.size % tarfile.BLOCKSIZE))
+        self._parts.append(bytes(2 * tarfile.BLOCKSIZE))
+        self._members = members
+
+    @staticmethod
+    def part_size(part) -> int:
+        return part.size if isinstance(part, ArchiveMember) else len(part)
+
+    @property
+    def size(self) -> int:
+        return sum(self.part_size(part) for part in self._parts)
+
+    def etag(self) -> str:
+        """Returns an ETag that changes whenever the content of the archive
+        does, so that a download is only resumed from the same archive
+        """
+        digest = hashlib.sha1()
+        for member in self._members:
+            digest.update('{}:{}:{}\n'.format(member.name, member.mtime, member.size).encode())
+        return '"{}"'.format(digest.hexdigest())
+
+    @staticmethod
+    def read_member(member: ArchiveMember, offset: int, length: int,
+                    chunk_size: int) -> Iterator[bytes]:
+        """Yields part of the data of a member. Files that shrank or were
+        removed meanwhile, e.g. by the storage policy, are completed with
+        zeros so that the rest of the archive is still where it should be
+        """
+        try:
+            with open(member.path, 'rb') as f:
+                f.seek(member.offset + offset)
+                while length > 0:
+                    chunk = f.read(min(chunk_size, length))
+                    if not chunk:
+                        break
+                    length -= len(chunk)
+                    yield chunk
+        except IOError:
+            pass
+        while length > 0:
+            yield bytes(min(chunk_size, length))
+            length -= chunk_size
+
+    def stream(self, first: int=0, last: int=None, chunk_size: int=64 * 1024,
+               rate: int=None) -> Iterator[bytes]:
+        """Yields the archive, or part of it
+        :param first: the position of the first byte yielded
+        :param last: the position of the last byte yielded, by default the
+        last byte of the archive
+        :param chunk_size: the maximum size of the chunks yielded
+        :param rate: the maximum number of bytes per second, so that the
+        export leaves the storage to recording most of the time
+        """
+        if last is None:
+            last = self.size - 1
+        started = monotonic()
+        sent = 0
+        position = 0
+        for part in self._parts:
+            part_size = self.part_size(part)
+            part_first = max(first - position, 0)
+            part_end = min(last + 1 - position, part_size)
+            position += part_size
+            if part_first >= part_end:
+                if position > last:
+                    break
+                continue
+            if isinstance(part, ArchiveMember):
+                chunks = self.read_member(part, part_first, part_end - part_first, chunk_size)
+            else:
+                chunks = (part[part_first:part_end],)
+            for chunk in chunks:
+                yield chunk
+                sent += len(chunk)
+                if rate:
+                    delay = sent / rate - (monotonic() - started)
+                    if delay > 0:
+                        sleep(delay)
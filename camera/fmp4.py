@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+from collections import namedtuple
+from typing import List, Tuple
+
+# Types of the H.264 NAL units that matter here
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+START_CODE = b'\x00\x00\x00\x01'
+# Time units per second of the timestamps, the usual one for video
+TIMESCALE = 90000
+# Profiles whose SPS has the chroma format, bit depths and scaling lists
+HIGH_PROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+
+
+def nal_type(nal_unit: bytes) -> int:
+    return nal_unit[0] & 0x1f
+
+
+def split_nal_units(stream: bytes) -> List[bytes]:
+    """Splits an H.264 Annex B byte stream in its NAL units, without the
+    start codes
+    """
+    nal_units = []
+    start = stream.find(b'\x00\x00\x01')
+    while start >= 0:
+        end = stream.find(b'\x00\x00\x01', start + 3)
+        nal_unit = stream[start + 3:end if end >= 0 else len(stream)].rstrip(b'\x00')
+        if nal_unit:
+            nal_units.append(nal_unit)
+        start = end
+    return nal_units
+
+
+class AccessUnitSplitter:
+    """Groups the H.264 Annex B byte stream written by the encoder, in
+    chunks of any size, in access units, that is the NAL units of one frame.
+    A unit is complete as soon as the header of the first NAL unit of the
+    next one arrives
+    """
+
+    def __init__(self):
+        self._pending = bytearray()
+        self._scan = 0
+        self._nal_start = None
+        self._unit = []
+        self._unit_timestamp = None
+        self._has_slice = False
+        self._keyframe = False
+
+    def feed(self, data: bytes, timestamp: int) -> List[Tuple[bytes, int, int, bool]]:
+        """Adds the next chunk of the stream
+        :param timestamp: the time the chunk was written, in TIMESCALE units
+        :return the access units completed, each one as its Annex B bytes,
+        its timestamp, its duration and whether it is a key frame
+        """
+        units = []
+        self._pending += data
+        while True:
+            index = self._pending.find(b'\x00\x00\x01', self._scan)
+            if index < 0:
+                # The end of the chunk could be the beginning of a start code
+                self._scan = max(len(self._pending) - 2, self._nal_start or 0)
+                break
+            if index + 5 > len(self._pending):
+                # Wait for the header of the NAL unit to tell its frame
+                self._scan = index
+                break
+            if self._nal_start is not None:
+                nal_unit = bytes(self._pending[self._nal_start:index]).rstrip(b'\x00')
+                if nal_unit:
+                    self._unit.append(nal_unit)
+            units.extend(self._start_nal_unit(self._pending[index + 3:index + 5], timestamp))
+            self._nal_start = self._scan = index + 3
+        # Keep only the NAL unit in progress
+        drop = self._scan if self._nal_start is None else self._nal_start
+        del self._pending[:drop]
+        self._scan -= drop
+        if self._nal_start is not None:
+            self._nal_start -= drop
+        return units
+
+    def _start_nal_unit(self, header: bytes, timestamp: int) -> List[Tuple[bytes, int, int, bool]]:
+        kind = header[0] & 0x1f
+        units = []
+        # A new frame starts with any of these after a slice, or with a
+        # slice whose first macroblock is 0, whose header starts with a 1 bit
+        if self._has_slice and (kind in (NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD) or
+                                (kind in (NAL_SLICE, NAL_IDR_SLICE) and header[1] & 0x80)):
+            units.append((b''.join(START_CODE + n for n in self._unit), self._unit_timestamp,
+                          max(timestamp - self._unit_timestamp, 1), self._keyframe))
+            self._unit = []
+            self._unit_timestamp = None
+            self._has_slice = self._keyframe = False
+        if self._unit_timestamp is None:
+            self._unit_timestamp = timestamp
+        if kind in (NAL_SLICE, NAL_IDR_SLICE):
+            self._has_slice = True
+            self._keyframe = self._keyframe or kind == NAL_IDR_SLICE
+        return units
+
+
+class BitReader:
+    """Reads the bits, and Exp-Golomb codes, of an H.264 RBSP
+    """
+
+    def __init__(self, data: bytes):
+        self._value = int.from_bytes(data, 'big')
+        self._length = len(data) * 8
+        self._position = 0
+
+    def bits(self, count: int) -> int:
+        if self._position + count > self._length:
+            raise ValueError('Read past the end of the data')
+        self._position += count
+        return (self._value >> (self._length - self._position)) & ((1 << count) - 1)
+
+    def ue(self) -> int:
+        zeros = 0
+        while not self.bits(1):
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value % 2 else -(value // 2)
+
+
+SPSInfo = namedtuple('SPSInfo', ('profile', 'width', 'height', 'chroma_format',
+                                 'bit_depth_luma', 'bit_depth_chroma'))
+
+
+def parse_sps(sps: bytes) -> SPSInfo:
+    """Reads the frame size and format from an SPS NAL unit
+    """
+    rbsp = bytes(sps[1:]).replace(b'\x00\x00\x03', b'\x00\x00')
+    reader = BitReader(rbsp)
+    profile = reader.bits(8)
+    reader.bits(16)     # Constraint flags and level
+    reader.ue()         # SPS id
+    chroma_format, bit_depth_luma, bit_depth_chroma = 1, 8, 8
+    if profile in HIGH_PROFILES:
+        chroma_format = reader.ue()
+        if chroma_format == 3:
+            reader.bits(1)
+        bit_depth_luma = reader.ue() + 8
+        bit_depth_chroma = reader.ue() + 8
+        reader.bits(1)
+        if reader.bits(1):     # Scaling matrix, skipped
+            for i in range(12 if chroma_format == 3 else 8):
+                if reader.bits(1):
+                    last = following = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if following:
+                            following = (last + reader.se() + 256) % 256
+                        last = following or last
+    reader.ue()         # log2_max_frame_num_minus4
+    poc_type = reader.ue()
+    if poc_type == 0:
+        reader.ue()
+    elif poc_type == 1:
+        reader.bits(1)
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()         # Reference frames
+    reader.bits(1)
+    width = (reader.ue() + 1) * 16
+    height_map_units = reader.ue() + 1
+    frame_mbs_only = reader.bits(1)
+    height = height_map_units * 16 * (2 - frame_mbs_only)
+    if not frame_mbs_only:
+        reader.bits(1)
+    reader.bits(1)
+    if reader.bits(1):      # Cropping, in chroma samples
+        left, right, top, bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+        crop_x = 1 if chroma_format in (0, 3) else 2
+        crop_y = (1 if chroma_format in (0, 2, 3) else 2) * (2 - frame_mbs_only)
+        width -= crop_x * (left + right)
+        height -= crop_y * (top + bottom)
+    return SPSInfo(profile, width, height, chroma_format, bit_depth_luma, bit_depth_chroma)
+
+
+def box(kind: bytes, *payloads: bytes) -> bytes:
+    payload = b''.join(payloads)
+    return struct.pack('>I', 8 + len(payload)) + kind + payload
+
+
+def full_box(kind: bytes, version: int, flags: int, *payloads: bytes) -> bytes:
+    return box(kind, struct.pack('>I', version << 24 | flags), *payloads)
+
+
+# Unity transformation matrix of the movie and track headers
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def init_segment(sps: bytes, pps: bytes) -> bytes:
+    """Returns the initialization segment, ftyp and moov boxes, of a
+    fragmented MP4 with one H.264 video track
+    """
+    info = parse_sps(sps)
+    avcc = bytes((1, sps[1], sps[2], sps[3], 0xff, 0xe1)) + struct.pack('>H', len(sps)) + sps + \
+        b'\x01' + struct.pack('>H', len(pps)) + pps
+    if info.profile in HIGH_PROFILES:
+        avcc += bytes((0xfc | info.chroma_format, 0xf8 | info.bit_depth_luma - 8,
+                       0xf8 | info.bit_depth_chroma - 8, 0))
+    avc1 = box(b'avc1',
+               bytes(6), struct.pack('>H', 1),      # Data reference index
+               bytes(16), struct.pack('>HHII', info.width, info.height, 0x480000, 0x480000),
+               bytes(4), struct.pack('>H', 1), bytes(32), struct.pack('>Hh', 0x18, -1),
+               box(b'avcC', avcc))
+    stbl = box(b'stbl',
+               full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+               full_box(b'stts', 0, 0, bytes(4)),
+               full_box(b'stsc', 0, 0, bytes(4)),
+               full_box(b'stsz', 0, 0, bytes(8)),
+               full_box(b'stco', 0, 0, bytes(4)))
+    minf = box(b'minf',
+               full_box(b'vmhd', 0, 1, bytes(8)),
+               box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1))),
+               stbl)
+    mdia = box(b'mdia',
+               full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, TIMESCALE, 0, 0x55c4, 0)),
+               full_box(b'hdlr', 0, 0, bytes(4), b'vide', bytes(12), b'VideoHandler\x00'),
+               minf)
+    trak = box(b'trak',
+               full_box(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, 1, 0, 0), bytes(8),
+                        struct.pack('>hhhH', 0, 0, 0, 0), MATRIX,
+                        struct.pack('>II', info.width << 16, info.height << 16)),
+               mdia)
+    moov = box(b'moov',
+               full_box(b'mvhd', 0, 0, struct.pack('>IIIIIH', 0, 0, TIMESCALE, 0, 0x10000, 0x100),
+                        bytes(10), MATRIX, bytes(24), struct.pack('>I', 2)),
+               trak,
+               box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, 0, 0, 0))))
+    return box(b'ftyp', b'iso5', struct.pack('>I', 512), b'iso5iso6mp41') + moov
+
+
+def media_segment(sequence: int, decode_time: int, duration: int,
+                  nal_units: List[bytes], keyframe: bool) -> bytes:
+    """Returns a fragment, moof and mdat boxes, with one frame
+    :param sequence: the sequence number of the fragment, from 1
+    :param decode_time: the time of the frame since the beginning of the
+    stream, in TIMESCALE units
+    :param nal_units: the NAL units of the frame
+    """
+    sample = b''.join(struct.pack('>I', len(n)) + n for n in nal_units)
+    # Key frames do not depend on other frames, the rest are not sync samples
+    sample_flags = 0x02000000 if keyframe else 0x01010000
+
+    def moof(data_offset: int) -> bytes:
+        return box(b'moof',
+                   full_box(b'mfhd', 0, 0, struct.pack('>I', sequence)),
+                   box(b'traf',
+                       full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1)),
+                       full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time)),
+                       full_box(b'trun', 0, 0x701,
+                                struct.pack('>IiIII', 1, data_offset, duration, len(sample), sample_flags))))
+
+    header = moof(0)
+    return moof(len(header) + 8) + box(b'mdat', sample)
+
+
+class FragmentedMP4Muxer:
+    """Packages H.264 access units as a fragmented MP4 stream, one fragment
+    per frame, that can be played as it arrives by a Media Source Extensions
+    player. The stream starts at the first key frame with its SPS and PPS,
+    and a new initialization segment is sent whenever they change
+    """
+
+    def __init__(self):
+        self._sps = None
+        self._pps = None
+        self._sequence = 0
+        self._start = None
+
+    def mux(self, access_unit: bytes, timestamp: int, duration: int, keyframe: bool) -> bytes:
+        """Returns the segments for an access unit, empty if the stream has
+        not started yet
+        :param access_unit: the Annex B bytes of the frame
+        :param timestamp: the time of the frame, in TIMESCALE units
+        :param duration: the duration of the frame, in TIMESCALE units
+        """
+        nal_units = split_nal_units(access_unit)
+        segments = b''
+        if keyframe:
+            sps = next((n for n in nal_units if nal_type(n) == NAL_SPS), None)
+            pps = next((n for n in nal_units if nal_type(n) == NAL_PPS), None)
+            if sps is not None and pps is not None and (sps, pps) != (self._sps, self._pps):
+                self._sps, self._pps = sps, pps
+                segments = init_segment(sps, pps)
+        if self._sps is None:
+            return b''
+        if self._start is None:
+            self._start = timestamp
+        self._sequence += 1
+        samples = [n for n in nal_units if nal_type(n) not in (NAL_SPS, NAL_PPS, NAL_AUD)]
+        return segments + media_segment(self._sequence, timestamp - self._start, duration, samples, keyframe)
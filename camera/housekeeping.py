@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import itertools
+import os
+import traceback
+
+from contextlib import contextmanager
+from multiprocessing import RawValue
+from queue import PriorityQueue
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Callable
+
+from django.conf import settings
+
+
+class HousekeepingStats(ctypes.Structure):
+    """Shared figures of the housekeeping of the capture daemon, and of the
+    time from a sensor edge to the start of its recording, which is what
+    housekeeping must not delay. Times are in seconds
+    """
+    _fields_ = (('tasks', ctypes.c_uint),
+                ('backlog', ctypes.c_uint),
+                ('busy_seconds', ctypes.c_double),
+                ('rest_seconds', ctypes.c_double),
+                ('recordings', ctypes.c_uint),
+                ('edge_latency', ctypes.c_double),
+                ('max_edge_latency', ctypes.c_double),
+                ('total_edge_latency', ctypes.c_double))
+
+    def add_edge_latency(self, seconds: float):
+        self.recordings += 1
+        self.edge_latency = seconds
+        self.max_edge_latency = max(self.max_edge_latency, seconds)
+        self.total_edge_latency += seconds
+
+    def as_dict(self) -> dict:
+        figures = {name: getattr(self, name) for name, _ in self._fields_}
+        figures['mean_edge_latency'] = self.total_edge_latency / self.recordings if self.recordings else None
+        return figures
+
+
+class Housekeeper:
+    """Runs the file system maintenance of the capture daemon, such as the
+    storage policy or moving thumbnails, in a thread of its own so that the
+    capture loop never waits for it. Tasks run one at a time by priority,
+    at a lower CPU priority than the capture loop, and keep within an I/O
+    budget by resting between file operations, see pace. They wait while
+    a recording is starting, see paused
+    """
+    # Task priorities, lower run first
+    URGENT = 0
+    NORMAL = 1
+    BACKGROUND = 2
+    # Seconds a task works before resting
+    SLICE = 0.05
+
+    def __init__(self, budget: float=None, niceness: int=None, stats: RawValue=None):
+        """
+        :param budget: the fraction of the time that tasks may work, by
+        default settings.CAMERA_HOUSEKEEPING_BUDGET
+        :param niceness: how much lower than the capture loop the priority of
+        the tasks is, by default settings.CAMERA_HOUSEKEEPING_NICENESS
+        :param stats: the shared HousekeepingStats to update
+        """
+        self._budget = budget or settings.CAMERA_HOUSEKEEPING_BUDGET
+        self._niceness = niceness if niceness is not None else settings.CAMERA_HOUSEKEEPING_NICENESS
+        self._stats = stats if stats is not None else RawValue(HousekeepingStats)
+        self._queue = PriorityQueue()
+        self._sequence = itertools.count()
+        self._pending = set()
+        self._lock = Lock()
+        self._running = Event()
+        self._running.set()
+        self._slice_start = None
+        self._thread = None
+
+    @property
+    def stats(self) -> HousekeepingStats:
+        return self._stats
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='housekeeping', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Runs the tasks already scheduled and stops
+        """
+        if self._thread is not None:
+            self._queue.put((self.BACKGROUND + 1, next(self._sequence), None, None, ()))
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # Whatever is pending, such as thumbnails, is done before leaving
+        self.stop()
+
+    def schedule(self, function: Callable, *args, priority: int=NORMAL, key: str=None) -> bool:
+        """Schedules a task, which runs straight away if the housekeeper is
+        not started
+        :param key: identifies the task, it is not scheduled again while it
+        is waiting to run
+        :return whether the task was scheduled
+        """
+        if self._thread is None:
+            function(*args)
+            return True
+        with self._lock:
+            if key is not None:
+                if key in self._pending:
+                    return False
+                self._pending.add(key)
+            self._stats.backlog += 1
+        self._queue.put((priority, next(self._sequence), key, function, args))
+        return True
+
+    @contextmanager
+    def paused(self):
+        """Holds the tasks at their next call to pace while the block runs
+        """
+        self._running.clear()
+        try:
+            yield
+        finally:
+            self._running.set()
+
+    def pace(self):
+        """Called by the tasks between file operations, it waits while the
+        housekeeper is paused and rests once a task worked for a slice, long
+        enough to keep within the budget
+        """
+        self._running.wait()
+        if self._slice_start is None:
+            return
+        worked = monotonic() - self._slice_start
+        if worked >= self.SLICE:
+            rest = worked * (1 - self._budget) / self._budget
+            sleep(rest)
+            self._stats.rest_seconds += rest
+            self._slice_start = monotonic()
+
+    def _run(self):
+        if self._niceness:
+            # On Linux it only lowers the priority of this thread
+            os.nice(self._niceness)
+        while True:
+            _, _, key, function, args = self._queue.get()
+            if function is None:
+                break
+            with self._lock:
+                self._pending.discard(key)
+                self._stats.backlog -= 1
+            self._running.wait()
+            start = self._slice_start = monotonic()
+            rest = self._stats.rest_seconds
+            try:
+                function(*args)
+            except Exception:
+                # A failing task must not stop the ones after it
+                traceback.print_exc()
+            self._stats.tasks += 1
+            self._stats.busy_seconds += monotonic() - start - (self._stats.rest_seconds - rest)
+            self.pace()
+            self._slice_start = None
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import struct
+
+from http.cookies import SimpleCookie
+from importlib import import_module
+from typing import Dict, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.http import HttpRequest
+
+from camera.capture import Capture
+from camera.management.commands.camera_server import Command
+
+
+async def fetch_frame(rendition_index: int, known_sequence: int=None) -> Tuple[int, float, bytes]:
+    """Asks the camera server for the latest live preview frame without
+    blocking, the same as camera.client.FeedCommand
+    :param known_sequence: the sequence number of the frame already known,
+    if it is still the latest one the frame is not sent
+    :return the sequence number and age in seconds of the latest frame and
+    the frame, None if there is none or it is the one already known
+    """
+    reader, writer = await asyncio.open_connection('localhost', settings.CAMERA_SERVER_PORT)
+    try:
+        writer.write(Command.SERVER_LIVE_FEED + bytes((rendition_index,)) +
+                     struct.pack('I', known_sequence or 0))
+        sequence, age, length = struct.unpack('III', await reader.readexactly(12))
+        return sequence, age / 1000, (await reader.readexactly(length) if length else None)
+    finally:
+        writer.close()
+
+
+class FrameSlot:
+    """Holds the newest frame not sent yet to a viewer. A frame that arrives
+    before the previous one is sent replaces it, so a slow viewer skips
+    frames instead of queuing them
+    """
+
+    def __init__(self):
+        self._frame = None
+        self._ready = asyncio.Event()
+        self.skipped = 0
+
+    def put(self, frame: bytes):
+        if self._frame is not None:
+            self.skipped += 1
+        self._frame = frame
+        self._ready.set()
+
+    async def get(self) -> bytes:
+        """Waits for a frame and takes it
+        """
+        await self._ready.wait()
+        self._ready.clear()
+        frame, self._frame = self._frame, None
+        return frame
+
+
+class FrameBroadcaster:
+    """Asks the camera server for the frames of a rendition on behalf of all
+    its viewers, so that the camera server is asked as often with one viewer
+    as with dozens. It only runs while there are viewers
+    """
+
+    def __init__(self, rendition_index: int, interval: float=None):
+        """
+        :param interval: seconds between requests to the camera server, by
+        default settings.CAMERA_LIVE_FEED_INTERVAL
+        """
+        self._rendition_index = rendition_index
+        self._interval = interval or settings.CAMERA_LIVE_FEED_INTERVAL
+        self._slots = set()     # type: Set[FrameSlot]
+        self._task = None
+        self._latest = None
+
+    @property
+    def viewers(self) -> int:
+        return len(self._slots)
+
+    def subscribe(self) -> FrameSlot:
+        """Adds a viewer, which gets the latest frame straight away if there
+        is one
+        """
+        slot = FrameSlot()
+        if self._latest is not None:
+            slot.put(self._latest)
+        self._slots.add(slot)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._poll())
+        return slot
+
+    def unsubscribe(self, slot: FrameSlot):
+        self._slots.discard(slot)
+        if not self._slots and self._task is not None:
+            self._task.cancel()
+
+    async def _poll(self):
+        sequence = None
+        try:
+            while self._slots:
+                try:
+                    latest_sequence, _, frame = await fetch_frame(self._rendition_index, sequence)
+                except (OSError, EOFError):
+                    # The camera server is not up, try again later
+                    frame = None
+                if frame is not None:
+                    sequence = latest_sequence
+                    self._latest = frame
+                    for slot in self._slots:
+                        slot.put(frame)
+                await asyncio.sleep(self._interval)
+        finally:
+            # Frames get old while nobody is watching
+            self._latest = None
+
+
+class LivePreviewApplication:
+    """ASGI application serving the live preview, to run next to the WSGI
+    one, see tusacam/asgi.py. Waiting on the camera server does not take a
+    worker, so one process serves many viewers. It answers:
+
+    - <prefix>/still_frame, the same as camera.views.still_frame
+    - <prefix>/stream, the same as camera.views.live_stream
+    - <prefix>/feed, a WebSocket that pushes the frames of the rendition
+      given by the size parameter as binary messages while they change
+
+    Both need the session of a logged in user
+    """
+
+    def __init__(self):
+        self._broadcasters = dict()     # type: Dict[int, FrameBroadcaster]
+
+    async def __call__(self, scope: dict, receive, send):
+        handler = {'http': self.http, 'websocket': self.websocket, 'lifespan': self.lifespan}.get(scope['type'])
+        if handler is not None:
+            await handler(scope, receive, send)
+
+    def broadcaster(self, rendition_index: int) -> FrameBroadcaster:
+        if rendition_index not in self._broadcasters:
+            self._broadcasters[rendition_index] = FrameBroadcaster(rendition_index)
+        return self._broadcasters[rendition_index]
+
+    @staticmethod
+    def headers(scope: dict) -> Dict[str, str]:
+        return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+    @staticmethod
+    def parameter(scope: dict, name: str) -> str:
+        values = parse_qs(scope.get('query_string', b'').decode('latin-1')).get(name)
+        return values[0] if values else None
+
+    @staticmethod
+    def session_user_authenticated(session_key: str) -> bool:
+        """Whether a session belongs to a logged in user, checked by Django
+        the same as for the WSGI application
+        """
+        request = HttpRequest()
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+        try:
+            return get_user(request).is_authenticated
+        finally:
+            close_old_connections()
+
+    async def authenticated(self, scope: dict) -> bool:
+        headers = self.headers(scope)
+        cookie = SimpleCookie(headers.get('cookie', '')).get(settings.SESSION_COOKIE_NAME)
+        if cookie is None:
+            return False
+        # Browsers send the cookies with WebSockets opened by other sites
+        origin = headers.get('origin')
+        if origin and urlsplit(origin).netloc != headers.get('host'):
+            return False
+        return await asyncio.get_event_loop().run_in_executor(None, self.session_user_authenticated,
+                                                              cookie.value)
+
+    async def lifespan(self, scope: dict, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def respond(send, status: int, body: bytes=b'', headers: dict=None):
+        headers = dict(headers or {}, **{'Content-Length': str(len(body))})
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def http(self, scope: dict, receive, send):
+        handler = None
+        if scope['method'] == 'GET':
+            handler = {'still_frame': self.still_frame,
+                       'stream': self.stream}.get(scope['path'].rsplit('/', 1)[-1])
+        if handler is None:
+            await self.respond(send, 404)
+        elif not await self.authenticated(scope):
+            await self.respond(send, 403)
+        else:
+            await handler(scope, receive, send)
+
+    async def still_frame(self, scope: dict, receive, send):
+        rendition_index = Capture.rendition_index(self.parameter(scope, 'size'))
+        if rendition_index is None:
+            await self.respond(send, 400)
+            return
+        # Same ETag as the WSGI view, so either can revalidate the other's
+        known_sequence = None
+        etag = self.headers(scope).get('if-none-match', '').strip('"').split('-')
+        if len(etag) == 2 and etag[0] == str(rendition_index) and etag[1].isdigit():
+            known_sequence = int(etag[1])
+        try:
+            sequence, age, frame = await fetch_frame(rendition_index, known_sequence)
+        except (OSError, EOFError):
+            await self.respond(send, 503)
+            return
+        headers = {'Cache-Control': 'max-age=0, must-revalidate'}
+        if sequence:
+            headers['ETag'] = '"{}-{}"'.format(rendition_index, sequence)
+            headers['X-Frame-Age'] = '{:.1f}'.format(age)
+        if sequence and sequence == known_sequence:
+            await self.respond(send, 304, headers=headers)
+        else:
+            headers['Content-Type'] = 'image/jpeg'
+            await self.respond(send, 200, frame or b'', headers)
+
+    async def stream(self, scope: dict, receive, send):
+        """Relays the live H.264 stream of the camera server, the same as
+        camera.views.live_stream, until the client goes away
+        """
+        if not settings.CAMERA_LIVE_STREAM:
+            await self.respond(send, 404)
+            return
+        try:
+            reader, writer = await asyncio.open_connection('localhost', settings.CAMERA_SERVER_PORT)
+        except OSError:
+            await self.respond(send, 503)
+            return
+        writer.write(Command.SERVER_LIVE_STREAM)
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'Content-Type', b'video/mp4'), (b'Cache-Control', b'no-store')]})
+
+        async def relay():
+            try:
+                while True:
+                    length = struct.unpack('I', await reader.readexactly(4))[0]
+                    if not length:
+                        break
+                    # Waits for the server to take it, meanwhile the camera
+                    # server skips frames if the client is too slow
+                    await send({'type': 'http.response.body', 'body': await reader.readexactly(length),
+                                'more_body': True})
+            except (OSError, EOFError):
+                pass
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(relay()), asyncio.ensure_future(disconnected())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            writer.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def websocket(self, scope: dict, receive, send):
+        if (await receive())['type'] != 'websocket.connect':
+            return
+        rendition_index = Capture.rendition_index(self.parameter(scope, 'size'))
+        if not scope['path'].endswith('/feed') or rendition_index is None or \
+                not await self.authenticated(scope):
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        await send({'type': 'websocket.accept'})
+        broadcaster = self.broadcaster(rendition_index)
+        slot = broadcaster.subscribe()
+
+        async def push():
+            while True:
+                frame = await slot.get()
+                # Waits for the server to take it, meanwhile newer frames
+                # replace each other in the slot
+                await send({'type': 'websocket.send', 'bytes': frame})
+
+        pusher = asyncio.ensure_future(push())
+        try:
+            while (await receive())['type'] != 'websocket.disconnect':
+                pass
+        finally:
+            broadcaster.unsubscribe(slot)
+            pusher.cancel()
+            await asyncio.gather(pusher, return_exceptions=True)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import gc
+import io
+import os
+import struct
+import time
+import tracemalloc
+
+from multiprocessing import Lock, RawArray, RawValue
+
+from django.core.management.base import BaseCommand
+
+from camera.capture import Capture, LiveFeed
+
+
+class SyntheticCamera:
+    """Stands in for the PiCamera, handing a JPEG sized payload to the output
+    in chunks the way the encoder callbacks do
+    """
+
+    def __init__(self, frame_size: int, chunk_size: int):
+        payload = memoryview(os.urandom(frame_size))
+        self._chunks = [bytes(payload[i:i + chunk_size])
+                        for i in range(0, frame_size, chunk_size)]
+
+    def capture(self, output, format=None, **kwargs):
+        for chunk in self._chunks:
+            output.write(chunk)
+
+
+def copying_snapshot(cam: SyntheticCamera, buffer: RawArray):
+    """The snapshot path used before the shared buffer writer, kept here as
+    the reference the benchmark compares against
+    """
+    iobuff = io.BytesIO()
+    cam.capture(iobuff, 'jpeg', use_video_port=True)
+    data = iobuff.getvalue()
+    buffer[:4] = struct.pack('I', len(data))
+    buffer[4:4 + len(data)] = data[:]
+
+
+class Command(BaseCommand):
+    """Measures the CPU time and the garbage generated per live feed snapshot
+    with the copying path and with the shared buffer writer. No camera is
+    needed, the frames are synthetic
+    """
+    help = 'Benchmarks the live feed snapshot paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=2000)
+        parser.add_argument('--frame-size', type=int, default=64 * 1024)
+        parser.add_argument('--chunk-size', type=int, default=16 * 1024)
+
+    def measure(self, snapshot, frames: int) -> dict:
+        gc.collect()
+        collections = sum(s['collections'] for s in gc.get_stats())
+        start = time.process_time()
+        for i in range(frames):
+            snapshot(i)
+        cpu_time = time.process_time() - start
+        collections = sum(s['collections'] for s in gc.get_stats()) - collections
+        tracemalloc.start()
+        for i in range(min(frames, 100)):
+            snapshot(i)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return dict(cpu_us=1e6 * cpu_time / frames, peak_kb=peak / 1024,
+                    gc_collections=collections)
+
+    def handle(self, *args, **kwargs):
+        frames = kwargs['frames']
+        cam = SyntheticCamera(kwargs['frame_size'], kwargs['chunk_size'])
+        size = 4 + Capture.JPEG_HEADERS_SIZE + kwargs['frame_size']
+        buffers = [RawArray(ctypes.c_byte, size) for i in range(2)]
+        buffer_index = RawValue(ctypes.c_int)
+        live_feed = LiveFeed(Lock(), RawValue(ctypes.c_uint), buffer_index,
+                             buffers)
+        results = (
+            ('copying', self.measure(lambda i: copying_snapshot(cam, buffers[i % 2]), frames)),
+            ('shared writer', self.measure(lambda i: live_feed.take_snapshot(cam, i % 2), frames))
+        )
+        self.stdout.write('{:<14} {:>12} {:>12} {:>14}'.format(
+            'path', 'cpu us/frame', 'peak KB', 'gc collections'))
+        for name, result in results:
+            self.stdout.write('{:<14} {cpu_us:>12.1f} {peak_kb:>12.1f} {gc_collections:>14}'.format(
+                name, **result))
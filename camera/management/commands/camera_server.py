@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import json
 import socket
 import struct
 import sys
 
+from multiprocessing import connection
+from threading import Event, Thread
+from time import monotonic, sleep
+
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
-from camera.capture import Capture
+from camera.capture import Capture, StreamReader
+from camera.fmp4 import FragmentedMP4Muxer
 from camera.models import CameraSettings
 
 
@@ -19,54 +25,176 @@ class Command(BaseCommand):
     SERVER_QUIT = b'QUIT'
     SERVER_SETTINGS = b'SETT'
     SERVER_LIVE_FEED = b'FEED'
+    SERVER_STATS = b'STAT'
+    SERVER_LIVE_STREAM = b'LIVE'
+    # Seconds between looks for new frames of the live stream
+    STREAM_POLL_INTERVAL = .02
+    # Most seconds between looks of the supervisor at the capture loop
+    # heartbeat, an exit of the capture daemon is noticed straight away
+    WATCHDOG_INTERVAL = 1
 
-    def ping(self, _: socket):
-        """Does nothing as a command but useful to know if the server is up
-        and running
+    def ping(self, conn: socket.socket):
+        """Tells that the server is up and running, and sends back whether
+        the capture loop is alive and how old the live preview is as a JSON
+        document preceded by its length, see Capture.health
         """
-        return
+        document = json.dumps(Capture.health()).encode('utf-8')
+        conn.sendall(struct.pack('I', len(document)) + document)
 
     def settings(self, _: socket.socket):
         """Pushes a new set of settings on the queue so the camera is
         reconfigured in the next available occassion (that is, when recording
         is not taking place)
         """
-        Capture.CAMERA_SETTINGS_QUEUE.put(CameraSettings.objects.first())
+        Capture.apply_settings(CameraSettings.objects.first())
 
     def live_feed(self, conn: socket.socket):
-        """Feeds back the latest live preview over the socket, or nothing if
-        there is none available
+        """Feeds back the sequence number and the age in milliseconds of the
+        latest live preview followed by the preview itself, or nothing if
+        there is none available. The
+        command is followed by one byte with the index of the rendition wanted
+        and four with the sequence number of the preview the client already
+        has, in which case the preview is not sent again
         """
-        if Capture.CAMERA_CURRENT_FEED_BUFFER.value == -1:
-            conn.sendall(bytearray((0, 0, 0, 0)))
+        request = conn.recv(5)
+        rendition_index = request[0] if request else Capture.rendition_index()
+        known_sequence = struct.unpack('I', request[1:5])[0] if len(request) == 5 else None
+        if rendition_index >= len(Capture.CAMERA_LIVE_FEEDS):
+            conn.sendall(bytearray(12))
             return
+        live_feed = Capture.CAMERA_LIVE_FEEDS[rendition_index]
+        # Renditions nobody asks for are hardly refreshed
+        live_feed.mark_read()
+        # Send straight from shared memory, the live feed is not overwritten
+        # by the capture daemon meanwhile
+        with live_feed.latest_snapshot() as snapshot:
+            if snapshot is None:
+                conn.sendall(bytearray(12))
+                return
+            age = min(int(1000 * live_feed.age), 0xffffffff)
+            if live_feed.sequence == known_sequence:
+                conn.sendall(struct.pack('III', live_feed.sequence, age, 0))
+            else:
+                conn.sendall(struct.pack('II', live_feed.sequence, age))
+                conn.sendall(snapshot)
+                if Capture.CAMERA_SCENE_STATS.static:
+                    Capture.CAMERA_SCENE_STATS.bytes_static += len(snapshot)
+                else:
+                    Capture.CAMERA_SCENE_STATS.bytes_active += len(snapshot)
+
+    def stats(self, conn: socket.socket):
+        """Sends back the figures of the capture daemon as a JSON document
+        preceded by its length
+        """
+        document = json.dumps(Capture.stats()).encode('utf-8')
+        conn.sendall(struct.pack('I', len(document)) + document)
+
+    def live_stream(self, conn: socket.socket):
+        """Streams the live H.264 video as fragmented MP4, each segment
+        preceded by its length, until the client goes away. The stream starts
+        with the initialization segment and the latest key frame, and skips
+        to the latest key frame whenever the client falls behind. Runs in its
+        own thread, a zero length means that there is no live stream
+        """
         try:
-            with Capture.CAMERA_CURRENT_FEED_LOCK:
-                Capture.CAMERA_CURRENT_FEED_USAGE.value += 1
-            buffer = bytearray(Capture.CAMERA_FEED_BUFFERS[Capture.CAMERA_CURRENT_FEED_BUFFER.value])
-            buffer_length = struct.unpack('I', buffer[:4])[0]
-            conn.sendall(buffer[:4 + buffer_length])
+            if Capture.CAMERA_LIVE_STREAM is None:
+                conn.sendall(bytearray(4))
+                return
+            reader = StreamReader(Capture.CAMERA_LIVE_STREAM)
+            muxer = FragmentedMP4Muxer()
+            while not self.quit:
+                frames = reader.read()
+                for frame, timestamp, duration, keyframe in frames:
+                    segments = muxer.mux(frame, timestamp, duration, keyframe)
+                    if segments:
+                        conn.sendall(struct.pack('I', len(segments)) + segments)
+                if not frames:
+                    sleep(self.STREAM_POLL_INTERVAL)
+        except OSError:
+            pass    # The client went away
         finally:
-            with Capture.CAMERA_CURRENT_FEED_LOCK:
-                Capture.CAMERA_CURRENT_FEED_USAGE.value -= 1
-        return
+            conn.close()
 
     def quit(self, _: socket.socket):
         """Stops the server
         """
         self.quit = True
 
+    @staticmethod
+    def restart_delay(delay: float, uptime: float) -> float:
+        """Backs off the restarts of a capture daemon that keeps failing
+        :param delay: the seconds waited before the last restart
+        :param uptime: the seconds the failed daemon ran for
+        :return the seconds to wait before restarting it again, none if it
+        had been running for longer than settings.CAMERA_RESTART_MAX_BACKOFF,
+        and otherwise twice as many as the last time, from
+        settings.CAMERA_RESTART_BACKOFF up to the maximum
+        """
+        if uptime > settings.CAMERA_RESTART_MAX_BACKOFF:
+            return 0
+        return min(max(2 * delay, settings.CAMERA_RESTART_BACKOFF), settings.CAMERA_RESTART_MAX_BACKOFF)
+
+    def supervise(self, stopped: Event):
+        """Restarts the capture daemon when it exits, or when it misses its
+        heartbeat by more than settings.CAMERA_WATCHDOG_TIMEOUT, which also
+        flags its frames as not live meanwhile. The time from the failure to
+        the first heartbeat of the new daemon is kept in the heartbeat
+        """
+        heartbeat = Capture.CAMERA_HEARTBEAT
+        delay = 0
+        started = monotonic()
+        failed = None
+        while not stopped.is_set():
+            daemon = Capture.CAMERA_DAEMON
+            if daemon is None:
+                # Nothing to supervise
+                return
+            connection.wait([daemon.sentinel], self.WATCHDOG_INTERVAL)
+            if stopped.is_set():
+                return
+            if failed is not None and heartbeat.beats:
+                heartbeat.add_recovery(heartbeat.beat - failed)
+                self.stderr.write('Capture loop recovered in {:.1f} seconds'.format(heartbeat.recovery))
+                failed = None
+            if heartbeat.check(settings.CAMERA_WATCHDOG_TIMEOUT):
+                self.stderr.write('Capture loop stalled, last heartbeat {:.1f} seconds ago'.format(
+                    heartbeat.as_dict()['age']))
+            if daemon.is_alive() and not heartbeat.stalled:
+                continue
+            if not daemon.is_alive():
+                self.stderr.write('Capture loop exited with code {}'.format(daemon.exitcode))
+            tick = monotonic()
+            if failed is None:
+                failed = tick
+            delay = self.restart_delay(delay, tick - started)
+            if stopped.wait(delay):
+                return
+            Capture.restart_daemon()
+            started = monotonic()
+
     def handle(self, *args, **kwargs):
+        Capture.start_daemon(settings.CAMERA_STORAGE_FOLDER)
+        self.settings(None)
+        stopped = Event()
+        Thread(target=self.supervise, args=(stopped,), daemon=True).start()
+        try:
+            self.serve()
+        finally:
+            stopped.set()
+            Capture.stop_daemon()
 
+    def serve(self):
+        """Answers the commands sent to settings.CAMERA_SERVER_PORT until told
+        to quit
+        """
         self.SERVER_COMMANDS = {
             self.SERVER_PING: self.ping,
             self.SERVER_SETTINGS: self.settings,
             self.SERVER_LIVE_FEED: self.live_feed,
+            self.SERVER_STATS: self.stats,
+            self.SERVER_LIVE_STREAM: self.live_stream,
             self.SERVER_QUIT: self.quit
         }
-
-        Capture.start_daemon(settings.CAMERA_STORAGE_FOLDER)
-        self.settings(None)
         # Fairly boilerplate server code
         # Create a TCP/IP socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -81,10 +209,14 @@ class Command(BaseCommand):
                 # Wait for a connection
                 connection, client_address = sock.accept()
                 data = connection.recv(4)
+                if data == self.SERVER_LIVE_STREAM:
+                    # Lasts as long as the client watches, the connection is
+                    # closed by the stream
+                    Thread(target=self.live_stream, args=(connection,), daemon=True).start()
+                    continue
                 # Read the command and act upon it
-                self.SERVER_COMMANDS.get(data, lambda self_obj, conn: None)(connection)
+                self.SERVER_COMMANDS.get(data, lambda conn: None)(connection)
                 connection.close()
         finally:
             sock.shutdown(socket.SHUT_RDWR)
             sock.close()
-            Capture.stop_daemon()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from camera.activity import ActivityIndex
+from camera.capture import FileManager
+from camera.models import Recording
+
+
+class Command(BaseCommand):
+    """Builds the activity index from the videos of the capture folder, for
+    the videos recorded before the index existed. Afterwards the index is
+    kept up to date by itself
+    """
+    help = 'Builds the activity index from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--folder', default=settings.CAMERA_STORAGE_FOLDER)
+
+    def handle(self, *args, **kwargs):
+        ActivityIndex(FileManager(kwargs['folder'], cleanup=False)).rebuild()
+        self.stdout.write('{} videos indexed'.format(Recording.objects.count()))
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+import http.client
+import logging
+import os
+import random
+import shutil
+import socket
+import tempfile
+
+from datetime import timedelta
+from importlib import import_module
+from multiprocessing import Process
+from threading import Event, Thread
+from time import monotonic, sleep
+from typing import List
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import get_internal_wsgi_application, run
+from django.db import connections
+from django.utils.timezone import now
+
+from camera.capture import Capture, FileManager
+from camera.management.commands.benchmark_feed import SyntheticCamera
+from camera.management.commands.camera_server import Command as CameraServer
+
+
+class SimulatedCameraServer(CameraServer):
+    """Camera server that answers as the real one does, over the same
+    protocol, with synthetic live preview frames instead of a capture daemon
+    """
+
+    def settings(self, _: socket.socket):
+        pass
+
+    def refresh(self, frame_size: int, interval: float):
+        cameras = [SyntheticCamera(min(frame_size, live_feed.buffer_size // 2), 16 * 1024)
+                   for live_feed in Capture.CAMERA_LIVE_FEEDS]
+        while True:
+            for camera, live_feed in zip(cameras, Capture.CAMERA_LIVE_FEEDS):
+                live_feed.capture_frame(camera)
+            sleep(interval)
+
+    def run(self, port: int, frame_size: int):
+        settings.CAMERA_SERVER_PORT = port
+        Capture.init_buffers()
+        Thread(target=self.refresh, args=(frame_size, settings.CAMERA_PREVIEW_FREQ), daemon=True).start()
+        self.serve()
+
+
+def web_server(port: int, camera_port: int, folder: str):
+    """Serves the web application with the threaded server of runserver,
+    against the simulated camera server and the synthetic recordings
+    """
+    settings.CAMERA_SERVER_PORT = camera_port
+    settings.CAMERA_STORAGE_FOLDER = settings.MEDIA_ROOT = folder
+    # No Apache in front to send the media files
+    settings.SENDFILE_BACKEND = 'sendfile.backends.simple'
+    # The connections of the parent are not to be shared
+    connections.close_all()
+    application = get_internal_wsgi_application()
+    # Logging every request would be measured too. Loading the application
+    # configures logging again, so it is only quietened after
+    logging.getLogger('django.server').setLevel(logging.ERROR)
+    run('127.0.0.1', port, application, threading=True)
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted latencies
+    """
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, max(0, int(round(fraction * len(latencies))) - 1))]
+
+
+class ProcessMonitor:
+    """Samples the CPU time and resident memory of a process from /proc
+    while a phase of the load test runs
+    """
+
+    def __init__(self, pid: int, interval: float=.1):
+        self._pid = pid
+        self._interval = interval
+        self._done = Event()
+        self.max_rss = 0
+
+    def cpu_seconds(self) -> float:
+        with open('/proc/{}/stat'.format(self._pid)) as f:
+            # The command may have spaces, the fields after it do not
+            fields = f.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def rss(self) -> int:
+        with open('/proc/{}/status'.format(self._pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def _sample(self):
+        while not self._done.wait(self._interval):
+            self.max_rss = max(self.max_rss, self.rss())
+
+    def __enter__(self):
+        self.max_rss = self.rss()
+        self._start = monotonic()
+        self._cpu_start = self.cpu_seconds()
+        self._thread = Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._done.set()
+        self._thread.join()
+        self.cpu = (self.cpu_seconds() - self._cpu_start) / (monotonic() - self._start)
+
+
+class Command(BaseCommand):
+    """Measures how the web application copes with many viewers at once. It
+    starts a simulated camera server with synthetic frames, fills a capture
+    folder with synthetic recordings and serves the application from another
+    process, which is sent requests from a number of threads at once, one
+    endpoint after the other. For each endpoint it tells the throughput, the
+    latency percentiles and the CPU and memory of the server. Media files are
+    sent by Django itself, as no Apache is in front of it
+    """
+    help = 'Load tests the web application against a simulated camera'
+
+    ENDPOINTS = ('still_frame', 'browse', 'media_file')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', nargs='+', choices=self.ENDPOINTS, default=self.ENDPOINTS)
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Requests sent at the same time')
+        parser.add_argument('--duration', type=float, default=10,
+                            help='Seconds each endpoint is loaded for')
+        parser.add_argument('--recordings', type=int, default=100)
+        parser.add_argument('--recording-size', type=int, default=1024 * 1024)
+        parser.add_argument('--frame-size', type=int, default=64 * 1024)
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--camera-port', type=int, default=settings.CAMERA_SERVER_PORT + 1)
+        parser.add_argument('--username', help='The user the requests are sent as, by default the first superuser')
+
+    @staticmethod
+    def create_recordings(folder: str, count: int, size: int) -> List[str]:
+        """Fills a capture folder with synthetic recordings and thumbnails, a
+        few per hour back from now
+        :return the names of the recordings
+        """
+        file_manager = FileManager(folder, cleanup=False)
+        payload = os.urandom(size)
+        names = []
+        for index in range(count):
+            name = '{}_{}.mp4'.format((now() - timedelta(minutes=20 * index)).strftime('%Y-%m-%d_%H%M%S'), 60)
+            path = file_manager.complete_path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(payload)
+            with open(path + '.jpg', 'wb') as f:
+                f.write(payload[:8 * 1024])
+            names.append(name)
+        file_manager.bump_generation()
+        return names
+
+    def login(self, username: str=None):
+        """Logs a user in the way the login view does, without a password
+        :return the session, to be deleted once done
+        """
+        users = get_user_model().objects.order_by('pk')
+        user = users.filter(username=username).first() if username else \
+            users.filter(is_superuser=True).first()
+        if user is None:
+            raise CommandError('No user to send the requests as, create one with createsuperuser')
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session
+
+    @staticmethod
+    def wait_for(port: int, timeout: float=10):
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                if monotonic() > deadline:
+                    raise CommandError('Nothing answers on port {}'.format(port))
+                sleep(.1)
+
+    def load(self, port: int, paths: List[str], cookie: str, concurrency: int, duration: float) -> dict:
+        """Sends requests for the paths, at random, from a number of threads
+        at once for a while
+        :return the sorted latencies of the successful requests and the
+        number of failed ones
+        """
+        latencies = []
+        errors = []
+        deadline = monotonic() + duration
+
+        def client():
+            while monotonic() < deadline:
+                start = monotonic()
+                try:
+                    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                    connection.request('GET', random.choice(paths), headers=dict(Cookie=cookie))
+                    response = connection.getresponse()
+                    response.read()
+                    connection.close()
+                    if response.status != 200:
+                        raise http.client.HTTPException(response.status)
+                    latencies.append(monotonic() - start)
+                except (OSError, http.client.HTTPException):
+                    errors.append(monotonic() - start)
+
+        threads = [Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return dict(latencies=sorted(latencies), errors=len(errors))
+
+    def handle(self, *args, **kwargs):
+        folder = tempfile.mkdtemp(prefix='tusacam_load_')
+        processes = []
+        session = None
+        try:
+            names = self.create_recordings(folder, kwargs['recordings'], kwargs['recording_size'])
+            session = self.login(kwargs['username'])
+            cookie = '{}={}'.format(settings.SESSION_COOKIE_NAME, session.session_key)
+            processes = [Process(target=SimulatedCameraServer().run,
+                                 args=(kwargs['camera_port'], kwargs['frame_size']), daemon=True),
+                         Process(target=web_server,
+                                 args=(kwargs['port'], kwargs['camera_port'], folder), daemon=True)]
+            for process in processes:
+                process.start()
+            self.wait_for(kwargs['camera_port'])
+            self.wait_for(kwargs['port'])
+            renditions = [name for name, _, _ in settings.CAMERA_PREVIEW_RENDITIONS]
+            endpoint_paths = dict(still_frame=['/still_frame?size={}'.format(name) for name in renditions],
+                                  browse=['/browse'],
+                                  media_file=['/media/{}'.format(name) for name in names])
+            self.stdout.write('{:<12} {:>9} {:>7} {:>8} {:>8} {:>8} {:>8} {:>7} {:>8}'.format(
+                'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'cpu %', 'rss MB'))
+            for endpoint in kwargs['endpoints']:
+                with ProcessMonitor(processes[1].pid) as monitor:
+                    result = self.load(kwargs['port'], endpoint_paths[endpoint], cookie,
+                                       kwargs['concurrency'], kwargs['duration'])
+                latencies = result['latencies']
+                percentiles = ['{:.1f}'.format(1000 * latency) if latency is not None else '-'
+                               for latency in (percentile(latencies, p) for p in (.5, .95, .99))]
+                self.stdout.write('{:<12} {:>9} {:>7} {:>8.1f} {:>8} {:>8} {:>8} {:>7.1f} {:>8.1f}'.format(
+                    endpoint, len(latencies), result['errors'], len(latencies) / kwargs['duration'],
+                    percentiles[0], percentiles[1], percentiles[2],
+                    100 * monitor.cpu, monitor.max_rss / (1024 * 1024)))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+            if session is not None:
+                session.delete()
+            shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from camera.capture import FileManager
+from camera.reencode import Reencoder
+
+
+class Command(BaseCommand):
+    """Re-encodes the aged recordings to a smaller profile so that the
+    storage policy has to delete less. It is meant to be run periodically,
+    e.g. from cron, and stops by itself whenever the camera starts recording
+    or the CPU gets hot
+    """
+    help = 'Re-encodes aged recordings to a smaller profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--folder', default=settings.CAMERA_STORAGE_FOLDER)
+        parser.add_argument('--days', type=int, default=settings.CAMERA_REENCODE_AFTER_DAYS,
+                            help='Age in days of the recordings re-encoded')
+        parser.add_argument('--profile', default=settings.CAMERA_REENCODE_PROFILE,
+                            choices=sorted(settings.CAMERA_REENCODE_PROFILES))
+        parser.add_argument('--max-videos', type=int, default=None,
+                            help='Maximum number of recordings re-encoded')
+
+    def handle(self, *args, **kwargs):
+        file_manager = FileManager(kwargs['folder'], cleanup=False)
+        reencoder = Reencoder(file_manager, kwargs['profile'])
+        count, size_before, size_after = reencoder.run(kwargs['days'], kwargs['max_videos'])
+        saved = size_before - size_after
+        self.stdout.write('{} videos re-encoded, {:.1f} MB saved, about {:.1f} more days of retention'.format(
+            count, saved / (1024 * 1024), reencoder.retention_gain(saved)))
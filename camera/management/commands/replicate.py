@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from camera.capture import FileManager
+from camera.replication import Replicator, S3Client
+
+
+class Command(BaseCommand):
+    """Copies the finished recordings to the S3 store in
+    settings.CAMERA_REPLICATION. Files that fail are tried again by later
+    runs, so it is meant to be run periodically, e.g. from cron
+    """
+    help = 'Copies the recordings to an S3 compatible store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--folder', default=settings.CAMERA_STORAGE_FOLDER)
+        parser.add_argument('--keep-local-days', type=int,
+                            default=settings.CAMERA_REPLICATION_KEEP_LOCAL_DAYS,
+                            help='Days replicated recordings are kept in the capture folder')
+
+    def handle(self, *args, **kwargs):
+        store = settings.CAMERA_REPLICATION
+        if not store:
+            raise CommandError('CAMERA_REPLICATION is not configured')
+        client = S3Client(store['endpoint'], store['region'], store['bucket'],
+                          store['access_key'], store['secret_key'])
+        replicator = Replicator(FileManager(kwargs['folder'], cleanup=False), client,
+                                store.get('prefix', ''))
+        queued = replicator.enqueue()
+        uploaded, failed = replicator.run()
+        removed = 0
+        if kwargs['keep_local_days'] is not None:
+            removed = replicator.prune(kwargs['keep_local_days'])
+        self.stdout.write('{} files queued, {} uploaded, {} failed, {} local videos removed'.format(
+            queued, uploaded, failed, removed))
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from camera.capture import FileManager
+
+
+class Command(BaseCommand):
+    """Moves the recordings of a capture folder that uses the flat layout to
+    one folder per day. It can run in the background while the camera server
+    and the web app keep working, as long as CAMERA_STORAGE_SHARDED is
+    already enabled so that both find the files in either place
+    """
+    help = 'Moves the capture folder files to one folder per day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--folder', default=settings.CAMERA_STORAGE_FOLDER)
+        parser.add_argument('--delay', type=float, default=.05,
+                            help='Seconds to wait after each file is moved')
+
+    def handle(self, *args, **kwargs):
+        file_manager = FileManager(kwargs['folder'], sharded=True, cleanup=False)
+        moved = file_manager.shard_files(kwargs['delay'])
+        self.stdout.write('{} files moved'.format(moved))
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.13 on 2026-10-19 10:12
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camera', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camerasettings',
+            name='bitrate',
+            field=models.IntegerField(default=17000, validators=[django.core.validators.MaxValueValidator(25000), django.core.validators.MinValueValidator(0)], verbose_name='Video Bitrate kbps (0 for no limit)'),
+        ),
+        migrations.AddField(
+            model_name='camerasettings',
+            name='quality',
+            field=models.IntegerField(default=0, validators=[django.core.validators.MaxValueValidator(40), django.core.validators.MinValueValidator(0)], verbose_name='Video Quantization (10 best to 40, 0 for default)'),
+        ),
+        migrations.AddField(
+            model_name='camerasettings',
+            name='intra_period',
+            field=models.IntegerField(default=60, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Video Key Frame Interval'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.13 on 2026-10-19 11:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camera', '0002_recording_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Replication',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.CharField(max_length=255, unique=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('replicated', models.DateTimeField(null=True)),
+                ('upload_id', models.CharField(blank=True, default='', max_length=255)),
+                ('parts', models.TextField(blank=True, default='')),
+                ('error', models.TextField(blank=True, default='')),
+            ],
+        ),
+    ]
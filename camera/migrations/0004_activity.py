@@ -0,0 +1,38 @@
+# Generated by Django 2.0.13 on 2026-10-19 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camera', '0003_replication'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityLogPosition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('offset', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HourlyActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(unique=True)),
+                ('recordings', models.IntegerField(default=0)),
+                ('seconds', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Recording',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.CharField(max_length=255, unique=True)),
+                ('timestamp', models.DateTimeField(db_index=True)),
+                ('duration', models.IntegerField()),
+            ],
+        ),
+    ]
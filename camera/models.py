@@ -1,6 +1,7 @@
 import picamera
 
 from django.db import models
+from django.utils.timezone import now
 from django.core.validators import MaxValueValidator, MinValueValidator
 
 from django.utils.translation import ugettext_lazy as _
@@ -20,9 +21,66 @@ class CameraSettings(models.Model):
                                     validators=(MinValueValidator(1),))
     max_mb = models.IntegerField(_('Storage Retention MB'), default=256,
                                  validators=(MinValueValidator(256),))
+    bitrate = models.IntegerField(_('Video Bitrate kbps (0 for no limit)'), default=17000,
+                                  validators=(MaxValueValidator(25000),
+                                              MinValueValidator(0)))
+    quality = models.IntegerField(_('Video Quantization (10 best to 40, 0 for default)'), default=0,
+                                  validators=(MaxValueValidator(40),
+                                              MinValueValidator(0)))
+    intra_period = models.IntegerField(_('Video Key Frame Interval'), default=60,
+                                       validators=(MinValueValidator(1),))
 
     def apply_to(self, camera: picamera.PiCamera):
         camera.brightness = self.brightness
         camera.hflip = self.hflip
         camera.vflip = self.vflip
         camera.contrast = self.contrast
+
+    def recording_options(self) -> dict:
+        """Returns the encoder options for PiCamera.start_recording
+        """
+        return dict(bitrate=self.bitrate * 1000,
+                    quality=self.quality,
+                    intra_period=self.intra_period)
+
+
+class Replication(models.Model):
+    """A file of the capture folder to be copied to the S3 store, see
+    camera.replication
+    """
+
+    file = models.CharField(max_length=255, unique=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=now)
+    replicated = models.DateTimeField(null=True)
+    # Multipart upload in progress and ETags of its parts already uploaded,
+    # one per line
+    upload_id = models.CharField(max_length=255, blank=True, default='')
+    parts = models.TextField(blank=True, default='')
+    error = models.TextField(blank=True, default='')
+
+
+class Recording(models.Model):
+    """A video of the capture folder, indexed by time, see camera.activity
+    """
+
+    file = models.CharField(max_length=255, unique=True)
+    timestamp = models.DateTimeField(db_index=True)
+    duration = models.IntegerField()
+
+
+class HourlyActivity(models.Model):
+    """Recordings started and seconds recorded in an hour. It is kept once
+    the recordings are deleted, as a history of the activity
+    """
+
+    hour = models.DateTimeField(unique=True)
+    recordings = models.IntegerField(default=0)
+    seconds = models.IntegerField(default=0)
+
+
+class ActivityLogPosition(models.Model):
+    """Bytes of the activity log of the capture folder already indexed
+    """
+
+    offset = models.BigIntegerField(default=0)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import struct
+
+from array import array
+from typing import List, Tuple
+
+try:
+    import numpy
+except ImportError:     # Frames are still counted, with no motion score, without numpy
+    numpy = None
+
+
+class MotionTrack:
+    """How much moved in every frame of a recording, kept in a small file
+    next to it so that the player can show where the activity is without
+    decoding the video. Every frame takes a byte, its score from 0 to
+    MAX_SCORE with the SENSOR bit set if the motion sensor fired on it
+    """
+
+    SUFFIX = '.motion'
+    # Magic, version and frame rate of the track file, the scores follow
+    HEADER = struct.Struct('<4sBH')
+    MAGIC = b'TMOT'
+    VERSION = 1
+    SENSOR = 0x80
+    MAX_SCORE = 0x7f
+
+    def __init__(self, framerate: int, scores: array=None):
+        self.framerate = framerate
+        self.scores = scores if scores is not None else array('B')
+        self._sensor = False
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    @property
+    def duration(self) -> float:
+        return len(self.scores) / self.framerate if self.framerate else 0
+
+    def add(self, score: int):
+        """Adds the score of the next frame
+        """
+        score = min(max(score, 0), self.MAX_SCORE)
+        if self._sensor:
+            score |= self.SENSOR
+            self._sensor = False
+        self.scores.append(score)
+
+    def sensor(self):
+        """Marks the next frame as the one the motion sensor fired on
+        """
+        self._sensor = True
+
+    def save(self, path: str):
+        temp_path = '{}.{}'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.framerate))
+            self.scores.tofile(f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'MotionTrack':
+        """
+        :raise ValueError: if the file is not a motion track
+        """
+        with open(path, 'rb') as f:
+            header = f.read(cls.HEADER.size)
+            if len(header) < cls.HEADER.size:
+                raise ValueError('Not a motion track')
+            magic, version, framerate = cls.HEADER.unpack(header)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError('Not a motion track')
+            scores = array('B')
+            scores.frombytes(f.read())
+        return cls(framerate, scores)
+
+    def bins(self, count: int) -> List[int]:
+        """Sums the track up in a number of bins of the same length, at most
+        one per frame
+        :return the highest score of the frames of each bin
+        """
+        count = min(count, len(self.scores))
+        frames = len(self.scores)
+        return [max(score & self.MAX_SCORE for score in self.scores[index * frames // count:(index + 1) * frames // count])
+                for index in range(count)]
+
+    def peaks(self, count: int, min_gap: float=5) -> List[float]:
+        """Finds the moments with most motion
+        :param count: how many at most
+        :param min_gap: the seconds between two of them, at least
+        :return the time of the peaks in seconds, in order
+        """
+        gap = max(int(min_gap * self.framerate), 1)
+        frames = sorted((frame for frame, score in enumerate(self.scores) if score & self.MAX_SCORE),
+                        key=lambda frame: (-(self.scores[frame] & self.MAX_SCORE), frame))
+        peaks = []
+        for frame in frames:
+            if len(peaks) == count:
+                break
+            if all(abs(frame - peak) >= gap for peak in peaks):
+                peaks.append(frame)
+        return [frame / self.framerate for frame in sorted(peaks)]
+
+    def sensor_times(self) -> List[float]:
+        """
+        :return the times in seconds the motion sensor fired at
+        """
+        return [frame / self.framerate for frame, score in enumerate(self.scores) if score & self.SENSOR]
+
+
+class MotionVectorOutput(io.RawIOBase):
+    """Output for the motion vectors of the encoder, the motion_output of
+    PiCamera.start_recording, that scores every frame as it is encoded. The
+    GPU works the vectors out anyway, so it only costs counting them
+    """
+    # Vectors of a macro block, the vertical and horizontal motion and the
+    # sum of absolute differences
+    VECTOR_SIZE = 4
+    # Squared length of the vectors that count as motion, shorter ones are
+    # noise of the sensor
+    MIN_MOTION = 4 ** 2
+
+    def __init__(self, resolution: Tuple[int, int], track: MotionTrack):
+        width, height = resolution
+        # There is an extra column of macro blocks
+        self._blocks = ((width + 15) // 16 + 1) * ((height + 15) // 16)
+        self._frame_size = self._blocks * self.VECTOR_SIZE
+        self._pending = bytearray()
+        self._track = track
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._pending += data
+        while len(self._pending) >= self._frame_size:
+            self._track.add(self.score(bytes(self._pending[:self._frame_size])))
+            del self._pending[:self._frame_size]
+        return len(data)
+
+    def score(self, frame: bytes) -> int:
+        if numpy is None:
+            return 0
+        vectors = numpy.frombuffer(frame, dtype=numpy.int8).reshape(self._blocks, self.VECTOR_SIZE)
+        motion = vectors[:, :2].astype(numpy.int16)
+        lengths = (motion * motion).sum(axis=1)
+        if not lengths.any() and len(self._track):
+            # Key frames have no vectors at all, they keep the score of the
+            # frame before instead of dropping to nothing
+            return self._track.scores[-1] & MotionTrack.MAX_SCORE
+        moving = numpy.count_nonzero(lengths >= self.MIN_MOTION) / self._blocks
+        # Square root so that something small far away still shows
+        return int(round(MotionTrack.MAX_SCORE * moving ** 0.5))
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+
+from datetime import timedelta
+from os.path import basename, splitext
+from typing import List, Tuple
+
+from django.conf import settings
+from django.utils.timezone import now
+
+from camera.capture import FileManager, StagingArea, Video
+from camera.clips import KeyframeIndex
+from camera.motion import MotionTrack
+
+
+class Reencoder:
+    """Re-encodes the videos older than a given age to a smaller profile, so
+    that more days fit in the same storage budget. It works at the lowest
+    priority and only while nothing is being recorded and the CPU is cool,
+    giving up the video it is working on as soon as that changes. Re-encoded
+    videos get the profile in their name, so their URLs never serve
+    different content
+    """
+
+    THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+
+    def __init__(self, file_manager: FileManager, profile: str=None,
+                 max_temperature: float=None, poll_interval: float=1,
+                 staging: StagingArea=None):
+        """
+        :param file_manager: the file manager of the capture folder
+        :param profile: one of settings.CAMERA_REENCODE_PROFILES, by default
+        settings.CAMERA_REENCODE_PROFILE
+        :param max_temperature: the CPU temperature in Celsius degrees above
+        which nothing is re-encoded
+        :param poll_interval: seconds between checks of whether the camera
+        is still idle while a video is re-encoded
+        :param staging: the staging area where the recordings may be
+        written, by default the one in the settings
+        """
+        self._file_manager = file_manager
+        self._staging = staging if staging is not None else StagingArea()
+        self._profile = profile or settings.CAMERA_REENCODE_PROFILE
+        self._input_args, self._output_args = settings.CAMERA_REENCODE_PROFILES[self._profile]
+        self._max_temperature = max_temperature or settings.CAMERA_REENCODE_MAX_TEMPERATURE
+        self._poll_interval = poll_interval
+
+    @classmethod
+    def temperature(cls) -> float:
+        """Returns the CPU temperature in Celsius degrees, or None if it is
+        not known
+        """
+        try:
+            with open(cls.THERMAL_ZONE) as f:
+                return int(f.read()) / 1000
+        except (IOError, ValueError):
+            return None
+
+    def idle(self) -> bool:
+        """Tells whether there is no recording in progress and the CPU is
+        below the maximum temperature
+        """
+        if self._file_manager.glob('*.h264') or self._staging.glob('*.h264'):
+            return False
+        temperature = self.temperature()
+        return temperature is None or temperature < self._max_temperature
+
+    def video_size(self, video: Video) -> int:
+        try:
+            return os.stat(self._file_manager.complete_path(video.file)).st_size
+        except IOError:
+            return 0
+
+    @staticmethod
+    def is_original(video: Video) -> bool:
+        return not Video.NAME_RE.match(basename(video.file)).group(3)
+
+    def aged_videos(self, days: int) -> List[Video]:
+        """Returns the videos older than the given number of days that have
+        not been re-encoded yet, oldest first
+        """
+        limit = now() - timedelta(days=days)
+        return [video
+                for _, videos in reversed(self._file_manager.list_videos())
+                for video in reversed(videos)
+                if video.timestamp < limit and self.is_original(video)]
+
+    @staticmethod
+    def _lower_priority():
+        os.nice(19)
+
+    def reencode(self, video: Video) -> int:
+        """Re-encodes a video. The original video is replaced, together with
+        its thumbnail, only once the new one is complete. When the new video
+        is not smaller the original is kept under the new name, so that it
+        is not tried again
+        :return the size of the video under the new name, or None if it
+        could not be re-encoded or the camera stopped being idle
+        """
+        video_path = self._file_manager.complete_path(video.file)
+        name, extension = splitext(video_path)
+        new_path = '{}.{}{}'.format(name, self._profile, extension)
+        partial_path = new_path + FileManager.PARTIAL_SUFFIX
+        process = subprocess.Popen(('ffmpeg', '-loglevel', 'error') +
+                                   tuple(self._input_args) +
+                                   ('-i', video_path, '-an') +
+                                   tuple(self._output_args) +
+                                   ('-f', 'mp4', '-y', partial_path),
+                                   preexec_fn=self._lower_priority)
+        while True:
+            try:
+                process.wait(self._poll_interval)
+                break
+            except subprocess.TimeoutExpired:
+                if not self.idle():
+                    process.terminate()
+                    process.wait()
+                    break
+        if process.returncode != 0 or not os.path.exists(partial_path):
+            try:
+                os.unlink(partial_path)
+            except IOError:
+                pass
+            return None
+        if os.stat(partial_path).st_size < os.stat(video_path).st_size:
+            os.replace(partial_path, new_path)
+            os.unlink(video_path)
+        else:
+            os.unlink(partial_path)
+            os.replace(video_path, new_path)
+        # The thumbnail, the proxy and the motion track go with the video
+        for suffix in ('.jpg', FileManager.PROXY_SUFFIX, MotionTrack.SUFFIX):
+            if os.path.exists(video_path + suffix):
+                os.replace(video_path + suffix, new_path + suffix)
+        # The key frames changed, the index is built again when needed
+        try:
+            os.unlink(video_path + KeyframeIndex.SUFFIX)
+        except IOError:
+            pass
+        # Added first, so that the activity index takes it as the same video
+        self._file_manager.log_activity(True, new_path)
+        self._file_manager.log_activity(False, video_path)
+        self._file_manager.bump_generation()
+        return os.stat(new_path).st_size
+
+    def run(self, days: int, max_videos: int=None) -> Tuple[int, int, int]:
+        """Re-encodes the videos older than the given number of days, oldest
+        first, while the camera is idle
+        :param days: age in days of the videos to re-encode
+        :param max_videos: maximum number of videos re-encoded, all by default
+        :return the number of videos re-encoded, their size before and
+        their size after
+        """
+        count = size_before = size_after = 0
+        for video in self.aged_videos(days)[:max_videos]:
+            if not self.idle():
+                break
+            size = self.video_size(video)
+            new_size = self.reencode(video)
+            if new_size is None:
+                break
+            count += 1
+            size_before += size
+            size_after += new_size
+        return count, size_before, size_after
+
+    def retention_gain(self, saved_bytes: int) -> float:
+        """Returns how many more days of recordings fit in the given number
+        of bytes, taking as reference the days that have no re-encoded
+        videos
+        """
+        day_sizes = [sum(self.video_size(video) for video in videos)
+                     for _, videos in self._file_manager.list_videos()
+                     if all(self.is_original(video) for video in videos)]
+        if not sum(day_sizes):
+            return 0
+        return saved_bytes * len(day_sizes) / sum(day_sizes)
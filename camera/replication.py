@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import hmac
+import http.client
+import io
+import os
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from os.path import basename
+from threading import Lock
+from time import monotonic, sleep
+from typing import List, Tuple
+from urllib.parse import quote, urlsplit
+
+from django.conf import settings
+from django.db import connection
+from django.utils.timezone import now
+
+from camera.capture import FileManager
+from camera.models import Replication
+
+
+class ReplicationError(IOError):
+    """Raised when the store does not accept a request
+    """
+
+
+class RateLimiter:
+    """Limits the bytes per second shared by several threads
+    """
+
+    def __init__(self, rate: int=None):
+        """
+        :param rate: bytes per second, None for no limit
+        """
+        self._rate = rate
+        self._lock = Lock()
+        self._started = monotonic()
+        self._consumed = 0
+
+    def consume(self, size: int):
+        """Waits until size more bytes can be sent
+        """
+        if not self._rate:
+            return
+        with self._lock:
+            self._consumed += size
+            delay = self._consumed / self._rate - (monotonic() - self._started)
+        if delay > 0:
+            sleep(delay)
+
+
+class FileSlice(io.RawIOBase):
+    """Readable part of a file, read at the pace allowed by a rate limiter,
+    that is given as request body so that uploads are streamed from disk
+    """
+
+    def __init__(self, path: str, offset: int, length: int, limiter: RateLimiter):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._file.seek(offset)
+        self._left = length
+        self._limiter = limiter
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int=-1) -> bytes:
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._file.read(size)
+        self._left -= len(data)
+        self._limiter.consume(len(data))
+        return data
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class S3Client:
+    """Minimal client of the S3 API, enough to upload objects to Amazon S3
+    or any compatible store such as MinIO. Requests are signed with AWS
+    signature version 4 and use path style URLs, <endpoint>/<bucket>/<key>
+    """
+
+    SERVICE = 's3'
+    UPLOAD_ID_RE = re.compile(r'<UploadId>(.*?)</UploadId>')
+
+    def __init__(self, endpoint: str, region: str, bucket: str,
+                 access_key: str, secret_key: str, timeout: float=60):
+        url = urlsplit(endpoint)
+        self._secure = url.scheme == 'https'
+        self._host = url.netloc
+        self._region = region
+        self._bucket = bucket
+        self._access_key = access_key
+        self._secret_key = secret_key
+        self._timeout = timeout
+
+    @staticmethod
+    def _hmac(key: bytes, message: str) -> bytes:
+        return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+    def sign(self, method: str, path: str, query: dict, headers: dict,
+             payload_hash: str, timestamp: datetime) -> str:
+        """Returns the Authorization header of a request
+        :param path: the URL encoded path of the request
+        :param headers: the headers signed, lower case
+        :param payload_hash: the SHA256 of the body or UNSIGNED-PAYLOAD
+        :param timestamp: the time of the request, in UTC
+        """
+        day = timestamp.strftime('%Y%m%d')
+        scope = '{}/{}/{}/aws4_request'.format(day, self._region, self.SERVICE)
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join((
+            method,
+            path,
+            '&'.join('{}={}'.format(quote(k, safe='-_.~'), quote(v, safe='-_.~'))
+                     for k, v in sorted(query.items())),
+            ''.join('{}:{}\n'.format(k, headers[k].strip()) for k in sorted(headers)),
+            signed_headers,
+            payload_hash))
+        string_to_sign = '\n'.join(('AWS4-HMAC-SHA256',
+                                    timestamp.strftime('%Y%m%dT%H%M%SZ'),
+                                    scope,
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()))
+        key = ('AWS4' + self._secret_key).encode()
+        for part in (day, self._region, self.SERVICE, 'aws4_request'):
+            key = self._hmac(key, part)
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+            self._access_key, scope, signed_headers, signature)
+
+    def request(self, method: str, key: str, query: dict=None, body=b'',
+                length: int=None) -> Tuple[dict, bytes]:
+        """Sends a request about an object of the bucket
+        :param body: bytes, or a file-like object of the given length that
+        is streamed without signing its content
+        :return the headers and the body of the response
+        """
+        query = query or dict()
+        path = quote('/{}/{}'.format(self._bucket, key), safe='/-_.~')
+        timestamp = datetime.utcnow()
+        if isinstance(body, bytes):
+            payload_hash = hashlib.sha256(body).hexdigest()
+            length = len(body)
+        else:
+            payload_hash = 'UNSIGNED-PAYLOAD'
+        headers = {'host': self._host,
+                   'x-amz-content-sha256': payload_hash,
+                   'x-amz-date': timestamp.strftime('%Y%m%dT%H%M%SZ')}
+        headers['Authorization'] = self.sign(method, path, query, headers, payload_hash, timestamp)
+        headers['Content-Length'] = str(length)
+        url = path
+        if query:
+            url += '?' + '&'.join('{}={}'.format(quote(k, safe='-_.~'), quote(v, safe='-_.~'))
+                                  for k, v in sorted(query.items()))
+        connection_class = http.client.HTTPSConnection if self._secure else http.client.HTTPConnection
+        conn = connection_class(self._host, timeout=self._timeout)
+        try:
+            conn.request(method, url, body=body, headers=headers)
+            response = conn.getresponse()
+            content = response.read()
+            if response.status // 100 != 2:
+                raise ReplicationError('{} {} failed with {}: {}'.format(
+                    method, key, response.status, content[:200].decode('utf-8', 'replace')))
+            return {k.lower(): v for k, v in response.getheaders()}, content
+        finally:
+            conn.close()
+
+    def put_object(self, key: str, body, length: int):
+        self.request('PUT', key, body=body, length=length)
+
+    def create_multipart_upload(self, key: str) -> str:
+        _, content = self.request('POST', key, dict(uploads=''))
+        upload_id = self.UPLOAD_ID_RE.search(content.decode('utf-8', 'replace'))
+        if upload_id is None:
+            raise ReplicationError('No upload id for {}'.format(key))
+        return upload_id.group(1)
+
+    def upload_part(self, key: str, upload_id: str, number: int, body, length: int) -> str:
+        headers, _ = self.request('PUT', key, dict(partNumber=str(number), uploadId=upload_id),
+                                  body=body, length=length)
+        if 'etag' not in headers:
+            raise ReplicationError('No ETag for part {} of {}'.format(number, key))
+        return headers['etag']
+
+    def complete_multipart_upload(self, key: str, upload_id: str, etags: List[str]):
+        parts = ''.join('<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(number, etag)
+                        for number, etag in enumerate(etags, 1))
+        body = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(parts).encode()
+        self.request('POST', key, dict(uploadId=upload_id), body=body)
+
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        """Discards an upload in parts, so that the store frees its parts
+        """
+        self.request('DELETE', key, dict(uploadId=upload_id))
+
+
+class Replicator:
+    """Copies the finished recordings and their thumbnails to an S3 store.
+    The files waiting to be copied are kept in the database, with the parts
+    already uploaded of the large ones, so that nothing is lost and nothing
+    is sent twice when the Pi or the network goes down
+    """
+
+    def __init__(self, file_manager: FileManager, client: S3Client, prefix: str='',
+                 part_size: int=None, concurrency: int=None, rate: int=None):
+        """
+        :param prefix: the prefix of the object keys
+        :param part_size: files larger than this are uploaded in parts of
+        this size, by default settings.CAMERA_REPLICATION_PART_SIZE
+        :param concurrency: the number of files uploaded at the same time,
+        by default settings.CAMERA_REPLICATION_CONCURRENCY
+        :param rate: the maximum bytes per second uploaded, by default
+        settings.CAMERA_REPLICATION_RATE
+        """
+        self._file_manager = file_manager
+        self._client = client
+        self._prefix = prefix
+        self._part_size = part_size or settings.CAMERA_REPLICATION_PART_SIZE
+        self._concurrency = concurrency or settings.CAMERA_REPLICATION_CONCURRENCY
+        self._limiter = RateLimiter(rate or settings.CAMERA_REPLICATION_RATE)
+
+    def key(self, file_name: str) -> str:
+        """Returns the key of a file in the store, always in the sharded
+        layout whatever the local one
+        """
+        return '{}{}/{}'.format(self._prefix, FileManager.day_folder(file_name).replace(os.sep, '/'),
+                                file_name)
+
+    def thumbnail_pack_files(self, file_name: str) -> List[str]:
+        """Returns the paths of the thumbnail pack of the day of a file and
+        of its index, sprite sheets are left out as they can be built again
+        """
+        pack = self._file_manager.thumbnail_pack(file_name)
+        return [pack.pack_path, pack.index_path]
+
+    def enqueue(self) -> int:
+        """Adds the finished files of the capture folder that are not in the
+        queue yet. Packed thumbnails go once their day is over, as the pack
+        is not finished until then
+        :return the number of files added
+        """
+        queued = set(Replication.objects.values_list('file', flat=True))
+        today = now().strftime('%Y-%m-%d')
+        new_files = []
+        for _, videos in self._file_manager.list_videos():
+            day_files = []
+            if basename(videos[0].file) < today:
+                day_files = self.thumbnail_pack_files(basename(videos[0].file))
+            for video in videos:
+                day_files.extend((self._file_manager.complete_path(video.file),
+                                  self._file_manager.complete_path(video.thumbnail)))
+            for file_path in day_files:
+                name = basename(file_path)
+                if name not in queued and os.path.exists(file_path):
+                    new_files.append(Replication(file=name))
+                    queued.add(name)
+        Replication.objects.bulk_create(new_files)
+        return len(new_files)
+
+    def upload(self, task: Replication):
+        """Uploads a file of the queue, resuming it if it was uploaded in
+        parts and some were uploaded already
+        """
+        path = self._file_manager.resolve(task.file)
+        size = os.stat(path).st_size
+        key = self.key(task.file)
+        if size <= self._part_size:
+            with FileSlice(path, 0, size, self._limiter) as body:
+                self._client.put_object(key, body, size)
+            return
+        if not task.upload_id:
+            task.upload_id = self._client.create_multipart_upload(key)
+            task.parts = ''
+            task.save(update_fields=('upload_id', 'parts'))
+        etags = task.parts.split()
+        for offset in range(len(etags) * self._part_size, size, self._part_size):
+            length = min(self._part_size, size - offset)
+            with FileSlice(path, offset, length, self._limiter) as body:
+                etags.append(self._client.upload_part(key, task.upload_id, len(etags) + 1, body, length))
+            task.parts = '\n'.join(etags)
+            task.save(update_fields=('parts',))
+        self._client.complete_multipart_upload(key, task.upload_id, etags)
+
+    def replicate(self, task: Replication) -> bool:
+        """Uploads a file of the queue and records the outcome. When it fails
+        the file is tried again later, waiting longer after each failure
+        :return whether the file was uploaded
+        """
+        try:
+            self.upload(task)
+            task.replicated = now()
+            task.error = ''
+            return True
+        except FileNotFoundError:
+            # Deleted by the storage policy before it could be uploaded
+            task.delete()
+            return False
+        except (IOError, http.client.HTTPException) as e:
+            task.attempts += 1
+            task.next_attempt = now() + min(timedelta(seconds=30 * 2 ** task.attempts), timedelta(hours=6))
+            task.error = str(e)
+            if isinstance(e, ReplicationError) and task.upload_id:
+                # The upload may have expired, start it again next time. The
+                # store keeps the parts of an upload until it is aborted
+                try:
+                    self._client.abort_multipart_upload(self.key(task.file), task.upload_id)
+                except (IOError, http.client.HTTPException):
+                    pass
+                task.upload_id = ''
+                task.parts = ''
+            return False
+        finally:
+            if task.pk is not None:
+                task.save()
+
+    def _replicate_in_worker(self, task: Replication) -> bool:
+        try:
+            return self.replicate(task)
+        finally:
+            # Each worker thread has its own database connection
+            connection.close()
+
+    def run(self) -> Tuple[int, int]:
+        """Uploads the files of the queue that are due, a few at a time
+        :return the number of files uploaded and the number that failed
+        """
+        tasks = list(Replication.objects.filter(replicated=None, next_attempt__lte=now()))
+        with ThreadPoolExecutor(self._concurrency) as executor:
+            results = list(executor.map(self._replicate_in_worker, tasks))
+        return results.count(True), results.count(False)
+
+    def prune(self, keep_days: int) -> int:
+        """Removes the local copy of the videos older than the given number
+        of days whose video and thumbnail are both replicated, the thumbnail
+        being replicated with the pack of its day when packed
+        :return the number of videos removed
+        """
+        limit = now() - timedelta(days=keep_days)
+        replicated = set(Replication.objects.exclude(replicated=None).values_list('file', flat=True))
+        removed = 0
+        for _, videos in self._file_manager.list_videos():
+            pack_files = [f for f in self.thumbnail_pack_files(basename(videos[0].file)) if os.path.exists(f)]
+            pack_replicated = all(basename(f) in replicated for f in pack_files)
+            for video in videos:
+                thumbnail_path = self._file_manager.complete_path(video.thumbnail)
+                if os.path.exists(thumbnail_path):
+                    thumbnail_replicated = basename(video.thumbnail) in replicated
+                else:
+                    thumbnail_replicated = pack_replicated
+                if video.timestamp < limit and basename(video.file) in replicated and thumbnail_replicated:
+                    self._file_manager.remove_even_thumbnail(self._file_manager.complete_path(video.file))
+                    removed += 1
+        if removed:
+            self._file_manager.bump_generation()
+        return removed
@@ -0,0 +1,88 @@
+import os
+import shutil
+
+from datetime import datetime
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.utils.timezone import utc
+
+from camera.activity import ActivityIndex
+from camera.capture import FileManager
+from camera.models import HourlyActivity, Recording
+
+
+class TestActivity(TestCase):
+
+    def setUp(self):
+        self.folder = os.path.join(os.path.dirname(__file__), 'activity')
+        os.makedirs(self.folder, exist_ok=True)
+        self.file_manager = FileManager(self.folder, sharded=False)
+        self.index = ActivityIndex(self.file_manager)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def log(self, added, name):
+        self.file_manager.log_activity(added, os.path.join(self.folder, name))
+
+    def activity(self):
+        return {hour.hour: (hour.recordings, hour.seconds) for hour in HourlyActivity.objects.all()}
+
+    def test_hours(self):
+        start = datetime(2018, 1, 31, 11, 59, 30, tzinfo=utc)
+        self.assertEqual(list(ActivityIndex.hours(start, 20)),
+                         [(datetime(2018, 1, 31, 11, tzinfo=utc), 20)])
+        self.assertEqual(list(ActivityIndex.hours(start, 3700)),
+                         [(datetime(2018, 1, 31, 11, tzinfo=utc), 30),
+                          (datetime(2018, 1, 31, 12, tzinfo=utc), 3600),
+                          (datetime(2018, 1, 31, 13, tzinfo=utc), 70)])
+
+    def test_update(self):
+        self.assertEqual(self.index.update(), 0)
+        self.log(True, '2018-01-31_115930_60.mp4')
+        self.log(True, '2018-01-31_120500_10.mp4')
+        self.log(True, '2018-01-31_120500_10.mp4.jpg')
+        self.assertEqual(self.index.update(), 2)
+        self.assertEqual(self.activity(),
+                         {datetime(2018, 1, 31, 11, tzinfo=utc): (1, 30),
+                          datetime(2018, 1, 31, 12, tzinfo=utc): (1, 40)})
+        # Only the new lines are read, the same video is not counted twice
+        self.log(True, '2018-01-31_120500_10.small.mp4')
+        self.log(False, '2018-01-31_120500_10.mp4')
+        self.log(False, '2018-01-31_115930_60.mp4')
+        self.assertEqual(self.index.update(), 3)
+        self.assertEqual(self.activity()[datetime(2018, 1, 31, 12, tzinfo=utc)], (1, 40))
+        self.assertEqual(list(Recording.objects.values_list('file', flat=True)),
+                         ['2018-01-31_120500_10.small.mp4'])
+
+    def test_partial_line(self):
+        self.log(True, '2018-01-31_120000_10.mp4')
+        with open(os.path.join(self.folder, FileManager.ACTIVITY_FILE), 'a') as f:
+            f.write('+2018-01-31_1300')
+        self.assertEqual(self.index.update(), 1)
+        with open(os.path.join(self.folder, FileManager.ACTIVITY_FILE), 'a') as f:
+            f.write('00_10.mp4\n')
+        self.assertEqual(self.index.update(), 1)
+        self.assertEqual(Recording.objects.count(), 2)
+
+    def test_rebuild(self):
+        self.log(True, '2018-01-30_120000_10.mp4')
+        self.index.update()
+        for name in ('2018-01-31_120000_10.mp4', '2018-01-31_121000_20.mp4'):
+            open(os.path.join(self.folder, name), 'w').close()
+        self.index.rebuild()
+        self.assertEqual(self.activity(), {datetime(2018, 1, 31, 12, tzinfo=utc): (2, 30)})
+        self.assertEqual(self.index.update(), 0)
+
+    def test_queries(self):
+        for name in ('2018-01-30_230000_10.mp4', '2018-01-31_120000_10.mp4', '2018-02-01_000000_10.mp4'):
+            self.log(True, name)
+        start, end = datetime(2018, 1, 31, tzinfo=utc), datetime(2018, 2, 1, tzinfo=utc)
+        self.assertEqual(self.index.heatmap(start, end), {datetime(2018, 1, 31, 12, tzinfo=utc): (1, 10)})
+        self.assertEqual([r.file for r in self.index.recordings(datetime(2018, 1, 30, tzinfo=utc), end)],
+                         ['2018-01-30_230000_10.mp4', '2018-01-31_120000_10.mp4'])
+        # Queries do not go through the capture folder
+        with patch.object(FileManager, 'list_videos') as list_videos:
+            self.index.recordings(start, end)
+            self.assertEqual(list_videos.call_count, 0)
@@ -0,0 +1,127 @@
+import json
+
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import monotonic, sleep
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from camera.aggregator import Node, fan_out, node_frame, timeline
+
+
+class SimulatedNodeHandler(BaseHTTPRequestHandler):
+    """Answers like the API of a tusacam node, after a delay
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        sleep(self.server.delay)
+        if self.headers['Authorization'] != 'Token secret':
+            self.send_response(403)
+            self.end_headers()
+            return
+        if self.path == '/api/videos':
+            body = json.dumps(dict(videos=self.server.videos)).encode()
+        else:
+            body = b'frame'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SimulatedNode(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, name, delay=0, videos=()):
+        super().__init__(('127.0.0.1', 0), SimulatedNodeHandler)
+        self.name = name
+        self.delay = delay
+        self.videos = list(videos)
+        self.requests = []
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def handle_error(self, request, client_address):
+        pass    # Clients that timed out are gone when the node answers
+
+    def node(self, token='secret'):
+        return Node(self.name, 'http://127.0.0.1:{}/'.format(self.server_port), token)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def video(timestamp):
+    return dict(timestamp=timestamp, file='{}_10.mp4'.format(timestamp[:17].replace(':', '')),
+                duration=10, thumbnail='x.jpg')
+
+
+class TestAggregator(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def simulate(self, *args, **kwargs):
+        server = SimulatedNode(*args, **kwargs)
+        self.servers.append(server)
+        return server.node()
+
+    def test_fan_out_parallel(self):
+        nodes = [self.simulate('node{}'.format(i), delay=.3) for i in range(4)]
+        started = monotonic()
+        responses = fan_out(nodes, 'still_frame', timeout=2)
+        self.assertLess(monotonic() - started, 1)
+        self.assertEqual(responses, {node.name: b'frame' for node in nodes})
+
+    def test_fan_out_timeout(self):
+        nodes = [self.simulate('fast'), self.simulate('slow', delay=1.5)]
+        started = monotonic()
+        responses = fan_out(nodes, 'still_frame', timeout=.5)
+        self.assertLess(monotonic() - started, 1.2)
+        self.assertEqual(responses, dict(fast=b'frame', slow=None))
+
+    def test_fan_out_errors(self):
+        self.simulate('a')
+        nodes = [self.servers[0].node('wrong'), Node('down', 'http://127.0.0.1:1', 'secret')]
+        self.assertEqual(fan_out(nodes, 'videos', timeout=1), dict(a=None, down=None))
+        self.assertEqual(fan_out([], 'videos'), dict())
+
+    def test_timeline(self):
+        garden = self.simulate('garden', videos=[video('2018-01-31T12:00:00+00:00'),
+                                                 video('2018-01-30T12:00:00+00:00')])
+        door = self.simulate('door', videos=[video('2018-01-31T13:00:00+00:00')])
+        down = Node('down', 'http://127.0.0.1:1', 'secret')
+        with self.settings(CAMERA_AGGREGATOR_TIMEOUT=1):
+            days, failed = timeline([garden, door, down])
+            self.assertEqual(failed, ['down'])
+            self.assertEqual([day.isoformat() for day, _ in days], ['2018-01-31', '2018-01-30'])
+            self.assertEqual([(name, v.duration) for name, v in days[0][1]],
+                             [('door', timedelta(seconds=10)), ('garden', timedelta(seconds=10))])
+            timeline([garden, door])
+        self.assertEqual(len(self.servers[0].requests), 1)
+
+    def test_node_frame(self):
+        node = self.simulate('garden')
+        self.assertEqual(node_frame(node, 'small'), b'frame')
+        self.assertEqual(node_frame(node, 'small'), b'frame')
+        self.assertEqual(self.servers[0].requests, ['/api/still_frame?size=small'])
+        with self.settings(CAMERA_AGGREGATOR_TIMEOUT=1):
+            self.assertIsNone(node_frame(Node('down', 'http://127.0.0.1:1', 'secret'), 'small'))
+
+    def test_node_get(self):
+        nodes = (dict(name='garden', url='http://garden', token='t'),)
+        with self.settings(CAMERA_AGGREGATOR_NODES=nodes):
+            self.assertEqual(Node.get('garden').url, 'http://garden')
+            self.assertIsNone(Node.get('door'))
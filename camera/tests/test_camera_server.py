@@ -1,19 +1,30 @@
+import io
+import json
 import os
 import pathlib
+import shutil
 import socket
 import struct
+import sys
 
+from multiprocessing import Process
+from time import monotonic, sleep
+from threading import Event, Timer
 from unittest.mock import Mock, patch
 
 from django.conf import settings
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.contrib.auth.models import User
 from django.test import TestCase
 
-from camera.capture import Capture, FileManager
+from camera.capture import Capture, FileManager, StreamBuffer
 from camera.client import CameraClient, FeedCommand
 from camera.management.commands.camera_server import Command
+from camera.management.commands.load_test import Command as LoadTestCommand, SimulatedCameraServer, percentile
+from camera.fmp4 import START_CODE
 from camera.models import CameraSettings
+from camera.tests.test_fmp4 import PPS, SPS, idr, p_slice
 
 
 class TestCameraServer(TestCase):
@@ -25,9 +36,12 @@ class TestCameraServer(TestCase):
 
     def tearDown(self):
         Capture.CAMERA_CONTENT_MANAGER = None
+        Capture.CAMERA_DAEMON = None
+        Capture.CAMERA_SETTINGS = None
+        Capture.CAMERA_HEARTBEAT.deadline = 0
 
-    def create_cmd_seq(self, a_cmd):
-        cmd = Mock(recv=Mock(return_value=a_cmd))
+    def create_cmd_seq(self, a_cmd, *args):
+        cmd = Mock(recv=Mock(side_effect=(a_cmd,) + args))
         srv_quit = Mock(recv=Mock(return_value=Command.SERVER_QUIT))
         return Mock(side_effect=[(c, 1) for c in (cmd, srv_quit)]), cmd
 
@@ -39,6 +53,64 @@ class TestCameraServer(TestCase):
             self.assertEqual(conn.close.call_count, 1)
             self.assertEqual(fake_sock.shutdown.call_count, 1)
             self.assertEqual(fake_sock.close.call_count, 1)
+            sent = conn.sendall.call_args[0][0]
+            health = json.loads(sent[4:].decode('utf-8'))
+            self.assertEqual(struct.unpack('I', sent[:4])[0], len(sent) - 4)
+            self.assertIn('stale', health)
+            self.assertIn('lag', health['heartbeat'])
+
+    def spawn_daemon(self):
+        """Starts a daemon that beats once and waits
+        """
+        Capture.CAMERA_HEARTBEAT.reset(settings.CAMERA_WATCHDOG_TIMEOUT)
+        Capture.CAMERA_DAEMON = Process(target=sleep, args=(10,), daemon=True)
+        Capture.CAMERA_DAEMON.start()
+        self.addCleanup(Capture.CAMERA_DAEMON.terminate)
+        Capture.CAMERA_HEARTBEAT.pulse(1)
+
+    def supervise(self, seconds: float) -> str:
+        stopped = Event()
+        Timer(seconds, stopped.set).start()
+        out = io.StringIO()
+        with patch.object(Capture, 'spawn_daemon', side_effect=self.spawn_daemon), \
+                patch.object(Command, 'WATCHDOG_INTERVAL', .01), \
+                self.settings(CAMERA_RESTART_BACKOFF=.01):
+            Command(stderr=out).supervise(stopped)
+        return out.getvalue()
+
+    def test_supervise_exit(self):
+        restarts = Capture.CAMERA_HEARTBEAT.restarts
+        Capture.CAMERA_DAEMON = Process(target=sys.exit, args=(3,))
+        Capture.CAMERA_DAEMON.start()
+        out = self.supervise(.3)
+        self.assertIn('Capture loop exited with code 3', out)
+        self.assertIn('Capture loop recovered', out)
+        self.assertEqual(Capture.CAMERA_HEARTBEAT.restarts, restarts + 1)
+        self.assertLess(Capture.CAMERA_HEARTBEAT.recovery, 1)
+        self.assertTrue(Capture.CAMERA_DAEMON.is_alive())
+
+    def test_supervise_stalled(self):
+        self.spawn_daemon()
+        stalled_daemon = Capture.CAMERA_DAEMON
+        Capture.CAMERA_HEARTBEAT.deadline -= settings.CAMERA_WATCHDOG_TIMEOUT + 1
+        out = self.supervise(.3)
+        # Told once, and replaced
+        self.assertEqual(out.count('Capture loop stalled'), 1)
+        self.assertFalse(stalled_daemon.is_alive())
+        self.assertIsNot(Capture.CAMERA_DAEMON, stalled_daemon)
+        self.assertFalse(Capture.CAMERA_HEARTBEAT.stalled)
+
+    def test_supervise_nothing(self):
+        Capture.CAMERA_DAEMON = None
+        self.assertEqual(self.supervise(0), '')
+
+    def test_restart_delay(self):
+        with self.settings(CAMERA_RESTART_BACKOFF=.5, CAMERA_RESTART_MAX_BACKOFF=30):
+            self.assertEqual(Command.restart_delay(0, 1), .5)
+            self.assertEqual(Command.restart_delay(.5, 1), 1)
+            self.assertEqual(Command.restart_delay(20, 1), 30)
+            # It was running fine
+            self.assertEqual(Command.restart_delay(30, 60), 0)
 
     def test_settings(self):
         while not Capture.CAMERA_SETTINGS_QUEUE.empty():
@@ -53,18 +125,147 @@ class TestCameraServer(TestCase):
         Capture.init_buffers()
         with patch('camera.management.commands.camera_server.socket.socket') as fake_sock:
             fake_sock = fake_sock.return_value
-            fake_sock.accept, _ = self.create_cmd_seq(Command.SERVER_LIVE_FEED)
+            fake_sock.accept, conn = self.create_cmd_seq(Command.SERVER_LIVE_FEED, b'\x00' + bytes(4))
             call_command('camera_server')
+            self.assertEqual(conn.sendall.call_args[0][0], bytearray(12))
+
+    def test_live_stream_none(self):
+        Capture.CAMERA_LIVE_STREAM = None
+        with patch('camera.management.commands.camera_server.Thread') as thread:
+            with patch('camera.management.commands.camera_server.socket.socket') as fake_sock:
+                fake_sock = fake_sock.return_value
+                fake_sock.accept, conn = self.create_cmd_seq(Command.SERVER_LIVE_STREAM)
+                call_command('camera_server')
+                # Served in its own thread, which closes the connection
+                self.assertEqual(conn.close.call_count, 0)
+                target = thread.call_args[1]['target']
+                target(*thread.call_args[1]['args'])
+                self.assertEqual(conn.sendall.call_args[0][0], bytearray(4))
+                self.assertEqual(conn.close.call_count, 1)
+
+    def test_live_stream(self):
+        Capture.CAMERA_LIVE_STREAM = StreamBuffer.allocate(10000)
+        try:
+            Capture.CAMERA_LIVE_STREAM.write(b''.join(START_CODE + n for n in (SPS, PPS, idr())), 0, 3000, True)
+            Capture.CAMERA_LIVE_STREAM.write(START_CODE + p_slice(), 3000, 3000, False)
+            conn = Mock(sendall=Mock(side_effect=(None, BrokenPipeError())))
+            command = Command()
+            command.quit = False
+            with patch.object(Command, 'STREAM_POLL_INTERVAL', 0):
+                command.live_stream(conn)
+            sent = [call[0][0] for call in conn.sendall.call_args_list]
+            self.assertEqual(len(sent), 2)
+            self.assertEqual(struct.unpack('I', sent[0][:4])[0], len(sent[0]) - 4)
+            self.assertEqual(sent[0][8:12], b'ftyp')
+            self.assertEqual(sent[1][8:12], b'moof')
+            self.assertEqual(conn.close.call_count, 1)
+        finally:
+            Capture.CAMERA_LIVE_STREAM = None
+
+    def set_buffers(self):
+        Capture.init_buffers()
+        live_feed = Capture.CAMERA_LIVE_FEEDS[1]
+        live_feed._buffer_index.value = 1
+        live_feed._sequence.value = 10
+        live_feed._frame_time.value = monotonic() - 2
+        live_feed._buffers[0][0:6] = struct.pack('I', 2) + bytearray((1, 2))
+        live_feed._buffers[1][0:6] = struct.pack('I', 2) + bytearray((3, 4))
+        return live_feed
 
     def test_live_feed_buffers(self):
+        live_feed = self.set_buffers()
+        Capture.CAMERA_SCENE_STATS.bytes_active = 0
+        with patch('camera.management.commands.camera_server.socket.socket') as fake_sock:
+            fake_sock = fake_sock.return_value
+            fake_sock.accept, conn = self.create_cmd_seq(Command.SERVER_LIVE_FEED,
+                                                         b'\x01' + struct.pack('I', 9))
+            call_command('camera_server')
+            self.assertEqual(live_feed._usage_counter.value, 0)
+            header_call, send_all_call = [c[0] for c in conn.sendall.call_args_list]
+            sequence, age = struct.unpack('II', header_call[0])
+            self.assertEqual(sequence, 10)
+            self.assertAlmostEqual(age, 2000, delta=500)
+            self.assertEqual(send_all_call[0], bytearray(live_feed._buffers[1][0:6]))
+            self.assertEqual(Capture.CAMERA_SCENE_STATS.bytes_active, 6)
+            self.assertLess(live_feed.read_age, 1)
+
+    def test_live_feed_known_sequence(self):
+        self.set_buffers()
+        with patch('camera.management.commands.camera_server.socket.socket') as fake_sock:
+            fake_sock = fake_sock.return_value
+            fake_sock.accept, conn = self.create_cmd_seq(Command.SERVER_LIVE_FEED,
+                                                         b'\x01' + struct.pack('I', 10))
+            call_command('camera_server')
+            self.assertEqual(conn.sendall.call_count, 1)
+            sequence, _, length = struct.unpack('III', conn.sendall.call_args[0][0])
+            self.assertEqual((sequence, length), (10, 0))
+
+    def test_live_feed_unknown_rendition(self):
         Capture.init_buffers()
-        Capture.CAMERA_CURRENT_FEED_BUFFER.value = 1
-        Capture.CAMERA_FEED_BUFFERS[0][0:6] = struct.pack('I', 2) + bytearray((1, 2))
-        Capture.CAMERA_FEED_BUFFERS[1][0:6] = struct.pack('I', 2) + bytearray((3, 4))
         with patch('camera.management.commands.camera_server.socket.socket') as fake_sock:
             fake_sock = fake_sock.return_value
-            fake_sock.accept, conn = self.create_cmd_seq(Command.SERVER_LIVE_FEED)
+            fake_sock.accept, conn = self.create_cmd_seq(Command.SERVER_LIVE_FEED, b'\xff' + bytes(4))
             call_command('camera_server')
-            self.assertEqual(Capture.CAMERA_CURRENT_FEED_USAGE.value, 0)
-            send_all_call = conn.sendall.call_args[0]
-            self.assertEqual(send_all_call[0], bytearray(Capture.CAMERA_FEED_BUFFERS[1][0:6]))
+            self.assertEqual(conn.sendall.call_args[0][0], bytearray(12))
+
+    def test_stats(self):
+        Capture.init_buffers()
+        with patch('camera.management.commands.camera_server.socket.socket') as fake_sock:
+            fake_sock = fake_sock.return_value
+            fake_sock.accept, conn = self.create_cmd_seq(Command.SERVER_STATS)
+            call_command('camera_server')
+            sent = conn.sendall.call_args[0][0]
+            length = struct.unpack('I', sent[:4])[0]
+            stats = json.loads(sent[4:4 + length].decode('utf-8'))
+            self.assertEqual(stats['feed_overflows'], 0)
+            self.assertEqual(set(stats['renditions']),
+                             set(name for name, _, _ in settings.CAMERA_PREVIEW_RENDITIONS))
+
+    def test_benchmark_feed(self):
+        out = io.StringIO()
+        call_command('benchmark_feed', frames=10, frame_size=1024,
+                     chunk_size=256, stdout=out)
+        self.assertIn('shared writer', out.getvalue())
+
+    def test_load_test(self):
+        user = User.objects.create(username='test', is_superuser=True)
+        out = io.StringIO()
+        # The test database is in memory, the server process cannot read the
+        # session from it
+        with patch('django.contrib.auth.middleware.auth.get_user', return_value=user):
+            call_command('load_test', recordings=3, recording_size=1024, duration=.2, concurrency=2,
+                         port=18765, camera_port=18766, stdout=out)
+        rows = {line.split()[0]: line.split()[1:] for line in out.getvalue().splitlines()}
+        for endpoint in ('still_frame', 'browse', 'media_file'):
+            requests, errors = rows[endpoint][:2]
+            self.assertGreater(int(requests), 0)
+            self.assertEqual(errors, '0')
+
+    def test_load_test_no_user(self):
+        with self.assertRaises(CommandError):
+            call_command('load_test', stdout=io.StringIO())
+
+    def test_simulated_camera_server(self):
+        process = Process(target=SimulatedCameraServer().run, args=(18767, 1024), daemon=True)
+        process.start()
+        self.addCleanup(process.terminate)
+        LoadTestCommand.wait_for(18767)
+        sleep(settings.CAMERA_PREVIEW_FREQ)
+        with self.settings(CAMERA_SERVER_PORT=18767):
+            feed = FeedCommand('small')
+        self.assertEqual(len(feed.response), 1024)
+
+    def test_percentile(self):
+        latencies = [i / 100 for i in range(1, 101)]
+        self.assertEqual([percentile(latencies, p) for p in (.5, .95, .99)], [.5, .95, .99])
+        self.assertEqual(percentile([.1], .99), .1)
+        self.assertIsNone(percentile([], .5))
+
+    def test_shard_capture_folder(self):
+        pathlib.Path(self.folder, '2018-01-31_120000_123.mp4').touch()
+        out = io.StringIO()
+        call_command('shard_capture_folder', folder=self.folder, delay=0, stdout=out)
+        self.assertIn('1 files moved', out.getvalue())
+        moved = pathlib.Path(self.folder, '2018', '01', '31', '2018-01-31_120000_123.mp4')
+        self.assertTrue(moved.exists())
+        shutil.rmtree(os.path.join(self.folder, '2018'))
@@ -1,16 +1,27 @@
+import ctypes
 import os
 import pathlib
 import picamera
+import shutil
 import struct
 
-from unittest.mock import Mock, patch
+from datetime import date, datetime
+from os.path import basename
+from time import sleep
+from unittest.mock import ANY, Mock, patch
 
 from django.conf import settings
 from django.test import SimpleTestCase, TestCase
 
 from camera.capture import Capture, FileManager, LiveFeed, capture_loop, GPIOInput, video_conversion
+from camera.capture import FrameTooLarge, SharedBufferWriter, Heartbeat, LivePreview, SceneMonitor
+from camera.capture import LiveStreamOutput, StagingArea, StreamBuffer, StreamReader, VideoCapture
+from camera.fmp4 import START_CODE, TIMESCALE
+from camera.clips import KeyframeIndex
+from camera.housekeeping import HousekeepingStats
+from camera.motion import MotionTrack
 from camera.models import CameraSettings
-from multiprocessing import Process, Queue
+from multiprocessing import Event, Process, Queue, RawArray, RawValue, active_children
 
 
 class TestGPIOInput(SimpleTestCase):
@@ -28,16 +39,23 @@ class TestGPIOInput(SimpleTestCase):
 
 class SimpleFileManager(FileManager):
 
-    def __init__(self):
+    def __init__(self, sharded=False):
         folder = os.path.join(os.path.dirname(__file__), 'capture')
         pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
-        super().__init__(folder)
+        super().__init__(folder, sharded)
 
     def clean_files(self):
         for f in pathlib.Path(self._folder).iterdir():
-            f.unlink()
+            if f.is_dir():
+                shutil.rmtree(str(f))
+            else:
+                try:
+                    f.unlink()
+                except FileNotFoundError:   # Removed by a conversion process
+                    pass
 
     def create_file(self, fname, size=1):
+        pathlib.Path(self._folder, fname).parent.mkdir(parents=True, exist_ok=True)
         with open(os.path.join(self._folder, fname), 'w') as f:
             f.write('1' * size)
 
@@ -55,6 +73,19 @@ class TestFileManager(SimpleTestCase):
         self.file_mngr.create_file('2018-31-31_120000_123.mp4')
         self.assertEqual(len(self.file_mngr.list_videos()), 0)
 
+    def test_list_videos_proxy(self):
+        self.file_mngr.create_file('2018-01-01_120000_123.mp4')
+        self.file_mngr.create_file('2018-01-01_120000_123.mp4.proxy.mp4')
+        self.file_mngr.create_file('2018-01-01_130000_10.mp4')
+        videos = self.file_mngr.list_videos()[0][1]
+        self.assertEqual([(v.file, v.proxy) for v in videos],
+                         [('2018-01-01_130000_10.mp4', None),
+                          ('2018-01-01_120000_123.mp4', '2018-01-01_120000_123.mp4.proxy.mp4')])
+        self.assertTrue(FileManager.is_finished(videos[1].proxy))
+        # It goes with its video
+        self.file_mngr.remove_even_thumbnail(self.file_mngr.complete_path(videos[1].file))
+        self.assertFalse(os.path.exists(self.file_mngr.complete_path(videos[1].proxy)))
+
     def test_storage_policy_empty(self):
         self.file_mngr.apply_storage_policy(1000, 16)
 
@@ -78,6 +109,25 @@ class TestFileManager(SimpleTestCase):
         self.assertTrue(pathlib.Path(self.file_mngr._folder, '2018-01-31_120000_123.mp4').exists())
         self.assertTrue(pathlib.Path(self.file_mngr._folder, '2018-01-15_120000_123.mp4').exists())
 
+    def test_storage_policy_timelapse(self):
+        self.file_mngr.create_file('2018-01-31_120000_123.mp4', 512 * 1024)
+        self.file_mngr.create_file('2018-01-31_timelapse.mp4', 256 * 1024)
+        self.file_mngr.create_file('2018-01-15_120000_123.mp4', 256 * 1024)
+        self.file_mngr.create_file('2018-01-15_timelapse.mp4', 256 * 1024)
+        self.file_mngr.create_file('2018-01-14_timelapse.mp4', 256 * 1024)
+        self.file_mngr.create_file('2018-01-01_timelapse.mp4', 256 * 1024)
+        self.assertEqual(self.file_mngr.list_timelapses()[-1],
+                         (date(2018, 1, 1), '2018-01-01_timelapse.mp4'))
+        self.assertTrue(FileManager.is_finished('2018-01-01_timelapse.mp4'))
+        self.file_mngr.apply_storage_policy(1, 20)
+        # Older than the days kept
+        self.assertFalse(pathlib.Path(self.file_mngr._folder, '2018-01-01_timelapse.mp4').exists())
+        # The oldest go first, a time-lapse after the recordings of its day
+        self.assertFalse(pathlib.Path(self.file_mngr._folder, '2018-01-14_timelapse.mp4').exists())
+        self.assertFalse(pathlib.Path(self.file_mngr._folder, '2018-01-15_120000_123.mp4').exists())
+        self.assertTrue(pathlib.Path(self.file_mngr._folder, '2018-01-15_timelapse.mp4').exists())
+        self.assertTrue(pathlib.Path(self.file_mngr._folder, '2018-01-31_120000_123.mp4').exists())
+
     def test_storage_policy_size_stat_error(self):
         self.file_mngr.create_file('2018-01-31_120000_123.mp4', 2 * 1024 * 1024)
         with patch('camera.capture.os.stat', side_effect=IOError):
@@ -91,6 +141,65 @@ class TestFileManager(SimpleTestCase):
         self.assertFalse(pathlib.Path(self.file_mngr._folder, '2018-01-01_120000_123.h264').exists())
         self.assertFalse(pathlib.Path(self.file_mngr._folder, '2018-01-01_120000_123.h264.jpg').exists())
 
+    def test_cleanup_before(self):
+        self.file_mngr.create_file('2018-01-01_120000.h264')
+        self.file_mngr.create_file('2018-01-01_110000_12.mp4.part')
+        old_path = self.file_mngr.complete_path('2018-01-01_110000_12.mp4.part')
+        os.utime(old_path, (1000, 1000))
+        self.file_mngr.cleanup(before=2000)
+        # The recording in progress is left alone
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(self.file_mngr.complete_path('2018-01-01_120000.h264')))
+
+    def test_generation(self):
+        self.assertEqual(self.file_mngr.generation(), (0, None))
+        self.file_mngr.bump_generation()
+        first, modified = self.file_mngr.generation()
+        self.assertGreater(first, 0)
+        self.assertIsNotNone(modified)
+        self.file_mngr.bump_generation()
+        self.assertGreater(self.file_mngr.generation()[0], first)
+
+    def test_storage_policy_generation(self):
+        self.file_mngr.create_file('2018-01-31_120000_123.mp4')
+        self.file_mngr.apply_storage_policy(1000, 16)
+        self.assertEqual(self.file_mngr.generation()[0], 0)
+        self.file_mngr.create_file('2018-01-01_120000_123.mp4')
+        self.file_mngr.apply_storage_policy(1000, 16)
+        self.assertGreater(self.file_mngr.generation()[0], 0)
+
+    def test_pack_thumbnail(self):
+        self.file_mngr.create_file('2018-01-31_120000.h264.jpg')
+        self.file_mngr.pack_thumbnail(self.file_mngr.complete_path('2018-01-31_120000.h264.jpg'),
+                                      '2018-01-31_120000_123.mp4')
+        self.assertFalse(pathlib.Path(self.file_mngr._folder, '2018-01-31_120000.h264.jpg').exists())
+        pack = self.file_mngr.thumbnail_pack('2018-01-31_120000_123.mp4')
+        self.assertEqual(pack.read('2018-01-31_120000'), b'1')
+        self.assertTrue(pack.pack_path.startswith(self.file_mngr._folder))
+
+    def test_storage_policy_thumbnail_pack(self):
+        self.file_mngr.create_file('2018-01-01_120000_123.mp4', 2 * 1024 * 1024)
+        self.file_mngr.create_file('2018-01-02_120000_123.mp4')
+        self.file_mngr.create_file('2018-01-31_120000_123.mp4')
+        for day in ('2018-01-01', '2018-01-02', '2018-01-31'):
+            self.file_mngr.thumbnail_pack(day).append('{}_120000'.format(day), b'1')
+        self.file_mngr.apply_storage_policy(1, 16)
+        self.assertEqual(self.file_mngr.thumbnail_pack('2018-01-01').entries(), [])
+        self.assertEqual(self.file_mngr.thumbnail_pack('2018-01-02').entries(), [])
+        self.assertEqual(len(self.file_mngr.thumbnail_pack('2018-01-31').entries()), 1)
+
+    def test_plan_storage(self):
+        self.assertIsNone(self.file_mngr.plan_storage(1000))
+        self.file_mngr.create_file('2018-01-01_120000_10.mp4', 1024 * 1024)
+        self.file_mngr.create_file('2018-01-03_120000_10.mp4', 1024 * 1024)
+        self.file_mngr.create_file('2018-01-03_130000_10.small.mp4', 1)
+        plan = self.file_mngr.plan_storage(10, 8)
+        self.assertEqual(plan['bytes_per_second'], 1024 * 1024 / 10)
+        self.assertEqual(plan['recordings_per_day'], 2 / 3)
+        self.assertEqual(plan['seconds_per_day'], 20 / 3)
+        self.assertAlmostEqual(plan['days'], 15)
+        self.assertAlmostEqual(plan['days_at_bitrate'], 10 * 1024 * 1024 / (1000 * 20 / 3))
+
     def test_path_functions(self):
         self.assertTrue(self.file_mngr.new_filename().endswith('.h264'))
         complete_path = self.file_mngr.complete_path('test')
@@ -98,36 +207,674 @@ class TestFileManager(SimpleTestCase):
         self.assertTrue(complete_path.endswith('test'))
 
 
+class TestShardedFileManager(SimpleTestCase):
+
+    def setUp(self):
+        self.file_mngr = SimpleFileManager(sharded=True)
+
+    def tearDown(self):
+        self.file_mngr.clean_files()
+
+    def exists(self, *path):
+        return pathlib.Path(self.file_mngr._folder, *path).exists()
+
+    def test_path_functions(self):
+        new_file = self.file_mngr.new_filename()
+        self.assertTrue(new_file.endswith('.h264'))
+        self.assertEqual(len(pathlib.Path(new_file).relative_to(self.file_mngr._folder).parts), 4)
+        self.assertTrue(pathlib.Path(new_file).parent.is_dir())
+        self.assertEqual(self.file_mngr.complete_path('2018-01-31_120000_123.mp4'),
+                         os.path.join(self.file_mngr._folder, '2018', '01', '31', '2018-01-31_120000_123.mp4'))
+        self.assertEqual(self.file_mngr.complete_path('test'),
+                         os.path.join(self.file_mngr._folder, 'test'))
+
+    def test_list_videos(self):
+        self.file_mngr.create_file('2018/01/31/2018-01-31_120000_123.mp4')
+        self.file_mngr.create_file('2018-01-30_120000_123.mp4')
+        videos = self.file_mngr.list_videos()
+        self.assertEqual(len(videos), 2)
+        self.assertEqual(videos[0][1][0].file, '2018/01/31/2018-01-31_120000_123.mp4')
+        self.assertEqual(videos[0][1][0].thumbnail, '2018/01/31/2018-01-31_120000_123.mp4.jpg')
+        self.assertEqual(videos[1][1][0].file, '2018-01-30_120000_123.mp4')
+
+    def test_resolve(self):
+        self.file_mngr.create_file('2018-01-30_120000_123.mp4')
+        self.file_mngr.create_file('2018/01/31/2018-01-31_120000_123.mp4')
+        self.assertEqual(self.file_mngr.resolve('2018/01/30/2018-01-30_120000_123.mp4'),
+                         os.path.join(self.file_mngr._folder, '2018-01-30_120000_123.mp4'))
+        self.assertEqual(self.file_mngr.resolve('2018-01-31_120000_123.mp4'),
+                         os.path.join(self.file_mngr._folder, '2018', '01', '31', '2018-01-31_120000_123.mp4'))
+
+    def test_storage_policy_age(self):
+        self.file_mngr.create_file('2018/01/01/2018-01-01_120000_123.mp4')
+        self.file_mngr.create_file('2018/01/01/2018-01-01_120000_123.mp4.jpg')
+        self.file_mngr.create_file('2018/01/31/2018-01-31_120000_123.mp4')
+        self.file_mngr.apply_storage_policy(1000, 16)
+        self.assertFalse(self.exists('2018', '01', '01'))
+        self.assertTrue(self.exists('2018', '01', '31', '2018-01-31_120000_123.mp4'))
+
+    def test_storage_policy_size(self):
+        self.file_mngr.create_file('2018/01/31/2018-01-31_120000_123.mp4', 256 * 1024)
+        self.file_mngr.create_file('2018/01/02/2018-01-02_120000_123.mp4', 2 * 1024 * 1024)
+        self.file_mngr.create_file('2017/12/31/2017-12-31_120000_123.mp4', 2 * 1024 * 1024)
+        self.file_mngr.apply_storage_policy(1, 1000)
+        self.assertFalse(self.exists('2017'))
+        self.assertFalse(self.exists('2018', '01', '02'))
+        self.assertTrue(self.exists('2018', '01', '31', '2018-01-31_120000_123.mp4'))
+
+    def test_storage_policy_size_day_in_use(self):
+        self.file_mngr.create_file('2018/01/31/2018-01-31_120000_123.mp4', 256 * 1024)
+        self.file_mngr.create_file('2018/01/02/2018-01-02_120000_123.mp4', 2 * 1024 * 1024)
+        self.file_mngr.create_file('2018/01/02/2018-01-02_130000.h264')
+        self.file_mngr.create_file('2018/01/02/2018-01-02_110000_123.mp4.part')
+        self.file_mngr.apply_storage_policy(1, 1000)
+        self.assertFalse(self.exists('2018', '01', '02', '2018-01-02_120000_123.mp4'))
+        self.assertTrue(self.exists('2018', '01', '02', '2018-01-02_130000.h264'))
+        self.assertTrue(self.exists('2018', '01', '02', '2018-01-02_110000_123.mp4.part'))
+
+    def test_remove_current_day(self):
+        self.file_mngr.create_file('2018/01/02/2018-01-02_120000_123.mp4')
+        self.file_mngr.create_file('2018/01/02/other.txt')
+        with patch('camera.capture.now', return_value=datetime(2018, 1, 2, 15)):
+            self.file_mngr.remove_day(self.file_mngr.list_videos()[0][1])
+        self.assertFalse(self.exists('2018', '01', '02', '2018-01-02_120000_123.mp4'))
+        self.assertTrue(self.exists('2018', '01', '02', 'other.txt'))
+
+    def test_shard_files(self):
+        self.file_mngr.create_file('2018-01-31_120000_123.mp4')
+        self.file_mngr.create_file('2018-01-31_120000_123.mp4.jpg')
+        self.file_mngr.create_file('2018-01-31_130000.h264')
+        self.file_mngr.create_file('2018-01-31_110000_123.mp4.part')
+        self.file_mngr.create_file('2018-01-31_100000_123.mp4.keyframes.1234')
+        self.file_mngr.create_file('2018-01-31_100000_123.mp4.motion.1234')
+        self.file_mngr.create_file('other.txt')
+        self.assertEqual(self.file_mngr.shard_files(), 2)
+        self.assertTrue(self.exists('2018-01-31_110000_123.mp4.part'))
+        self.assertTrue(self.exists('2018-01-31_100000_123.mp4.keyframes.1234'))
+        self.assertTrue(self.exists('2018-01-31_100000_123.mp4.motion.1234'))
+        self.assertTrue(self.exists('2018', '01', '31', '2018-01-31_120000_123.mp4'))
+        self.assertTrue(self.exists('2018', '01', '31', '2018-01-31_120000_123.mp4.jpg'))
+        self.assertTrue(self.exists('2018-01-31_130000.h264'))
+        self.assertTrue(self.exists('other.txt'))
+
+
+class TestSharedBufferWriter(SimpleTestCase):
+
+    def setUp(self):
+        self.buffer = RawArray(ctypes.c_byte, 10)
+        self.writer = SharedBufferWriter(self.buffer)
+
+    def test_write_and_seal(self):
+        self.writer.write(b'\x01\x02')
+        self.writer.write(b'\xff')
+        self.assertEqual(self.writer.seal(), 3)
+        self.assertEqual(bytes(memoryview(self.buffer).cast('B')[:7]),
+                         struct.pack('I', 3) + b'\x01\x02\xff')
+
+    def test_rewind(self):
+        self.writer.write(b'\x01\x02')
+        self.writer.rewind()
+        self.writer.write(b'\x03')
+        self.assertEqual(self.writer.seal(), 1)
+        self.assertEqual(bytes(memoryview(self.buffer).cast('B')[4:5]), b'\x03')
+
+    def test_overflow(self):
+        self.writer.write(b'1' * 6)
+        with self.assertRaises(FrameTooLarge):
+            self.writer.write(b'1')
+
+
 class TestLiveFeed(SimpleTestCase):
 
     def setUp(self):
         super().setUp()
-        Capture.init_buffers()
-        self.live_feed = LiveFeed(Capture.CAMERA_CURRENT_FEED_LOCK,
-                                  Capture.CAMERA_CURRENT_FEED_USAGE,
-                                  Capture.CAMERA_CURRENT_FEED_BUFFER,
-                                  Capture.CAMERA_FEED_BUFFERS)
+        self.live_feed = LiveFeed.allocate(64)
+        self.buffer_index = self.live_feed._buffer_index
+        self.usage_counter = self.live_feed._usage_counter
         self.camera = Mock()
 
     def test_capture_frame_no_buffer_index(self):
         self.live_feed.capture_frame(self.camera)
-        self.assertEqual(Capture.CAMERA_CURRENT_FEED_BUFFER.value, 0)
+        self.assertEqual(self.buffer_index.value, 0)
         self.assertEqual(self.camera.capture.call_count, 1)
 
     def test_capture_usage_counter_not_zero(self):
-        Capture.CAMERA_CURRENT_FEED_BUFFER.value = 0
-        Capture.CAMERA_CURRENT_FEED_USAGE.value = 1
+        self.buffer_index.value = 0
+        self.usage_counter.value = 1
         self.live_feed.capture_frame(self.camera)
-        self.assertEqual(Capture.CAMERA_CURRENT_FEED_BUFFER.value, 0)
+        self.assertEqual(self.buffer_index.value, 0)
         self.assertEqual(self.camera.capture.call_count, 0)
 
     def test_capture_usage_counter_zero(self):
-        Capture.CAMERA_CURRENT_FEED_BUFFER.value = 0
-        Capture.CAMERA_CURRENT_FEED_USAGE.value = 0
+        self.buffer_index.value = 0
+        self.usage_counter.value = 0
         self.live_feed.capture_frame(self.camera)
-        self.assertEqual(Capture.CAMERA_CURRENT_FEED_BUFFER.value, 1)
+        self.assertEqual(self.buffer_index.value, 1)
         self.assertEqual(self.camera.capture.call_count, 1)
 
+    def test_capture_frame_overflow(self):
+        self.buffer_index.value = 0
+        too_big = b'1' * self.live_feed.buffer_size
+        self.camera.capture = Mock(side_effect=lambda output, *args, **kwargs: output.write(too_big))
+        self.live_feed.capture_frame(self.camera)
+        self.assertEqual(self.buffer_index.value, 0)
+        self.assertEqual(self.live_feed.overflows, 1)
+
+    def test_capture_frame_into_buffer(self):
+        self.camera.capture = Mock(side_effect=lambda output, *args, **kwargs: output.write(b'\x01\x02'))
+        self.live_feed.capture_frame(self.camera)
+        self.assertEqual(self.buffer_index.value, 0)
+        with self.live_feed.latest_snapshot() as snapshot:
+            self.assertEqual(bytes(snapshot), struct.pack('I', 2) + b'\x01\x02')
+            self.assertEqual(self.usage_counter.value, 1)
+        self.assertEqual(self.usage_counter.value, 0)
+
+    def test_latest_snapshot_none(self):
+        with self.live_feed.latest_snapshot() as snapshot:
+            self.assertIsNone(snapshot)
+
+    def test_latest_snapshot_locked(self):
+        self.live_feed.capture_frame(self.camera)
+        with self.live_feed._usage_lock:
+            with self.live_feed.latest_snapshot(timeout=.01) as snapshot:
+                self.assertIsNone(snapshot)
+        self.assertEqual(self.usage_counter.value, 0)
+
+    def test_capture_frame_resized(self):
+        live_feed = LiveFeed.allocate(64, quality=50, resize=(160, 120))
+        live_feed.capture_frame(self.camera)
+        self.assertEqual(self.camera.capture.call_args[1]['resize'], (160, 120))
+        self.assertEqual(self.camera.capture.call_args[1]['quality'], 50)
+
+    def test_age(self):
+        self.assertIsNone(self.live_feed.age)
+        self.live_feed.capture_frame(self.camera)
+        self.assertLess(self.live_feed.age, 1)
+        self.live_feed._frame_time.value -= 5
+        self.assertGreaterEqual(self.live_feed.age, 5)
+        # Found unchanged, so still live
+        self.live_feed.confirm()
+        self.assertLess(self.live_feed.age, 1)
+
+
+class TestSceneMonitor(SimpleTestCase):
+
+    def probe_camera(self, *values):
+        def capture(output, *args, **kwargs):
+            output[:] = values[camera.capture.call_count - 1]
+        camera = Mock()
+        camera.capture = Mock(side_effect=capture)
+        return camera
+
+    def test_changed(self):
+        camera = self.probe_camera(10, 11, 60)
+        monitor = SceneMonitor((64, 48), 3)
+        self.assertTrue(monitor.changed(camera))
+        self.assertFalse(monitor.changed(camera))
+        self.assertTrue(monitor.changed(camera))
+        self.assertEqual(camera.capture.call_args[0][1], 'yuv')
+        self.assertEqual(camera.capture.call_args[1]['resize'], (64, 48))
+
+    def test_slow_change(self):
+        camera = self.probe_camera(10, 12, 14, 16, 18)
+        monitor = SceneMonitor((64, 48), 3)
+        self.assertTrue(monitor.changed(camera))
+        # Small steps that add up
+        self.assertEqual([monitor.changed(camera) for _ in range(4)], [False, True, False, True])
+
+
+class TestLivePreview(SimpleTestCase):
+
+    def setUp(self):
+        self.live_feed = Mock(read_age=0)
+        self.scene_monitor = Mock()
+        self.heartbeat = Mock()
+        self.preview = LivePreview([self.live_feed], self.scene_monitor, heartbeat=self.heartbeat)
+        self.camera = Mock()
+
+    def test_no_scene_monitor(self):
+        preview = LivePreview([self.live_feed])
+        preview.capture_frame(self.camera)
+        preview.capture_frame(self.camera)
+        self.assertEqual(self.live_feed.capture_frame.call_count, 2)
+
+    def test_static_scene(self):
+        self.scene_monitor.changed = Mock(return_value=False)
+        with patch('camera.capture.monotonic', side_effect=(100, 100.5, 101, 102, 103)):
+            for i in range(5):
+                self.preview.capture_frame(self.camera)
+        # Probes at 100, 101 and 103 as the interval grows from .5 to 2
+        self.assertEqual(self.scene_monitor.changed.call_count, 3)
+        # Published once as it is watched, then only confirmed
+        self.assertEqual(self.live_feed.capture_frame.call_count, 1)
+        self.assertEqual(self.live_feed.confirm.call_count, 2)
+        self.assertTrue(self.preview._stats.static)
+        self.assertEqual(self.preview._stats.deduplicated, 3)
+
+    def test_scene_change(self):
+        self.scene_monitor.changed = Mock(side_effect=(False, False, True, True))
+        with patch('camera.capture.monotonic', side_effect=(100, 101, 103, 103.5)):
+            for i in range(4):
+                self.preview.capture_frame(self.camera)
+        # Also published on the first probe, as it is watched
+        self.assertEqual(self.live_feed.capture_frame.call_count, 3)
+        self.assertFalse(self.preview._stats.static)
+        self.assertEqual(self.preview._stats.published, 2)
+        self.assertGreater(self.preview._stats.time_static, 0)
+
+    def test_activate(self):
+        self.scene_monitor.changed = Mock(return_value=False)
+        with patch('camera.capture.monotonic', side_effect=(100, 101, 101.1)):
+            self.preview.capture_frame(self.camera)
+            self.preview.capture_frame(self.camera)
+            self.preview.activate()
+            self.preview.capture_frame(self.camera)
+        self.assertEqual(self.scene_monitor.changed.call_count, 3)
+
+    def test_idle_rendition(self):
+        idle_feed = Mock(read_age=settings.CAMERA_PREVIEW_IDLE_AFTER + 1)
+        preview = LivePreview([self.live_feed, idle_feed], self.scene_monitor, heartbeat=self.heartbeat)
+        self.scene_monitor.changed = Mock(side_effect=(True, True, False, True))
+        with patch('camera.capture.monotonic', side_effect=(100, 101, 102, 104)):
+            for i in range(4):
+                preview.capture_frame(self.camera)
+        self.assertEqual(self.live_feed.capture_frame.call_count, 3)
+        # Only every CAMERA_PREVIEW_STATIC_FREQ seconds
+        self.assertEqual(idle_feed.capture_frame.call_count, 2)
+        # The idle rendition missed the change before the static probe, so
+        # it is not confirmed
+        self.assertEqual(self.live_feed.confirm.call_count, 1)
+        self.assertEqual(idle_feed.confirm.call_count, 0)
+
+    def test_idle_rendition_watched_static(self):
+        idle_feed = Mock(read_age=settings.CAMERA_PREVIEW_IDLE_AFTER + 1)
+        preview = LivePreview([self.live_feed, idle_feed], self.scene_monitor, heartbeat=self.heartbeat)
+        self.scene_monitor.changed = Mock(side_effect=(True, True, False, False))
+        with patch('camera.capture.monotonic', side_effect=(100, 101, 102, 104)):
+            preview.capture_frame(self.camera)
+            preview.capture_frame(self.camera)
+            # A viewer starts watching it while the scene stays the same
+            idle_feed.read_age = 0
+            preview.capture_frame(self.camera)
+            preview.capture_frame(self.camera)
+        self.assertEqual(idle_feed.capture_frame.call_count, 2)
+        self.assertEqual(idle_feed.confirm.call_count, 1)
+
+    def test_heartbeat(self):
+        preview = LivePreview([self.live_feed], heartbeat=self.heartbeat)
+        preview.capture_frame(self.camera)
+        self.heartbeat.pulse.assert_called_once_with(
+            max(settings.CAMERA_PREVIEW_FREQ, settings.MOTION_SENSOR_TIMEOUT / 1000))
+
+
+class TestHeartbeat(SimpleTestCase):
+
+    def setUp(self):
+        self.heartbeat = Heartbeat()
+
+    def test_not_started(self):
+        self.assertEqual(self.heartbeat.overdue(), 0)
+        self.assertFalse(self.heartbeat.check(10))
+        self.assertIsNone(self.heartbeat.as_dict()['age'])
+
+    def test_pulse(self):
+        with patch('camera.capture.monotonic', side_effect=(100, 101, 102.5, 103)):
+            self.heartbeat.reset(10)
+            self.heartbeat.pulse(1)
+            self.heartbeat.pulse(1)
+            self.assertEqual(self.heartbeat.overdue(), 0)
+        self.assertEqual(self.heartbeat.beats, 2)
+        self.assertEqual(self.heartbeat.lag, .5)
+        self.assertEqual(self.heartbeat.max_lag, .5)
+
+    def test_check(self):
+        with patch('camera.capture.monotonic', side_effect=(100, 100, 121, 122, 122, 123)):
+            self.heartbeat.reset(10)
+            # Still starting
+            self.assertFalse(self.heartbeat.check(10))
+            self.assertTrue(self.heartbeat.check(10))
+            # Flagged once
+            self.assertFalse(self.heartbeat.check(10))
+            self.heartbeat.pulse(1)
+            self.assertFalse(self.heartbeat.check(10))
+        self.assertFalse(self.heartbeat.stalled)
+        self.assertEqual(self.heartbeat.stalls, 1)
+        # The startup did not count as lag
+        self.assertEqual(self.heartbeat.lag, 0)
+
+
+class TestStreamBuffer(SimpleTestCase):
+
+    def setUp(self):
+        self.stream = StreamBuffer.allocate(100)
+
+    def write(self, *frames):
+        for timestamp, (frame, keyframe) in enumerate(frames):
+            self.stream.write(frame, timestamp * TIMESCALE, TIMESCALE, keyframe)
+
+    def test_empty(self):
+        self.assertEqual(StreamReader(self.stream).read(), [])
+        # Frames before the first key frame cannot be decoded
+        self.write((b'p', False))
+        self.assertEqual(StreamReader(self.stream).read(), [])
+
+    def test_read_from_keyframe(self):
+        self.write((b'i1', True), (b'p1', False), (b'i2', True), (b'p2', False))
+        reader = StreamReader(self.stream, max_lag=10)
+        self.assertEqual(reader.read(), [(b'i2', 2 * TIMESCALE, TIMESCALE, True),
+                                         (b'p2', 3 * TIMESCALE, TIMESCALE, False)])
+        self.assertEqual(reader.read(), [])
+        self.stream.write(b'p3', 4 * TIMESCALE, TIMESCALE, False)
+        self.assertEqual([f[0] for f in reader.read()], [b'p3'])
+
+    def test_wrap_around(self):
+        reader = StreamReader(self.stream, max_lag=100)
+        frames = []
+        for i in range(20):
+            self.stream.write(bytes((i,)) * 10, i, 1, i % 3 == 0)
+            frames.extend(f[0] for f in reader.read())
+        self.assertEqual(frames, [bytes((i,)) * 10 for i in range(20)])
+        self.assertEqual(reader.skips, 0)
+        self.assertEqual(self.stream.frames, 20)
+
+    def test_overwritten(self):
+        reader = StreamReader(self.stream, max_lag=100)
+        self.stream.write(b'0' * 10, 0, 1, True)
+        self.assertEqual(len(reader.read()), 1)
+        for i in range(1, 10):
+            self.stream.write(bytes((i,)) * 10, i, 1, i == 7)
+        # Frames 1 to 6 are gone, it goes on from the latest key frame
+        self.assertEqual([f[1] for f in reader.read()], [7, 8, 9])
+        self.assertEqual(reader.skips, 1)
+
+    def test_lag(self):
+        self.write((b'i1', True), (b'p1', False), (b'p2', False))
+        reader = StreamReader(self.stream, max_lag=1)
+        self.write((b'i1', True), (b'p1', False), (b'p2', False), (b'i2', True), (b'p3', False))
+        self.assertEqual([f[0] for f in reader.read()], [b'i2', b'p3'])
+
+    def test_frame_too_large(self):
+        self.stream.write(b'0' * 100, 0, 1, True)
+        self.assertEqual(self.stream.frames, 0)
+
+    def test_output(self):
+        stream = StreamBuffer.allocate(1000)
+        output = LiveStreamOutput(stream)
+        for nal_unit in (b'\x67\x42', b'\x68\xce', b'\x65\x88\x01', b'\x41\x9a\x01', b'\x41\x9a\x02'):
+            output.write(START_CODE + nal_unit)
+        frames = StreamReader(stream).read()
+        self.assertEqual([(f[0], f[3]) for f in frames],
+                         [(START_CODE + b'\x67\x42' + START_CODE + b'\x68\xce' + START_CODE + b'\x65\x88\x01', True),
+                          (START_CODE + b'\x41\x9a\x01', False)])
+
+
+class TestStagingArea(SimpleTestCase):
+
+    def setUp(self):
+        self.file_manager = SimpleFileManager()
+        self.folder = os.path.join(os.path.dirname(__file__), 'staging')
+        self.staging = StagingArea(self.folder, 1)
+
+    def tearDown(self):
+        self.file_manager.clean_files()
+        shutil.rmtree(self.folder)
+
+    def stats(self):
+        return self.staging._stats.get_obj().as_dict()
+
+    def stage_file(self, name, size):
+        with open(os.path.join(self.folder, name), 'wb') as f:
+            f.write(b'1' * size)
+        return os.path.join(self.folder, name)
+
+    def test_disabled(self):
+        staging = StagingArea('', 1)
+        self.assertFalse(staging.enabled)
+        self.assertIsNone(staging.path(self.file_manager.complete_path('a.h264'), 0))
+        self.assertEqual(staging._stats.get_obj().fallbacks, 0)
+
+    def test_path(self):
+        card_path = self.file_manager.complete_path('a.h264')
+        self.assertEqual(self.staging.path(card_path, 1000), os.path.join(self.folder, 'a.h264'))
+        self.assertTrue(self.staging.staged(self.staging.path(card_path, 1000)))
+        self.assertFalse(self.staging.staged(card_path))
+        self.stage_file('b.h264', 1024 * 1024 - 1000)
+        self.assertEqual(self.staging.room(), 1000)
+        self.assertIsNone(self.staging.path(card_path, 1001))
+        self.assertEqual(self.stats()['fallbacks'], 1)
+
+    def test_flush(self):
+        staged_path = self.stage_file('a.mp4', 3000)
+        self.staging.flush(staged_path, self.file_manager.complete_path('a.mp4'))
+        self.assertFalse(os.path.exists(staged_path))
+        self.assertEqual(os.path.getsize(self.file_manager.complete_path('a.mp4')), 3000)
+        self.file_manager.create_file('b.mp4', 500)
+        self.staging.written(self.file_manager.complete_path('b.mp4'))
+        stats = self.stats()
+        self.assertEqual((stats['bytes_written'], stats['flushes'], stats['direct_writes']), (3500, 1, 1))
+        self.assertEqual(stats['mean_flush_seconds'], stats['flush_seconds'])
+
+    def test_clear(self):
+        self.stage_file('a.h264', 10)
+        self.staging.clear()
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_video_conversion(self):
+        capture_file = self.stage_file('a.h264', 2000)
+        full_video_fname = self.file_manager.complete_path('a.mp4')
+
+        def ffmpeg(command):
+            # Converted in the staging folder too
+            self.assertEqual(command[-1], os.path.join(self.folder, 'a.mp4' + FileManager.PARTIAL_SUFFIX))
+            self.stage_file(basename(command[-1]), 1500)
+
+        with patch('camera.capture.subprocess.run', side_effect=ffmpeg):
+            with patch.object(KeyframeIndex, 'build'):
+                video_conversion(1, capture_file, full_video_fname, staging=self.staging)
+        self.assertEqual(os.listdir(self.folder), [])
+        self.assertEqual(os.path.getsize(full_video_fname), 1500)
+        self.assertEqual(self.stats()['bytes_written'], 1500)
+
+    def test_video_conversion_card_part(self):
+        capture_file = self.stage_file('a.h264', 1024 * 1024 - 1000)
+        self.file_manager.create_file('a.h264', 2000)
+        card_part = self.file_manager.complete_path('a.h264')
+        with patch('camera.capture.subprocess.run') as run:
+            video_conversion(1, capture_file, self.file_manager.complete_path('a.mp4'),
+                             staging=self.staging, card_part=card_part)
+            command = run.call_args[0][0]
+        # Both parts are converted together, and written to the card as
+        # they do not fit in the staging folder
+        self.assertEqual(command[command.index('-i') + 1], 'concat:{}|{}'.format(capture_file, card_part))
+        self.assertEqual(command[-1], self.file_manager.complete_path('a.mp4' + FileManager.PARTIAL_SUFFIX))
+        self.assertFalse(os.path.exists(capture_file) or os.path.exists(card_part))
+        stats = self.stats()
+        self.assertEqual((stats['bytes_written'], stats['fallbacks']), (2000, 1))
+
+    def test_video_capture_proxy(self):
+        camera = Mock(framerate=25)
+        capture = VideoCapture(camera, 1, self.file_manager, Mock(), dict(bitrate=1000000), self.staging)
+        card_path = self.file_manager.complete_path('a.h264')
+        with self.settings(CAMERA_PROXY=dict(resize=(640, 360), bitrate=500000)):
+            with patch.object(FileManager, 'new_filename', return_value=card_path):
+                capture.start_recording()
+            self.assertEqual(camera.start_recording.call_args,
+                             ((os.path.join(self.folder, 'a.proxy.h264'),),
+                              dict(splitter_port=2, resize=(640, 360), bitrate=500000)))
+            # Both go on on the card
+            self.stage_file('other', 1024 * 1024)
+            capture.spill()
+            self.assertEqual(camera.split_recording.call_args,
+                             ((self.file_manager.complete_path('a.proxy.h264'),), dict(splitter_port=2)))
+            self.stage_file('a.h264.jpg', 10)
+            with patch('camera.capture.Process') as process:
+                capture.stop_recording()
+        self.assertEqual(camera.stop_recording.call_args_list[0], ((), dict(splitter_port=2)))
+        args = process.call_args[1]['args']
+        self.assertEqual(args[1], os.path.join(self.folder, 'a.proxy.h264'))
+        self.assertTrue(args[2].endswith('.mp4' + FileManager.PROXY_SUFFIX))
+        self.assertEqual(args[5:], (self.file_manager.complete_path('a.proxy.h264'), False))
+
+    def test_video_capture_proxy_spill(self):
+        camera = Mock(framerate=25)
+        capture = VideoCapture(camera, 1, self.file_manager, Mock(), dict(bitrate=1000000), self.staging)
+        card_path = self.file_manager.complete_path('a.h264')
+        with self.settings(CAMERA_PROXY=dict(bitrate=500000)):
+            # Room for the proxy only
+            self.stage_file('other', 1024 * 1024 - self.staging.headroom(1000000) + 1)
+            with patch.object(FileManager, 'new_filename', return_value=card_path):
+                capture.start_recording()
+            self.assertEqual(camera.start_recording.call_args_list[0][0], (card_path,))
+            self.assertEqual(camera.start_recording.call_args_list[1][0],
+                             (os.path.join(self.folder, 'a.proxy.h264'),))
+            capture.spill()
+            self.assertEqual(camera.split_recording.call_count, 0)
+            # The proxy fills the staging folder, it goes on on the card alone
+            self.stage_file('a.proxy.h264', self.staging.headroom(1000000) - self.staging.headroom(500000))
+            capture.spill()
+            camera.split_recording.assert_called_once_with(self.file_manager.complete_path('a.proxy.h264'),
+                                                           splitter_port=2)
+
+    def test_video_capture_motion_track(self):
+        camera = Mock(framerate=25)
+        capture = VideoCapture(camera, 1, self.file_manager, Mock(), dict(bitrate=1000000), self.staging)
+        with self.settings(CAMERA_RESOLUTION=(64, 32)):
+            with patch.object(FileManager, 'new_filename', return_value=self.file_manager.complete_path('a.h264')):
+                capture.start_recording()
+        output = camera.start_recording.call_args[1]['motion_output']
+        output.write(bytes(10 * 4))
+        capture.motion_detected()
+        output.write(bytes(10 * 4 * 2))
+        self.stage_file('a.h264.jpg', 10)
+        with patch('camera.capture.Process'):
+            capture.stop_recording()
+        track_files = self.file_manager.glob('*' + MotionTrack.SUFFIX)
+        self.assertEqual(len(track_files), 1)
+        track = MotionTrack.load(str(track_files[0]))
+        self.assertEqual((track.framerate, track.sensor_times()), (25, [0, 0.04]))
+        self.assertTrue(FileManager.is_finished('2018-01-01_120000_123.mp4' + MotionTrack.SUFFIX))
+        # It goes with its video
+        self.file_manager.remove_even_thumbnail(str(track_files[0])[:-len(MotionTrack.SUFFIX)])
+        self.assertFalse(track_files[0].exists())
+
+    def test_video_capture_spill(self):
+        camera = Mock(framerate=25)
+        capture = VideoCapture(camera, 1, self.file_manager, Mock(), dict(bitrate=1000000), self.staging)
+        with patch.object(FileManager, 'new_filename', return_value=self.file_manager.complete_path('a.h264')):
+            capture.start_recording()
+        self.assertTrue(self.staging.staged(camera.start_recording.call_args[0][0]))
+        self.assertTrue(self.staging.staged(camera.capture.call_args[0][0]))
+        capture.keep_recording(1)
+        self.assertEqual(camera.split_recording.call_count, 0)
+        # Less than the headroom left, the recording goes on on the card
+        self.stage_file('other', 1024 * 1024 - self.staging.headroom(1000000) + 1)
+        capture.keep_recording(2)
+        camera.split_recording.assert_called_once_with(self.file_manager.complete_path('a.h264'))
+        self.stage_file('a.h264.jpg', 10)
+        with patch('camera.capture.Process') as process:
+            capture.stop_recording()
+        args = process.call_args[1]['args']
+        self.assertEqual((args[1], args[5]), (os.path.join(self.folder, 'a.h264'),
+                                              self.file_manager.complete_path('a.h264')))
+        self.assertEqual(self.stats()['flushes'], 1)
+
+
+class TestCaptureBuffers(SimpleTestCase):
+
+    def tearDown(self):
+        Capture.init_buffers()
+
+    def test_buffer_size_resolution(self):
+        small = Capture.buffer_size((640, 480), 85)
+        self.assertGreater(small, 640 * 480)
+        self.assertLess(small, 640 * 480 * 3)
+        self.assertLess(Capture.buffer_size((640, 480), 50), small)
+        with self.settings(CAMERA_RESOLUTION=(1296, 972)):
+            self.assertLess(small, Capture.buffer_size((1296, 972), 85))
+
+    def test_buffer_size_upper_bound(self):
+        self.assertEqual(Capture.buffer_size((4000, 3000), 100), Capture.max_buffer_size())
+        with self.settings(CAMERA_PREVIEW_MAX_BUFFER_SIZE=1024):
+            self.assertEqual(Capture.buffer_size((640, 480), 85), 1024)
+
+    def test_max_buffer_size(self):
+        # Enough for the full resolution rendition, a few MB in all at most
+        self.assertEqual(Capture.max_buffer_size(), Capture.snapshot_size(settings.CAMERA_RESOLUTION,
+                                                                          settings.CAMERA_PREVIEW_QUALITY))
+        self.assertLess(Capture.feed_memory_footprint()[1], 8 * 1024 * 1024)
+
+    def test_rendition_index(self):
+        names = [name for name, _, _ in settings.CAMERA_PREVIEW_RENDITIONS]
+        for index, name in enumerate(names):
+            self.assertEqual(Capture.rendition_index(name), index)
+        self.assertEqual(Capture.rendition_index(),
+                         names.index(settings.CAMERA_PREVIEW_RENDITION))
+        self.assertIsNone(Capture.rendition_index('unknown'))
+
+    def test_init_buffers_renditions(self):
+        Capture.init_buffers((640, 480), 85)
+        self.assertEqual(len(Capture.CAMERA_LIVE_FEEDS), len(settings.CAMERA_PREVIEW_RENDITIONS))
+        for (_, resize, quality), live_feed in zip(settings.CAMERA_PREVIEW_RENDITIONS,
+                                                   Capture.CAMERA_LIVE_FEEDS):
+            self.assertEqual(live_feed.buffer_size,
+                             Capture.buffer_size(resize or (640, 480), quality or 85))
+
+    def test_grow_buffers(self):
+        with self.settings(CAMERA_RESOLUTION=(1296, 972)):
+            Capture.init_buffers((640, 480), 85)
+            sizes = [live_feed.buffer_size for live_feed in Capture.CAMERA_LIVE_FEEDS]
+            self.assertFalse(Capture.grow_buffers((320, 240), 85))
+            self.assertEqual([live_feed.buffer_size for live_feed in Capture.CAMERA_LIVE_FEEDS], sizes)
+            self.assertTrue(Capture.grow_buffers((1296, 972), 85))
+            self.assertGreater(sum(live_feed.buffer_size for live_feed in Capture.CAMERA_LIVE_FEEDS),
+                               sum(sizes))
+            # Never larger than the settings need
+            self.assertFalse(Capture.grow_buffers((2592, 1944), 85))
+
+    def test_feed_memory_footprint(self):
+        Capture.init_buffers((640, 480), 85)
+        used, upper_bound = Capture.feed_memory_footprint()
+        self.assertEqual(used, 2 * sum(live_feed.buffer_size for live_feed in Capture.CAMERA_LIVE_FEEDS))
+        self.assertEqual(upper_bound, 2 * len(settings.CAMERA_PREVIEW_RENDITIONS) *
+                         Capture.max_buffer_size())
+        self.assertLess(used, upper_bound)
+        self.assertEqual(Capture.stats()['feed_memory'], used)
+
+    def test_health(self):
+        Capture.init_buffers((640, 480), 85)
+        self.assertTrue(Capture.health()['stale'])
+        self.assertIsNone(Capture.health()['frame_age'])
+        for live_feed in Capture.CAMERA_LIVE_FEEDS:
+            live_feed._buffer_index.value = 0
+            live_feed.confirm()
+        health = Capture.health()
+        self.assertFalse(health['stale'])
+        self.assertEqual(set(health['frame_ages']), set(name for name, _, _ in settings.CAMERA_PREVIEW_RENDITIONS))
+        Capture.CAMERA_LIVE_FEEDS[0]._frame_time.value -= settings.CAMERA_LIVE_STALE_AFTER + 1
+        # Nobody watches, the newest frame counts
+        self.assertFalse(Capture.health()['stale'])
+        Capture.CAMERA_LIVE_FEEDS[0].mark_read()
+        self.assertTrue(Capture.health()['stale'])
+        self.assertGreater(Capture.health()['frame_age'], settings.CAMERA_LIVE_STALE_AFTER)
+        # Only the renditions being watched count
+        Capture.CAMERA_LIVE_FEEDS[-1].mark_read()
+        Capture.CAMERA_LIVE_FEEDS[0]._read_time.value = 0
+        self.assertFalse(Capture.health()['stale'])
+        Capture.CAMERA_LIVE_FEEDS[0].confirm()
+        Capture.CAMERA_HEARTBEAT.stalled = True
+        try:
+            self.assertTrue(Capture.health()['stale'])
+        finally:
+            Capture.CAMERA_HEARTBEAT.stalled = False
+
+
+def hold_flash_stats(held):
+    """Capture daemon dying with the flash figures locked
+    """
+    Capture.CAMERA_FLASH_STATS.get_lock().acquire()
+    held.set()
+    sleep(10)
+
 
 class TestCapture(TestCase):
 
@@ -143,6 +890,43 @@ class TestCapture(TestCase):
     def test_start_daemon(self):
         with patch.object(Process, 'start'):
             Capture.start_daemon(SimpleFileManager()._folder)
+        self.assertIsNotNone(Capture.CAMERA_DAEMON)
+        self.assertIsNotNone(Capture.CAMERA_START_TIME)
+        # Restarted daemons get the same start time
+        self.assertEqual(Capture.CAMERA_DAEMON._args[-1], Capture.CAMERA_START_TIME)
+        Capture.CAMERA_CONTENT_MANAGER = Capture.CAMERA_DAEMON = Capture.CAMERA_START_TIME = None
+
+    def test_restart_daemon(self):
+        while not Capture.CAMERA_SETTINGS_QUEUE.empty():
+            Capture.CAMERA_SETTINGS_QUEUE.get()
+        held = Event()
+        daemon = Process(target=hold_flash_stats, args=(held,), daemon=True)
+        daemon.start()
+        self.assertTrue(held.wait(5))
+        Capture.CAMERA_DAEMON = daemon
+        flash_stats = Capture.CAMERA_FLASH_STATS
+        flash_stats.get_obj().flushes = 3
+        # Died holding it
+        Capture.CAMERA_LIVE_FEEDS[0]._usage_lock.acquire()
+        Capture.CAMERA_SETTINGS = self.settings
+        restarts = Capture.CAMERA_HEARTBEAT.restarts
+        try:
+            with patch.object(Capture, 'spawn_daemon') as spawn_daemon:
+                Capture.restart_daemon(timeout=1)
+            self.assertFalse(daemon.is_alive())
+            self.assertEqual(spawn_daemon.call_count, 1)
+            self.assertEqual(Capture.CAMERA_HEARTBEAT.restarts, restarts + 1)
+            self.assertTrue(Capture.CAMERA_LIVE_FEEDS[0]._usage_lock.acquire(False))
+            Capture.CAMERA_LIVE_FEEDS[0]._usage_lock.release()
+            # Same figures, new lock
+            self.assertTrue(Capture.CAMERA_FLASH_STATS.get_lock().acquire(False))
+            Capture.CAMERA_FLASH_STATS.get_lock().release()
+            self.assertEqual(Capture.stats()['flash']['flushes'], 3)
+            # Given again
+            self.assertEqual(Capture.CAMERA_SETTINGS_QUEUE.get(timeout=1).pk, self.settings.pk)
+        finally:
+            Capture.CAMERA_SETTINGS = Capture.CAMERA_DAEMON = None
+            flash_stats.get_obj().flushes = 0
 
     def test_capture_loop_wait_settings(self):
         with patch('camera.capture.GPIO') as GPIO:
@@ -154,11 +938,7 @@ class TestCapture(TestCase):
                 capture_loop(self.file_manager,
                              stop_queue,
                              settings_queue,
-                             Capture.CAMERA_CURRENT_FEED_LOCK,
-                             Capture.CAMERA_CURRENT_FEED_USAGE,
-                             Capture.CAMERA_CURRENT_FEED_BUFFER,
-                             Capture.CAMERA_FEED_BUFFERS[0],
-                             Capture.CAMERA_FEED_BUFFERS[1])
+                             Capture.CAMERA_LIVE_FEEDS)
 
     def test_video_conversion(self):
         """Ok, this is not very useful but included for completeness, we
@@ -172,6 +952,23 @@ class TestCapture(TestCase):
         self.assertFalse(pathlib.Path(self.file_manager._folder,
                                       'simple.h264').exists())
 
+    def test_video_conversion_keyframes(self):
+        self.file_manager.create_file('simple.h264')
+        self.file_manager.create_file('simple.mp4.part')
+        with patch('camera.capture.subprocess.run'):
+            with patch.object(KeyframeIndex, 'build') as build:
+                video_conversion(1, self.file_manager.complete_path('simple.h264'),
+                                 self.file_manager.complete_path('simple.mp4'))
+                self.assertEqual(build.call_count, 1)
+        self.assertTrue(pathlib.Path(self.file_manager._folder, 'simple.mp4').exists())
+
+    def test_video_conversion_generation(self):
+        self.file_manager.create_file('simple.h264')
+        with patch('camera.capture.subprocess.run'):
+            video_conversion(1, self.file_manager.complete_path('simple.h264'), 'nothing',
+                             self.file_manager)
+        self.assertGreater(self.file_manager.generation()[0], 0)
+
     def test_capture_loop_movement(self):
         allow_retries = (True,) * settings.MOTION_SENSOR_RETRIES
         stop_queue = Mock()
@@ -188,8 +985,29 @@ class TestCapture(TestCase):
                                 capture_loop(self.file_manager,
                                              stop_queue,
                                              settings_queue,
-                                             Capture.CAMERA_CURRENT_FEED_LOCK,
-                                             Capture.CAMERA_CURRENT_FEED_USAGE,
-                                             Capture.CAMERA_CURRENT_FEED_BUFFER,
-                                             Capture.CAMERA_FEED_BUFFERS[0],
-                                             Capture.CAMERA_FEED_BUFFERS[1])
+                                             Capture.CAMERA_LIVE_FEEDS)
+                                for child in active_children():   # The video conversion
+                                    child.join()
+                                camera = PiCam.return_value.__enter__.return_value
+                                self.assertEqual(camera.start_recording.call_args[1],
+                                                 dict(self.settings.recording_options(), motion_output=ANY))
+
+    def test_capture_loop_housekeeping(self):
+        stop_queue = Mock()
+        stop_queue.empty = Mock(side_effect=(True, True, False, False, False))
+        stats = RawValue(HousekeepingStats)
+        with patch('camera.capture.GPIO'):
+            with patch.object(GPIOInput, 'wait', return_value=True):
+                settings_queue = Queue()
+                settings_queue.put(self.settings)
+                with patch('camera.capture.picamera.PiCamera'), patch('camera.capture.shutil.move'), \
+                        patch('camera.capture.Process'):
+                    with patch.object(FileManager, 'apply_storage_policy') as apply_storage_policy:
+                        capture_loop(self.file_manager, stop_queue, settings_queue, Capture.CAMERA_LIVE_FEEDS,
+                                     housekeeping_stats=stats)
+        # Done in the background, at its own pace
+        self.assertEqual(apply_storage_policy.call_args[0][:2], (self.settings.max_mb, self.settings.days_kept))
+        self.assertEqual(apply_storage_policy.call_args[0][2].__name__, 'pace')
+        # Cleanup, thumbnail, motion track and storage policy
+        self.assertEqual((stats.tasks, stats.backlog, stats.recordings), (5, 0, 1))
+        self.assertGreater(stats.edge_latency, 0)
@@ -1,4 +1,5 @@
 
+import json
 import socket
 import struct
 
@@ -8,7 +9,8 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import SimpleTestCase
 
-from camera.client import CameraClient, FeedCommand
+from camera.capture import Capture
+from camera.client import CameraClient, FeedCommand, PingCommand, StatsCommand, StreamCommand
 from camera.management.commands.camera_server import Command
 from camera.models import CameraSettings
 
@@ -26,21 +28,98 @@ class TestCameraClient(SimpleTestCase):
             with patch.object(socket.socket, 'sendall') as send:
                 command = CameraClient(Command.SERVER_PING)
                 self.check_base_client(conn, send, Command.SERVER_PING)
+                self.assertEqual(command._socket.gettimeout(), settings.CAMERA_SERVER_TIMEOUT)
+                self.assertEqual(CameraClient(Command.SERVER_PING, 1)._socket.gettimeout(), 1)
+
+    def test_stream_command_stalled(self):
+        with patch.object(socket.socket, 'connect'):
+            with patch.object(socket.socket, 'sendall'):
+                with patch.object(socket.socket, 'recv', side_effect=socket.timeout()):
+                    self.assertEqual(list(StreamCommand().segments()), [])
 
     def test_feed_command_empty_response(self):
         with patch.object(socket.socket, 'connect') as conn:
             with patch.object(socket.socket, 'sendall') as send:
                 with patch.object(socket.socket, 'recv', return_value=[]):
                     command = FeedCommand()
-                    self.check_base_client(conn, send, Command.SERVER_LIVE_FEED)
+                    self.check_base_client(conn, send, Command.SERVER_LIVE_FEED +
+                                           bytes((Capture.rendition_index(),)) + bytes(4))
                     self.assertIsNone(command.response)
 
     def test_feed_command_completed_response(self):
         with patch.object(socket.socket, 'connect') as conn:
             with patch.object(socket.socket, 'sendall') as send:
-                buffer_lenght_resp = struct.pack('I', 2)
-                with patch.object(socket.socket, 'recv', return_value=buffer_lenght_resp):
+                responses = (struct.pack('II', 2, 1500), struct.pack('I', 2))
+                with patch.object(socket.socket, 'recv', side_effect=responses):
                     with patch.object(socket.socket, 'recv_into', side_effect=(1, 1)):
                         command = FeedCommand()
-                        self.check_base_client(conn, send, Command.SERVER_LIVE_FEED)
+                        self.check_base_client(conn, send, Command.SERVER_LIVE_FEED +
+                                               bytes((Capture.rendition_index(),)) + bytes(4))
                         self.assertIsNotNone(command.response)
+                        self.assertEqual(command.sequence, 2)
+                        self.assertEqual(command.age, 1.5)
+
+    def test_feed_command_rendition(self):
+        with patch.object(socket.socket, 'connect') as conn:
+            with patch.object(socket.socket, 'sendall') as send:
+                with patch.object(socket.socket, 'recv', return_value=[]):
+                    FeedCommand('small', 7)
+                    self.check_base_client(conn, send, Command.SERVER_LIVE_FEED +
+                                           bytes((Capture.rendition_index('small'),)) +
+                                           struct.pack('I', 7))
+
+    def test_feed_command_unknown_rendition(self):
+        with self.assertRaises(ValueError):
+            FeedCommand('unknown')
+
+    def test_stats_command(self):
+        document = json.dumps(dict(feed_overflows=3)).encode('utf-8')
+
+        def recv_into(buffer, size):
+            buffer[:size] = document[:size]
+            return size
+
+        with patch.object(socket.socket, 'connect') as conn:
+            with patch.object(socket.socket, 'sendall') as send:
+                with patch.object(socket.socket, 'recv', return_value=struct.pack('I', len(document))):
+                    with patch.object(socket.socket, 'recv_into', side_effect=recv_into):
+                        command = StatsCommand()
+                        self.check_base_client(conn, send, Command.SERVER_STATS)
+                        self.assertEqual(command.response, dict(feed_overflows=3))
+
+    def test_ping_command(self):
+        document = json.dumps(dict(stale=False)).encode('utf-8')
+
+        def recv_into(buffer, size):
+            buffer[:size] = document[:size]
+            return size
+
+        with patch.object(socket.socket, 'connect') as conn:
+            with patch.object(socket.socket, 'sendall') as send:
+                with patch.object(socket.socket, 'recv', return_value=struct.pack('I', len(document))):
+                    with patch.object(socket.socket, 'recv_into', side_effect=recv_into):
+                        command = PingCommand()
+                        self.check_base_client(conn, send, Command.SERVER_PING)
+                        self.assertEqual(command.response, dict(stale=False))
+
+    def test_stream_command(self):
+        blocks = [struct.pack('I', 3), b'abc', struct.pack('I', 2), b'de', struct.pack('I', 0)]
+        received = iter(blocks)
+
+        def recv(size, *args):
+            return next(received)
+
+        def recv_into(buffer, size):
+            data = next(received)
+            buffer[:len(data)] = data
+            return len(data)
+
+        with patch.object(socket.socket, 'connect'):
+            with patch.object(socket.socket, 'sendall') as send:
+                with patch.object(socket.socket, 'recv', side_effect=recv):
+                    with patch.object(socket.socket, 'recv_into', side_effect=recv_into):
+                        with patch.object(socket.socket, 'close') as close:
+                            command = StreamCommand()
+                            self.assertEqual(send.call_args[0], (Command.SERVER_LIVE_STREAM,))
+                            self.assertEqual(list(command.segments()), [b'abc', b'de'])
+                            self.assertTrue(close.called)
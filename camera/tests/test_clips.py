@@ -0,0 +1,71 @@
+import os
+import pathlib
+import shutil
+
+from unittest.mock import Mock, patch
+
+from django.test import SimpleTestCase
+
+from camera.clips import KeyframeIndex, clip_stream
+
+
+FFPROBE_OUTPUT = b'0.000000,K_\n0.040000,__\n2.000000,K_\n2.040000,__\n4.000000,K_\n'
+
+
+class TestKeyframeIndex(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = os.path.join(os.path.dirname(__file__), 'clips')
+        pathlib.Path(self.folder).mkdir(parents=True, exist_ok=True)
+        self.index = KeyframeIndex(os.path.join(self.folder, '2018-01-31_120000_123.mp4'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_build(self):
+        with patch('camera.clips.subprocess.run', return_value=Mock(stdout=FFPROBE_OUTPUT)) as run:
+            self.assertEqual(self.index.build(), [0, 2, 4])
+            self.assertEqual(self.index.keyframes(), [0, 2, 4])
+            self.assertEqual(run.call_count, 1)
+
+    def test_build_failed(self):
+        with patch('camera.clips.subprocess.run', return_value=Mock(stdout=b'')):
+            self.assertEqual(self.index.keyframes(), [])
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_gop_bounds(self):
+        with patch('camera.clips.subprocess.run', return_value=Mock(stdout=FFPROBE_OUTPUT)):
+            self.assertEqual(self.index.gop_bounds(0, 1), (0, 2))
+            self.assertEqual(self.index.gop_bounds(2.5, 4), (2, 4))
+            self.assertEqual(self.index.gop_bounds(2, 4.5), (2, None))
+            self.assertEqual(self.index.gop_bounds(3), (2, None))
+
+    def test_gop_bounds_without_keyframes(self):
+        with patch('camera.clips.subprocess.run', return_value=Mock(stdout=b'')):
+            self.assertEqual(self.index.gop_bounds(3, 5), (0, None))
+
+
+class TestClipStream(SimpleTestCase):
+
+    def test_clip_stream(self):
+        process = Mock()
+        process.stdout.read.side_effect = (b'12', b'34', b'')
+        process.poll.return_value = 0
+        with patch('camera.clips.subprocess.Popen', return_value=process) as popen:
+            self.assertEqual(b''.join(clip_stream('video.mp4', 2, 4)), b'1234')
+            args = popen.call_args[0][0]
+            self.assertEqual(args[args.index('-ss') + 1], '2.000000')
+            self.assertEqual(args[args.index('-t') + 1], '4.000000')
+            self.assertIn('copy', args)
+        self.assertEqual(process.kill.call_count, 0)
+
+    def test_clip_stream_closed(self):
+        process = Mock()
+        process.stdout.read.return_value = b'12'
+        process.poll.return_value = None
+        with patch('camera.clips.subprocess.Popen', return_value=process) as popen:
+            stream = clip_stream('video.mp4', 0)
+            next(stream)
+            stream.close()
+            self.assertNotIn('-t', popen.call_args[0][0])
+        self.assertEqual(process.kill.call_count, 1)
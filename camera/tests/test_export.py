@@ -0,0 +1,82 @@
+import io
+import os
+import shutil
+import tarfile
+
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+from django.utils.timezone import utc
+
+from camera.capture import FileManager
+from camera.export import ArchiveMember, TarExport, export_members
+
+
+class TestExport(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = os.path.join(os.path.dirname(__file__), 'export')
+        self.file_manager = FileManager(self.folder, sharded=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def create_file(self, name, size=1):
+        with open(os.path.join(self.folder, name), 'wb') as f:
+            f.write(b'1' * size)
+
+    def test_export_members(self):
+        self.create_file('2018-01-30_120000_123.mp4')
+        self.create_file('2018-01-31_120000_123.mp4', 10)
+        self.create_file('2018-01-31_120000_123.mp4.jpg', 2)
+        self.create_file('2018-01-31_130000_123.mp4', 20)
+        self.file_manager.thumbnail_pack('2018-01-31').append('2018-01-31_130000', b'123')
+        self.create_file('2018-02-01_120000_123.mp4')
+        start = datetime(2018, 1, 31, tzinfo=utc)
+        members = export_members(self.file_manager, start, start + timedelta(days=1))
+        self.assertEqual([(m.name, m.size, m.offset) for m in members],
+                         [('2018-01-31_120000_123.mp4', 10, 0),
+                          ('2018-01-31_120000_123.mp4.jpg', 2, 0),
+                          ('2018-01-31_130000_123.mp4', 20, 0),
+                          ('2018-01-31_130000_123.mp4.jpg', 3, 0)])
+        self.assertTrue(members[-1].path.endswith('.pack'))
+
+    def members(self):
+        self.create_file('2018-01-31_120000_123.mp4', 600)
+        self.create_file('2018-01-31_120000_123.mp4.jpg', 3)
+        return [ArchiveMember('2018-01-31_120000_123.mp4', 0, 600,
+                              os.path.join(self.folder, '2018-01-31_120000_123.mp4'), 0),
+                ArchiveMember('2018-01-31_120000_123.mp4.jpg', 0, 2,
+                              os.path.join(self.folder, '2018-01-31_120000_123.mp4.jpg'), 1)]
+
+    def test_stream(self):
+        archive = TarExport(self.members())
+        content = b''.join(archive.stream(chunk_size=100))
+        self.assertEqual(len(content), archive.size)
+        with tarfile.open(fileobj=io.BytesIO(content)) as tar:
+            self.assertEqual(tar.getnames(), ['2018-01-31_120000_123.mp4', '2018-01-31_120000_123.mp4.jpg'])
+            self.assertEqual(tar.extractfile('2018-01-31_120000_123.mp4.jpg').read(), b'11')
+        for first, last in ((0, 0), (100, 1500), (1000, None), (archive.size - 1, None)):
+            self.assertEqual(b''.join(archive.stream(first, last, chunk_size=100)),
+                             content[first:None if last is None else last + 1])
+
+    def test_stream_missing_file(self):
+        members = self.members()
+        archive = TarExport(members)
+        os.unlink(members[0].path)
+        content = b''.join(archive.stream())
+        self.assertEqual(len(content), archive.size)
+        with tarfile.open(fileobj=io.BytesIO(content)) as tar:
+            self.assertEqual(tar.extractfile('2018-01-31_120000_123.mp4').read(), bytes(600))
+
+    def test_stream_rate(self):
+        archive = TarExport(self.members())
+        with patch('camera.export.sleep') as sleep:
+            b''.join(archive.stream(rate=1024))
+            self.assertGreater(sleep.call_count, 0)
+
+    def test_etag(self):
+        members = self.members()
+        self.assertEqual(TarExport(members).etag(), TarExport(members).etag())
+        self.assertNotEqual(TarExport(members).etag(), TarExport(members[:1]).etag())
@@ -0,0 +1,169 @@
+import struct
+
+from django.test import SimpleTestCase
+
+from camera.fmp4 import AccessUnitSplitter, FragmentedMP4Muxer, START_CODE
+from camera.fmp4 import init_segment, media_segment, parse_sps, split_nal_units
+
+
+class BitWriter:
+    """Writes the bits, and Exp-Golomb codes, of an RBSP
+    """
+
+    def __init__(self):
+        self.bits = ''
+
+    def u(self, count, value):
+        self.bits += format(value, '0{}b'.format(count))
+
+    def ue(self, value):
+        code = format(value + 1, 'b')
+        self.bits += '0' * (len(code) - 1) + code
+
+    def se(self, value):
+        self.ue(2 * value - 1 if value > 0 else -2 * value)
+
+    def rbsp(self):
+        bits = self.bits + '1'
+        bits += '0' * (-len(bits) % 8)
+        return int(bits, 2).to_bytes(len(bits) // 8, 'big')
+
+
+def make_sps(profile, width, height, scaling_list=False):
+    """Returns an SPS for a progressive 4:2:0 frame of the given size
+    """
+    writer = BitWriter()
+    writer.u(8, profile)
+    writer.u(8, 0)
+    writer.u(8, 40)
+    writer.ue(0)
+    if profile == 100:
+        writer.ue(1)
+        writer.ue(0)
+        writer.ue(0)
+        writer.u(1, 0)
+        writer.u(1, 1 if scaling_list else 0)
+        if scaling_list:
+            writer.u(1, 1)
+            for delta in (-8,):     # A list with all zeros but the first
+                writer.se(delta)
+            for _ in range(7):
+                writer.u(1, 0)
+    writer.ue(0)
+    writer.ue(0)
+    writer.ue(0)
+    writer.ue(1)
+    writer.u(1, 0)
+    width_mbs, height_mbs = (width + 15) // 16, (height + 15) // 16
+    writer.ue(width_mbs - 1)
+    writer.ue(height_mbs - 1)
+    writer.u(1, 1)
+    writer.u(1, 1)
+    crop_right, crop_bottom = (width_mbs * 16 - width) // 2, (height_mbs * 16 - height) // 2
+    writer.u(1, 1 if crop_right or crop_bottom else 0)
+    if crop_right or crop_bottom:
+        for value in (0, crop_right, 0, crop_bottom):
+            writer.ue(value)
+    writer.u(1, 0)
+    return b'\x67' + writer.rbsp()
+
+
+SPS = make_sps(66, 640, 480)
+PPS = b'\x68\xce\x3c\x80'
+
+
+def idr(size=10):
+    return b'\x65\x88' + bytes(range(1, size))
+
+
+def p_slice(size=5):
+    return b'\x41\x9a' + bytes(range(1, size))
+
+
+def boxes(data):
+    """Returns the type and payload of the boxes of an MP4 byte string
+    """
+    result = []
+    position = 0
+    while position < len(data):
+        size, kind = struct.unpack_from('>I4s', data, position)
+        result.append((kind, data[position + 8:position + size]))
+        position += size
+    return result
+
+
+class TestFragmentedMP4(SimpleTestCase):
+
+    def test_parse_sps(self):
+        info = parse_sps(SPS)
+        self.assertEqual((info.profile, info.width, info.height), (66, 640, 480))
+        info = parse_sps(make_sps(100, 1920, 1080))
+        self.assertEqual((info.profile, info.width, info.height, info.chroma_format), (100, 1920, 1080, 1))
+        info = parse_sps(make_sps(100, 1296, 972, scaling_list=True))
+        self.assertEqual((info.width, info.height), (1296, 972))
+
+    def test_split_nal_units(self):
+        stream = START_CODE + SPS + b'\x00\x00\x01' + PPS + START_CODE + idr()
+        self.assertEqual(split_nal_units(stream), [SPS, PPS, idr()])
+
+    def test_splitter(self):
+        stream = b''.join(START_CODE + n for n in (SPS, PPS, idr(), p_slice(), p_slice(), SPS, PPS, idr()))
+        splitter = AccessUnitSplitter()
+        units = []
+        # Chunks of any size, split start codes included
+        for timestamp, position in enumerate(range(0, len(stream), 3)):
+            units.extend(splitter.feed(stream[position:position + 3], timestamp * 10))
+        self.assertEqual(len(units), 3)
+        self.assertEqual(split_nal_units(units[0][0]), [SPS, PPS, idr()])
+        self.assertTrue(units[0][3])
+        self.assertEqual(units[1][0], START_CODE + p_slice())
+        self.assertFalse(units[1][3])
+        self.assertEqual([u[1] for u in units], sorted(u[1] for u in units))
+        self.assertEqual([u[1] + u[2] for u in units[:2]], [u[1] for u in units[1:]])
+        # The last frame is complete once the next one starts
+        self.assertEqual(splitter.feed(START_CODE + p_slice()[:1], 1000), [])
+        units = splitter.feed(p_slice()[1:], 1010)
+        self.assertEqual(split_nal_units(units[0][0]), [SPS, PPS, idr()])
+        self.assertEqual(units[0][2], 1010 - units[0][1])
+
+    def test_init_segment(self):
+        segment = boxes(init_segment(SPS, PPS))
+        self.assertEqual([kind for kind, _ in segment], [b'ftyp', b'moov'])
+        moov = boxes(segment[1][1])
+        self.assertEqual([kind for kind, _ in moov], [b'mvhd', b'trak', b'mvex'])
+        tkhd = boxes(moov[1][1])[0][1]
+        self.assertEqual(struct.unpack('>II', tkhd[-8:]), (640 << 16, 480 << 16))
+        avcc = segment[1][1][segment[1][1].index(b'avcC') + 4:]
+        self.assertEqual(avcc[:4], b'\x01' + SPS[1:4])
+        self.assertIn(SPS + b'\x01\x00\x04' + PPS, avcc)
+
+    def test_media_segment(self):
+        segment = boxes(media_segment(3, 9000, 3000, [idr()], True))
+        self.assertEqual([kind for kind, _ in segment], [b'moof', b'mdat'])
+        self.assertEqual(segment[1][1], struct.pack('>I', len(idr())) + idr())
+        traf = boxes(boxes(segment[0][1])[1][1])
+        self.assertEqual([kind for kind, _ in traf], [b'tfhd', b'tfdt', b'trun'])
+        self.assertEqual(struct.unpack('>Q', traf[1][1][4:]), (9000,))
+        count, offset, duration, size, flags = struct.unpack('>IiIII', traf[2][1][4:])
+        # The data offset points at the payload of the mdat box
+        self.assertEqual((count, offset, duration, size, flags),
+                         (1, len(segment[0][1]) + 16, 3000, len(idr()) + 4, 0x02000000))
+
+    def test_muxer(self):
+        muxer = FragmentedMP4Muxer()
+        # Nothing until the first key frame
+        self.assertEqual(muxer.mux(START_CODE + p_slice(), 100, 10, False), b'')
+        first = boxes(muxer.mux(b''.join(START_CODE + n for n in (SPS, PPS, idr())), 200, 10, True))
+        self.assertEqual([kind for kind, _ in first], [b'ftyp', b'moov', b'moof', b'mdat'])
+        self.assertEqual(first[3][1], struct.pack('>I', len(idr())) + idr())
+        second = boxes(muxer.mux(START_CODE + p_slice(), 210, 10, False))
+        self.assertEqual([kind for kind, _ in second], [b'moof', b'mdat'])
+        mfhd, traf = boxes(second[0][1])
+        self.assertEqual(struct.unpack('>I', mfhd[1][4:]), (2,))
+        self.assertEqual(struct.unpack('>Q', boxes(traf[1])[1][1][4:]), (10,))
+        # The same headers are not sent again, new ones are
+        third = boxes(muxer.mux(b''.join(START_CODE + n for n in (SPS, PPS, idr())), 220, 10, True))
+        self.assertEqual([kind for kind, _ in third], [b'moof', b'mdat'])
+        sps = make_sps(66, 320, 240)
+        fourth = boxes(muxer.mux(b''.join(START_CODE + n for n in (sps, PPS, idr())), 230, 10, True))
+        self.assertEqual([kind for kind, _ in fourth], [b'ftyp', b'moov', b'moof', b'mdat'])
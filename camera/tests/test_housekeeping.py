@@ -0,0 +1,95 @@
+from threading import Event
+from time import monotonic, sleep
+from unittest.mock import Mock, patch
+
+from django.test import SimpleTestCase
+
+from camera.housekeeping import Housekeeper
+
+
+class TestHousekeeper(SimpleTestCase):
+
+    def setUp(self):
+        self.housekeeper = Housekeeper(budget=0.5, niceness=0)
+        self.addCleanup(self.housekeeper.stop)
+        self.done = []
+
+    def task(self, name):
+        self.done.append(name)
+
+    def blocked(self) -> Event:
+        """Keeps the housekeeper busy until the returned event is set
+        """
+        started, release = Event(), Event()
+        self.housekeeper.schedule(lambda: started.set() or release.wait())
+        self.addCleanup(release.set)
+        started.wait()
+        return release
+
+    def test_not_started(self):
+        self.assertTrue(self.housekeeper.schedule(self.task, 'a'))
+        self.assertEqual(self.done, ['a'])
+
+    def test_priority(self):
+        self.housekeeper.start()
+        release = self.blocked()
+        self.housekeeper.schedule(self.task, 'background', priority=Housekeeper.BACKGROUND)
+        self.housekeeper.schedule(self.task, 'normal')
+        self.housekeeper.schedule(self.task, 'urgent', priority=Housekeeper.URGENT)
+        self.housekeeper.schedule(self.task, 'other', priority=Housekeeper.URGENT)
+        self.assertEqual(self.housekeeper.stats.backlog, 4)
+        release.set()
+        self.housekeeper.stop()
+        self.assertEqual(self.done, ['urgent', 'other', 'normal', 'background'])
+        self.assertEqual((self.housekeeper.stats.tasks, self.housekeeper.stats.backlog), (5, 0))
+
+    def test_key(self):
+        self.housekeeper.start()
+        release = self.blocked()
+        self.assertTrue(self.housekeeper.schedule(self.task, 'a', key='policy'))
+        self.assertFalse(self.housekeeper.schedule(self.task, 'b', key='policy'))
+        release.set()
+        self.housekeeper.stop()
+        self.assertEqual(self.done, ['a'])
+        # Scheduled again once it ran
+        self.housekeeper.start()
+        self.assertTrue(self.housekeeper.schedule(self.task, 'c', key='policy'))
+        self.housekeeper.stop()
+        self.assertEqual(self.done, ['a', 'c'])
+
+    def test_failing_task(self):
+        with patch('camera.housekeeping.traceback.print_exc') as print_exc:
+            with self.housekeeper:
+                self.housekeeper.schedule(Mock(side_effect=OSError))
+                self.housekeeper.schedule(self.task, 'a')
+        self.assertEqual(print_exc.call_count, 1)
+        self.assertEqual(self.done, ['a'])
+
+    def test_paused(self):
+        self.housekeeper.start()
+        release = self.blocked()
+        self.housekeeper.schedule(self.task, 'a')
+        with self.housekeeper.paused():
+            release.set()
+            # Nothing runs while a recording starts
+            sleep(0.05)
+            self.assertEqual(self.done, [])
+        self.housekeeper.stop()
+        self.assertEqual(self.done, ['a'])
+
+    def test_pace(self):
+        def busy():
+            # 30 ms of work, with a call to pace every 5 ms
+            for _ in range(6):
+                start = monotonic()
+                while monotonic() - start < 0.005:
+                    pass
+                self.housekeeper.pace()
+
+        with patch.object(Housekeeper, 'SLICE', 0.01):
+            with self.housekeeper:
+                self.housekeeper.schedule(busy)
+        stats = self.housekeeper.stats
+        # As long resting as working, but for the last slice
+        self.assertGreaterEqual(stats.busy_seconds, 0.03)
+        self.assertGreaterEqual(stats.rest_seconds, stats.busy_seconds - 0.01)
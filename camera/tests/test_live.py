@@ -0,0 +1,197 @@
+import asyncio
+import struct
+
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from camera.live import FrameBroadcaster, FrameSlot, LivePreviewApplication, fetch_frame
+from camera.management.commands.camera_server import Command
+
+
+class FakeCameraServer:
+    """Answers FEED commands like the camera server, with a new frame every
+    time it is asked unless it is told not to advance, and LIVE commands
+    with the given segments
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.sequence = 0
+        self.advance = True
+        self.age = 250
+        self.segments = [b'ftyp', b'moof']
+
+    async def handle(self, reader, writer):
+        command = await reader.readexactly(4)
+        self.requests += 1
+        if command == Command.SERVER_LIVE_STREAM:
+            for segment in self.segments + [b'']:
+                writer.write(struct.pack('I', len(segment)) + segment)
+            await writer.drain()
+            writer.close()
+            return
+        if command != Command.SERVER_LIVE_FEED:
+            writer.close()
+            return
+        command += await reader.readexactly(5)
+        known_sequence = struct.unpack('I', command[5:])[0]
+        if self.advance:
+            self.sequence += 1
+        if self.sequence == known_sequence:
+            writer.write(struct.pack('III', self.sequence, self.age, 0))
+        else:
+            frame = 'frame {} {}'.format(command[4], self.sequence).encode()
+            writer.write(struct.pack('III', self.sequence, self.age, len(frame)) + frame)
+        await writer.drain()
+        writer.close()
+
+
+class TestLive(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.camera_server = FakeCameraServer()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.camera_server.handle, 'localhost', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.settings_override = self.settings(CAMERA_SERVER_PORT=port, CAMERA_LIVE_FEED_INTERVAL=0.01)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_fetch_frame(self):
+        sequence, age, frame = self.loop.run_until_complete(fetch_frame(1))
+        self.assertEqual((sequence, age, frame), (1, .25, b'frame 1 1'))
+        sequence, age, frame = self.loop.run_until_complete(fetch_frame(1, sequence))
+        self.assertEqual((sequence, frame), (2, b'frame 1 2'))
+        self.camera_server.advance = False
+        sequence, age, frame = self.loop.run_until_complete(fetch_frame(1, sequence))
+        self.assertEqual((sequence, age, frame), (2, .25, None))
+
+    def test_frame_slot(self):
+        async def use_slot():
+            slot = FrameSlot()
+            slot.put(b'1')
+            slot.put(b'2')
+            self.assertEqual(await slot.get(), b'2')
+            self.assertEqual(slot.skipped, 1)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(slot.get(), 0.01)
+
+        self.loop.run_until_complete(use_slot())
+
+    def test_broadcaster(self):
+        async def watch():
+            broadcaster = FrameBroadcaster(0)
+            slots = [broadcaster.subscribe() for _ in range(30)]
+            frames = [await slot.get() for slot in slots]
+            self.assertEqual(broadcaster.viewers, 30)
+            for slot in slots:
+                broadcaster.unsubscribe(slot)
+            await asyncio.sleep(0.05)
+            return frames
+
+        frames = self.loop.run_until_complete(watch())
+        self.assertEqual(set(frames), {b'frame 0 1'})
+        # The camera server is asked for all the viewers at once, and no more
+        # once they are gone
+        requests = self.camera_server.requests
+        self.assertLess(requests, 10)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.camera_server.requests, requests)
+
+    def session_cookie(self):
+        self.client.force_login(User.objects.create(username='test'))
+        return '{}={}'.format(settings.SESSION_COOKIE_NAME,
+                              self.client.cookies[settings.SESSION_COOKIE_NAME].value).encode()
+
+    def test_session_user_authenticated(self):
+        self.session_cookie()
+        with patch('camera.live.close_old_connections'):
+            self.assertTrue(LivePreviewApplication.session_user_authenticated(
+                self.client.cookies[settings.SESSION_COOKIE_NAME].value))
+            self.assertFalse(LivePreviewApplication.session_user_authenticated('other'))
+
+    def run_app(self, scope, messages, stop_after=1):
+        """Runs the application with the given messages from the client,
+        and then a disconnect once it sent stop_after messages
+        :return the messages sent by the application
+        """
+        received = asyncio.Queue()
+        for message in messages:
+            received.put_nowait(message)
+        sent = []
+
+        async def receive():
+            return await received.get()
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == stop_after:
+                received.put_nowait({'type': 'websocket.disconnect'})
+
+        scope = dict(dict(headers=[], query_string=b'', method='GET'), **scope)
+        with patch.object(LivePreviewApplication, 'session_user_authenticated',
+                          side_effect=lambda key: key == 'good'):
+            self.loop.run_until_complete(asyncio.wait_for(LivePreviewApplication()(scope, receive, send), 5))
+        return sent
+
+    def test_websocket(self):
+        scope = dict(type='websocket', path='/live/feed', query_string=b'size=medium',
+                     headers=[(b'cookie', settings.SESSION_COOKIE_NAME.encode() + b'=good'),
+                              (b'host', b'pi'), (b'origin', b'http://pi')])
+        sent = self.run_app(scope, [{'type': 'websocket.connect'}], stop_after=3)
+        self.assertEqual(sent[0], {'type': 'websocket.accept'})
+        self.assertEqual(sent[1], {'type': 'websocket.send', 'bytes': b'frame 1 1'})
+        self.assertEqual(sent[2], {'type': 'websocket.send', 'bytes': b'frame 1 2'})
+        for headers in ([], [(b'cookie', settings.SESSION_COOKIE_NAME.encode() + b'=bad')],
+                        [(b'cookie', settings.SESSION_COOKIE_NAME.encode() + b'=good'),
+                         (b'host', b'pi'), (b'origin', b'http://elsewhere')]):
+            sent = self.run_app(dict(scope, headers=headers), [{'type': 'websocket.connect'}])
+            self.assertEqual(sent, [{'type': 'websocket.close', 'code': 1008}])
+
+    def test_still_frame(self):
+        scope = dict(type='http', path='/live/still_frame', query_string=b'size=small',
+                     headers=[(b'cookie', settings.SESSION_COOKIE_NAME.encode() + b'=good')])
+        sent = self.run_app(scope, [], stop_after=0)
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'ETag', b'"0-1"'), sent[0]['headers'])
+        self.assertIn((b'X-Frame-Age', b'0.2'), sent[0]['headers'])
+        self.assertEqual(sent[1]['body'], b'frame 0 1')
+        self.camera_server.advance = False
+        sent = self.run_app(dict(scope, headers=scope['headers'] + [(b'if-none-match', b'"0-1"')]), [],
+                            stop_after=0)
+        self.assertEqual(sent[0]['status'], 304)
+        sent = self.run_app(dict(scope, query_string=b'size=huge'), [], stop_after=0)
+        self.assertEqual(sent[0]['status'], 400)
+        sent = self.run_app(dict(scope, headers=[]), [], stop_after=0)
+        self.assertEqual(sent[0]['status'], 403)
+        sent = self.run_app(dict(scope, path='/live/other'), [], stop_after=0)
+        self.assertEqual(sent[0]['status'], 404)
+
+    def test_stream(self):
+        scope = dict(type='http', path='/live/stream',
+                     headers=[(b'cookie', settings.SESSION_COOKIE_NAME.encode() + b'=good')])
+        sent = self.run_app(scope, [], stop_after=0)
+        self.assertEqual(sent[0]['status'], 404)
+        with self.settings(CAMERA_LIVE_STREAM=dict(resize=(640, 480))):
+            sent = self.run_app(scope, [], stop_after=0)
+            self.assertEqual(sent[0]['status'], 200)
+            self.assertIn((b'Content-Type', b'video/mp4'), sent[0]['headers'])
+            self.assertEqual([m['body'] for m in sent[1:]], [b'ftyp', b'moof', b''])
+            self.assertFalse(sent[-1].get('more_body'))
+            sent = self.run_app(dict(scope, headers=[]), [], stop_after=0)
+            self.assertEqual(sent[0]['status'], 403)
+            # The relay stops as soon as the client goes away
+            self.camera_server.segments = [b'moof'] * 1000
+            sent = self.run_app(scope, [{'type': 'http.disconnect'}], stop_after=0)
+            self.assertLess(len(sent), 1000)
@@ -16,3 +16,8 @@ class TestModels(TestCase):
         self.assertEqual(picamera.hflip, True)
         self.assertEqual(picamera.vflip, False)
         self.assertEqual(picamera.contrast, 20)
+
+    def test_recording_options(self):
+        camera_settings = CameraSettings(bitrate=1000, quality=25, intra_period=30)
+        self.assertEqual(camera_settings.recording_options(),
+                         dict(bitrate=1000000, quality=25, intra_period=30))
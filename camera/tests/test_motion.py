@@ -0,0 +1,80 @@
+import os
+import tempfile
+
+from array import array
+from unittest import skipIf
+
+from django.test import SimpleTestCase
+
+from camera.motion import MotionTrack, MotionVectorOutput, numpy
+
+
+class TestMotionTrack(SimpleTestCase):
+
+    def test_add(self):
+        track = MotionTrack(10)
+        track.sensor()
+        for score in (0, 200, -1):
+            track.add(score)
+        self.assertEqual(list(track.scores), [MotionTrack.SENSOR, MotionTrack.MAX_SCORE, 0])
+        self.assertEqual(track.duration, 0.3)
+
+    def test_save_load(self):
+        track = MotionTrack(25, array('B', (1, 2, 3 | MotionTrack.SENSOR)))
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'a.mp4' + MotionTrack.SUFFIX)
+            track.save(path)
+            self.assertEqual(os.path.getsize(path), MotionTrack.HEADER.size + 3)
+            loaded = MotionTrack.load(path)
+            self.assertEqual((loaded.framerate, loaded.scores), (25, track.scores))
+            with open(path, 'wb') as f:
+                f.write(b'not a track')
+            with self.assertRaises(ValueError):
+                MotionTrack.load(path)
+
+    def test_bins(self):
+        track = MotionTrack(1, array('B', (1, 5, 2, 0, MotionTrack.SENSOR, 7)))
+        self.assertEqual(track.bins(3), [5, 2, 7])
+        # At most one per frame
+        self.assertEqual(len(track.bins(100)), 6)
+        self.assertEqual(MotionTrack(1).bins(10), [])
+
+    def test_peaks(self):
+        track = MotionTrack(1, array('B', [0] * 30))
+        for frame, score in ((3, 50), (4, 60), (12, 40), (20, 10), (21, 70)):
+            track.scores[frame] = score
+        # Close peaks count once
+        self.assertEqual(track.peaks(3, min_gap=5), [4, 12, 21])
+        self.assertEqual(track.peaks(2, min_gap=5), [4, 21])
+
+    def test_sensor_times(self):
+        track = MotionTrack(2, array('B', (MotionTrack.SENSOR, 0, 0, 3 | MotionTrack.SENSOR)))
+        self.assertEqual(track.sensor_times(), [0, 1.5])
+
+
+@skipIf(numpy is None, 'numpy is not installed')
+class TestMotionVectorOutput(SimpleTestCase):
+
+    def frame(self, moving_blocks, blocks):
+        vectors = numpy.zeros((blocks, 4), dtype=numpy.int8)
+        vectors[:moving_blocks, 0] = 10
+        # Noise
+        vectors[moving_blocks:, 1] = 1
+        return vectors.tobytes()
+
+    def test_write(self):
+        track = MotionTrack(25)
+        output = MotionVectorOutput((64, 32), track)
+        blocks = 5 * 2
+        data = self.frame(0, blocks) + self.frame(blocks, blocks) + self.frame(1, blocks)
+        # Frames may come in pieces
+        output.write(data[:30])
+        output.write(data[30:])
+        self.assertEqual(list(track.scores), [0, MotionTrack.MAX_SCORE, round(MotionTrack.MAX_SCORE * 0.1 ** 0.5)])
+
+    def test_key_frame(self):
+        track = MotionTrack(25)
+        output = MotionVectorOutput((64, 32), track)
+        output.write(self.frame(10, 10))
+        output.write(bytes(10 * 4))
+        self.assertEqual(list(track.scores), [MotionTrack.MAX_SCORE] * 2)
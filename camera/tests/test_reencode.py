@@ -0,0 +1,131 @@
+import io
+import os
+import pathlib
+import shutil
+import subprocess
+
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from camera.capture import FileManager, StagingArea
+from camera.reencode import Reencoder
+
+
+class FakeProcess:
+    """Stands for ffmpeg, writing an output of the given size
+    """
+
+    def __init__(self, size, timeouts=0):
+        self._size = size
+        self._timeouts = timeouts
+        self.returncode = None
+        self.terminated = False
+
+    def __call__(self, args, **kwargs):
+        self._output = args[-1]
+        return self
+
+    def wait(self, timeout=None):
+        if self._timeouts and not self.terminated:
+            self._timeouts -= 1
+            raise subprocess.TimeoutExpired('ffmpeg', timeout)
+        if not self.terminated:
+            with open(self._output, 'w') as f:
+                f.write('1' * self._size)
+        self.returncode = -15 if self.terminated else 0
+        return self.returncode
+
+    def terminate(self):
+        self.terminated = True
+
+
+class TestReencoder(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = os.path.join(os.path.dirname(__file__), 'reencode')
+        self.file_manager = FileManager(self.folder, sharded=False)
+        self.staging_folder = os.path.join(os.path.dirname(__file__), 'reencode_staging')
+        self.reencoder = Reencoder(self.file_manager, 'small', max_temperature=70, poll_interval=0,
+                                   staging=StagingArea(self.staging_folder, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        shutil.rmtree(self.staging_folder)
+
+    def create_file(self, name, size=1):
+        with open(os.path.join(self.folder, name), 'w') as f:
+            f.write('1' * size)
+
+    def exists(self, name):
+        return pathlib.Path(self.folder, name).exists()
+
+    def test_aged_videos(self):
+        self.create_file('2018-01-01_120000_123.mp4')
+        self.create_file('2018-01-02_120000_123.mp4')
+        self.create_file('2018-01-03_120000_123.small.mp4')
+        self.create_file('2099-01-01_120000_123.mp4')
+        self.assertEqual([video.file for video in self.reencoder.aged_videos(7)],
+                         ['2018-01-01_120000_123.mp4', '2018-01-02_120000_123.mp4'])
+
+    def test_idle(self):
+        with patch.object(Reencoder, 'temperature', return_value=None):
+            self.assertTrue(self.reencoder.idle())
+        with patch.object(Reencoder, 'temperature', return_value=80):
+            self.assertFalse(self.reencoder.idle())
+        self.create_file('2018-01-01_120000.h264')
+        with patch.object(Reencoder, 'temperature', return_value=40):
+            self.assertFalse(self.reencoder.idle())
+
+    def test_idle_staging(self):
+        pathlib.Path(self.staging_folder, '2018-01-01_120000.h264').touch()
+        with patch.object(Reencoder, 'temperature', return_value=None):
+            self.assertFalse(self.reencoder.idle())
+
+    def test_reencode(self):
+        self.create_file('2018-01-01_120000_123.mp4', 100)
+        self.create_file('2018-01-01_120000_123.mp4.jpg')
+        self.create_file('2018-01-01_120000_123.mp4.proxy.mp4')
+        self.create_file('2018-01-01_120000_123.mp4.motion')
+        with patch('camera.reencode.subprocess.Popen', FakeProcess(10)), \
+                patch.object(Reencoder, 'temperature', return_value=None):
+            self.assertEqual(self.reencoder.run(7), (1, 100, 10))
+        self.assertFalse(self.exists('2018-01-01_120000_123.mp4'))
+        self.assertTrue(self.exists('2018-01-01_120000_123.small.mp4'))
+        self.assertTrue(self.exists('2018-01-01_120000_123.small.mp4.jpg'))
+        self.assertTrue(self.exists('2018-01-01_120000_123.small.mp4.proxy.mp4'))
+        self.assertTrue(self.exists('2018-01-01_120000_123.small.mp4.motion'))
+        self.assertGreater(self.file_manager.generation()[0], 0)
+        self.assertEqual(self.reencoder.aged_videos(7), [])
+
+    def test_reencode_not_smaller(self):
+        self.create_file('2018-01-01_120000_123.mp4', 10)
+        with patch('camera.reencode.subprocess.Popen', FakeProcess(100)), \
+                patch.object(Reencoder, 'temperature', return_value=None):
+            self.assertEqual(self.reencoder.run(7), (1, 10, 10))
+        self.assertTrue(self.exists('2018-01-01_120000_123.small.mp4'))
+        self.assertFalse(self.exists('2018-01-01_120000_123.small.mp4.part'))
+
+    def test_reencode_interrupted(self):
+        self.create_file('2018-01-01_120000_123.mp4', 100)
+        with patch('camera.reencode.subprocess.Popen', FakeProcess(10, timeouts=2)), \
+                patch.object(Reencoder, 'temperature', side_effect=(None, None, 80)):
+            self.assertEqual(self.reencoder.run(7), (0, 0, 0))
+        self.assertTrue(self.exists('2018-01-01_120000_123.mp4'))
+        self.assertEqual(os.listdir(self.folder), ['2018-01-01_120000_123.mp4'])
+
+    def test_retention_gain(self):
+        self.create_file('2018-01-01_120000_123.small.mp4', 10)
+        self.create_file('2018-01-02_120000_123.mp4', 100)
+        self.create_file('2018-01-03_120000_123.mp4', 300)
+        self.assertEqual(self.reencoder.retention_gain(400), 2)
+
+    def test_command(self):
+        out = io.StringIO()
+        with patch('camera.management.commands.reencode_videos.Reencoder') as reencoder:
+            reencoder.return_value.run.return_value = (2, 3 * 1024 * 1024, 1024 * 1024)
+            reencoder.return_value.retention_gain.return_value = 1.5
+            call_command('reencode_videos', '--folder', self.folder, '--days', '3', stdout=out)
+            reencoder.return_value.run.assert_called_with(3, None)
+        self.assertIn('2 videos re-encoded, 2.0 MB saved, about 1.5 more days', out.getvalue())
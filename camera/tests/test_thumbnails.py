@@ -0,0 +1,76 @@
+import os
+import pathlib
+import shutil
+
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from camera.thumbnails import ThumbnailPack
+
+
+class TestThumbnailPack(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = os.path.join(os.path.dirname(__file__), 'thumbnails')
+        pathlib.Path(self.folder).mkdir(parents=True, exist_ok=True)
+        self.pack = ThumbnailPack(os.path.join(self.folder, '2018-01-31_thumbnails'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_empty(self):
+        self.assertEqual(self.pack.entries(), [])
+        self.assertIsNone(self.pack.read('2018-01-31_120000'))
+        self.assertIsNone(self.pack.sprite((16, 12), 4))
+
+    def test_append_read(self):
+        self.pack.append('2018-01-31_120000', b'first')
+        self.pack.append('2018-01-31_130000', b'second')
+        self.assertEqual(self.pack.entries(), [('2018-01-31_120000', 0, 5),
+                                               ('2018-01-31_130000', 5, 6)])
+        self.assertEqual(self.pack.read('2018-01-31_120000'), b'first')
+        self.assertEqual(self.pack.read('2018-01-31_130000'), b'second')
+        self.assertEqual(self.pack.find('2018-01-31_130000'), (1, 5, 6))
+
+    def test_partial_index_record(self):
+        self.pack.append('2018-01-31_120000', b'first')
+        with open(self.pack.index_path, 'ab') as index:
+            index.write(b'2018')
+        self.assertEqual(len(self.pack.entries()), 1)
+
+    def test_sprite(self):
+        self.pack.append('2018-01-31_120000', b'first')
+
+        def ffmpeg(args, input):
+            self.assertIn('scale=16:12,tile=4x1', args)
+            self.assertEqual(input, b'first')
+            pathlib.Path(args[-1]).touch()
+
+        with patch('camera.thumbnails.subprocess.run', side_effect=ffmpeg) as run:
+            first_sprite = self.pack.sprite((16, 12), 4)
+            self.assertEqual(first_sprite, self.pack.sprite_path(1))
+            self.assertTrue(os.path.exists(first_sprite))
+            self.pack.sprite((16, 12), 4)
+            self.assertEqual(run.call_count, 1)
+            self.pack.append('2018-01-31_130000', b'second')
+            run.side_effect = lambda args, input: pathlib.Path(args[-1]).touch()
+            self.assertEqual(self.pack.sprite((16, 12), 4), self.pack.sprite_path(2))
+            self.assertFalse(os.path.exists(first_sprite))
+
+    def test_sprite_old_sprite_gone(self):
+        self.pack.append('2018-01-31_120000', b'first')
+        with patch('camera.thumbnails.subprocess.run',
+                   side_effect=lambda args, input: pathlib.Path(args[-1]).touch()), \
+                patch('camera.thumbnails.glob', return_value=[self.pack.sprite_path(0)]):
+            self.assertEqual(self.pack.sprite((16, 12), 4), self.pack.sprite_path(1))
+
+    def test_sprite_failed(self):
+        self.pack.append('2018-01-31_120000', b'first')
+        with patch('camera.thumbnails.subprocess.run'):
+            self.assertIsNone(self.pack.sprite((16, 12), 4))
+
+    def test_remove(self):
+        self.pack.append('2018-01-31_120000', b'first')
+        self.pack.remove()
+        self.assertEqual(os.listdir(self.folder), [])
@@ -0,0 +1,97 @@
+import os
+import pathlib
+import struct
+
+from contextlib import contextmanager
+from datetime import date, datetime
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+from django.utils.timezone import utc
+
+from camera.tests.test_capture import SimpleFileManager
+from camera.timelapse import Timelapse, timelapse_conversion
+
+
+class FakeLiveFeed:
+
+    def __init__(self):
+        self.frame = None
+
+    @contextmanager
+    def latest_snapshot(self):
+        if self.frame is None:
+            yield None
+        else:
+            yield memoryview(struct.pack('I', len(self.frame)) + self.frame)
+
+
+class TestTimelapse(SimpleTestCase):
+
+    def setUp(self):
+        self.file_manager = SimpleFileManager()
+        self.addCleanup(self.file_manager.clean_files)
+        self.live_feed = FakeLiveFeed()
+        self.timelapse = Timelapse(self.file_manager, self.live_feed, interval=10, framerate=25)
+
+    def sample(self, frame, tick, day=31):
+        self.live_feed.frame = frame
+        with patch('camera.timelapse.monotonic', return_value=tick), \
+                patch('camera.timelapse.now', return_value=datetime(2018, 1, day, 12, tzinfo=utc)):
+            self.timelapse.sample()
+
+    def frames(self, day=31) -> bytes:
+        with open(self.timelapse.frames_path(date(2018, 1, day)), 'rb') as f:
+            return f.read()
+
+    def test_sample(self):
+        self.sample(None, 100)
+        self.sample(b'a', 100)
+        # Not before the interval is over
+        self.sample(b'b', 105)
+        self.sample(b'c', 110)
+        self.assertFalse(os.path.exists(self.timelapse.frames_path(date(2018, 1, 31))))
+        self.timelapse.flush()
+        self.assertEqual(self.frames(), b'ac')
+
+    def test_sample_flush_size(self):
+        with patch.object(Timelapse, 'FLUSH_SIZE', 3):
+            self.sample(b'ab', 100)
+            self.sample(b'cd', 110)
+            self.sample(b'ef', 120)
+        # Appended in large writes
+        self.assertEqual(self.frames(), b'abcd')
+
+    def test_next_day(self):
+        self.sample(b'a', 100, day=30)
+        with patch.object(Timelapse, 'finish') as finish:
+            self.sample(b'b', 110, day=31)
+        # The day before is finished with all of its frames
+        finish.assert_called_once_with(date(2018, 1, 30))
+        self.assertEqual(self.frames(30), b'a')
+
+    def test_finish_pending(self):
+        self.file_manager.create_file('2018-01-30' + Timelapse.FRAMES_SUFFIX)
+        self.file_manager.create_file('2018-01-31' + Timelapse.FRAMES_SUFFIX)
+        with patch('camera.timelapse.now', return_value=datetime(2018, 1, 31, 12, tzinfo=utc)), \
+                patch('camera.timelapse.Process') as process:
+            self.timelapse.finish_pending()
+        self.assertEqual(process.call_count, 1)
+        self.assertEqual(process.call_args[1]['args'][1], date(2018, 1, 30))
+
+    def test_conversion(self):
+        self.file_manager.create_file('2018-01-30' + Timelapse.FRAMES_SUFFIX)
+        frames_path = self.timelapse.frames_path(date(2018, 1, 30))
+        timelapse_path = self.file_manager.complete_path(Timelapse.name(date(2018, 1, 30)))
+
+        def run(command, **kwargs):
+            pathlib.Path(command[-1]).touch()
+            return type('Process', (), dict(returncode=0))
+
+        with patch('camera.timelapse.subprocess.run', side_effect=run) as ffmpeg:
+            timelapse_conversion(frames_path, timelapse_path, 25)
+        command = ffmpeg.call_args[0][0]
+        self.assertEqual(command[command.index('-i') - 3:command.index('-i') + 2],
+                         ('mjpeg', '-framerate', '25', '-i', frames_path))
+        self.assertTrue(os.path.exists(timelapse_path))
+        self.assertFalse(os.path.exists(frames_path))
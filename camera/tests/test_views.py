@@ -1,18 +1,25 @@
+import os
+import socket
 
+from array import array
 from unittest.mock import Mock, patch
 
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.test import TestCase
 
+from camera.capture import Capture, FileManager
 from camera.client import CameraClient, FeedCommand
 from camera.management.commands.camera_server import Command
 from camera.models import CameraSettings
+from camera.motion import MotionTrack
 
 
 class FakeFeedCommand:
-    def __init__(self):
-        self.response = b''
+    def __init__(self, sequence=0, response=b'', age=None):
+        self.sequence = sequence
+        self.response = response
+        self.age = age
 
 
 class TestViews(TestCase):
@@ -21,6 +28,38 @@ class TestViews(TestCase):
         user = User.objects.create(username='test')
         self.client.force_login(user)
 
+    def test_browse_cache(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        with self.settings(CAMERA_STORAGE_FOLDER=folder):
+            file_manager = FileManager(folder)
+            file_manager.bump_generation()
+            self.addCleanup(os.unlink, os.path.join(folder, FileManager.GENERATION_FILE))
+            result = self.client.get(reverse('browse'))
+            self.assertEqual(result.status_code, 200)
+            etag = result['ETag']
+            self.assertIn('Last-Modified', result)
+            with patch.object(FileManager, 'list_videos') as list_videos:
+                result = self.client.get(reverse('browse'), HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(result.status_code, 304)
+                result = self.client.get(reverse('browse'))
+                self.assertEqual(result.status_code, 200)
+                self.assertEqual(list_videos.call_count, 0)
+                file_manager.bump_generation()
+                list_videos.return_value = []
+                result = self.client.get(reverse('browse'), HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(result.status_code, 200)
+                self.assertNotEqual(result['ETag'], etag)
+                self.assertEqual(list_videos.call_count, 1)
+
+    def test_browse_aggregator(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        nodes = (dict(name='garden', url='http://garden', token='t'),)
+        with self.settings(CAMERA_STORAGE_FOLDER=folder, CAMERA_AGGREGATOR_NODES=nodes):
+            FileManager(folder).bump_generation()
+            self.addCleanup(os.unlink, os.path.join(folder, FileManager.GENERATION_FILE))
+            result = self.client.get(reverse('browse'))
+        self.assertContains(result, 'href="{}"'.format(reverse('cameras')))
+
     def test_get_views(self):
         for view_name in ('browse', 'live_preview', 'camera_config'):
             view_url = reverse(view_name)
@@ -35,11 +74,366 @@ class TestViews(TestCase):
             self.assertEqual(len(result.content), 0)
             self.assertEqual(result['Cache-Control'], 'max-age=0, must-revalidate')
 
+    def test_still_frame_size(self):
+        view_url = reverse('still_frame')
+        with patch('camera.views.FeedCommand', return_value=FakeFeedCommand()) as feed:
+            result = self.client.get(view_url, dict(size='small'))
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(feed.call_args[0][0], 'small')
+
+    def test_still_frame_etag(self):
+        view_url = reverse('still_frame')
+        with patch('camera.views.FeedCommand', return_value=FakeFeedCommand(5, b'12', 1.25)):
+            result = self.client.get(view_url, dict(size='small'))
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(result['ETag'], '"{}-5"'.format(Capture.rendition_index('small')))
+            self.assertEqual(result['X-Frame-Age'], '1.2')
+
+    def test_still_frame_not_modified(self):
+        view_url = reverse('still_frame')
+        etag = '"{}-5"'.format(Capture.rendition_index('small'))
+        with patch('camera.views.FeedCommand', return_value=FakeFeedCommand(5, None, 0)) as feed:
+            result = self.client.get(view_url, dict(size='small'), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(result.status_code, 304)
+            self.assertEqual(feed.call_args[0], ('small', 5))
+
+    def test_still_frame_no_answer(self):
+        with patch('camera.views.FeedCommand', side_effect=socket.timeout()):
+            result = self.client.get(reverse('still_frame'))
+            self.assertEqual(result.status_code, 503)
+
+    def test_still_frame_unknown_size(self):
+        view_url = reverse('still_frame')
+        with patch('camera.views.FeedCommand', return_value=FakeFeedCommand()) as feed:
+            result = self.client.get(view_url, dict(size='unknown'))
+            self.assertEqual(result.status_code, 400)
+            self.assertEqual(feed.call_count, 0)
+
+    def test_live_status(self):
+        view_url = reverse('live_status')
+        health = dict(stale=False, frame_age=.5)
+        with patch('camera.views.PingCommand', return_value=Mock(response=health)):
+            result = self.client.get(view_url)
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(result.json(), health)
+            self.assertEqual(result['Cache-Control'], 'no-store')
+        with patch('camera.views.PingCommand', side_effect=ConnectionRefusedError()):
+            result = self.client.get(view_url)
+            self.assertEqual(result.status_code, 503)
+            self.assertTrue(result.json()['stale'])
+
+    def test_live_stream(self):
+        view_url = reverse('live_stream')
+        self.assertEqual(self.client.get(view_url).status_code, 404)
+        self.assertNotContains(self.client.get(reverse('live_preview')), view_url)
+        with self.settings(CAMERA_LIVE_STREAM=dict(resize=(640, 480))):
+            self.assertContains(self.client.get(reverse('live_preview')), view_url)
+            with patch('camera.views.StreamCommand') as command:
+                command.return_value.segments.return_value = iter((b'ftyp', b'moof'))
+                result = self.client.get(view_url)
+                self.assertEqual(result.status_code, 200)
+                self.assertEqual(result['Content-Type'], 'video/mp4')
+                self.assertEqual(b''.join(result.streaming_content), b'ftypmoof')
+
     def test_media_file(self):
         url = reverse('media_file', args=('notfound.txt',))
         result = self.client.get(url)
         self.assertEqual(result.status_code, 404)
 
+    def media_file_get(self, name, **kwargs):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write('1')
+        try:
+            with self.settings(MEDIA_ROOT=folder):
+                return self.client.get(reverse('media_file', args=(name,)), **kwargs)
+        finally:
+            os.unlink(os.path.join(folder, name))
+
+    def test_media_file_finished(self):
+        for name in ('2018-01-31_120000_123.mp4', '2018-01-31_120000_123.mp4.jpg'):
+            result = self.media_file_get(name)
+            self.assertEqual(result.status_code, 200)
+            self.assertIn('immutable', result['Cache-Control'])
+            self.assertTrue(result['ETag'].startswith('"'))
+
+    def test_media_file_in_progress(self):
+        for name in ('2018-01-31_120000.h264.jpg', '2018-01-31_120000_123.mp4.part'):
+            result = self.media_file_get(name)
+            self.assertEqual(result.status_code, 200)
+            self.assertNotIn('immutable', result['Cache-Control'])
+
+    def test_media_file_not_modified(self):
+        with patch('camera.views.sendfile') as sendfile:
+            result = self.media_file_get('2018-01-31_120000_123.mp4', HTTP_IF_NONE_MATCH='*')
+            self.assertEqual(result.status_code, 304)
+            self.assertEqual(sendfile.call_count, 0)
+
+    def test_media_file_outside_media_root(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        with self.settings(MEDIA_ROOT=folder):
+            result = self.client.get(reverse('media_file', args=('../test_views.py',)))
+            self.assertEqual(result.status_code, 404)
+
+    def test_browse_sprite(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        file_manager = FileManager(folder)
+        with open(os.path.join(folder, '2018-01-31_120000_123.mp4'), 'w') as f:
+            f.write('1')
+        pack = file_manager.thumbnail_pack('2018-01-31')
+        for key in ('2018-01-31_110000', '2018-01-31_120000'):
+            pack.append(key, b'1')
+        try:
+            with self.settings(CAMERA_STORAGE_FOLDER=folder, CAMERA_THUMBNAIL_SPRITE_TILE=(16, 12),
+                               CAMERA_THUMBNAIL_SPRITE_COLUMNS=1):
+                result = self.client.get(reverse('browse'))
+            self.assertContains(result, 'url(sprite/2018-01-31?v=2) -0px -12px')
+        finally:
+            pack.remove()
+            os.unlink(os.path.join(folder, '2018-01-31_120000_123.mp4'))
+
+    def test_browse_proxy(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        FileManager(folder).bump_generation()
+        names = ('2018-01-31_120000_123.mp4', '2018-01-31_120000_123.mp4.proxy.mp4')
+        for name in names:
+            with open(os.path.join(folder, name), 'w') as f:
+                f.write('1')
+        try:
+            with self.settings(CAMERA_STORAGE_FOLDER=folder):
+                result = self.client.get(reverse('browse'))
+            # The proxy plays by default, the full quality video is a click away
+            self.assertContains(result, 'href="media/2018-01-31_120000_123.mp4.proxy.mp4"')
+            self.assertContains(result, 'href="media/2018-01-31_120000_123.mp4" title="Full quality"')
+        finally:
+            for name in names + (FileManager.GENERATION_FILE,):
+                os.unlink(os.path.join(folder, name))
+
+    def test_browse_timelapse(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        FileManager(folder).bump_generation()
+        names = ('2018-01-31_120000_123.mp4', '2018-01-31_timelapse.mp4', '2018-01-30_timelapse.mp4')
+        for name in names:
+            with open(os.path.join(folder, name), 'w') as f:
+                f.write('1')
+        try:
+            with self.settings(CAMERA_STORAGE_FOLDER=folder):
+                result = self.client.get(reverse('browse'))
+            self.assertContains(result, 'href="media/2018-01-31_timelapse.mp4" title="Time-lapse"')
+            # Only the days with recordings are listed
+            self.assertNotContains(result, '2018-01-30_timelapse.mp4')
+        finally:
+            for name in names + (FileManager.GENERATION_FILE,):
+                os.unlink(os.path.join(folder, name))
+
+    def test_thumbnail(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        pack = FileManager(folder).thumbnail_pack('2018-01-31')
+        pack.append('2018-01-31_120000', b'thumbnail')
+        try:
+            with self.settings(CAMERA_STORAGE_FOLDER=folder):
+                url = reverse('thumbnail', args=('2018-01-31_120000_123.mp4',))
+                result = self.client.get(url)
+                self.assertEqual(result.status_code, 200)
+                self.assertEqual(result.content, b'thumbnail')
+                self.assertIn('immutable', result['Cache-Control'])
+                result = self.client.get(url, HTTP_IF_NONE_MATCH=result['ETag'])
+                self.assertEqual(result.status_code, 304)
+                result = self.client.get(reverse('thumbnail', args=('2018-01-31_130000_123.mp4',)))
+                self.assertEqual(result.status_code, 404)
+                result = self.client.get(reverse('thumbnail', args=('test.mp4',)))
+                self.assertEqual(result.status_code, 404)
+        finally:
+            pack.remove()
+
+    def test_thumbnail_sprite(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        with self.settings(CAMERA_STORAGE_FOLDER=folder):
+            result = self.client.get(reverse('thumbnail_sprite', args=('2018-01-31',)))
+            self.assertEqual(result.status_code, 404)
+            with patch('camera.thumbnails.ThumbnailPack.sprite', return_value=__file__):
+                result = self.client.get(reverse('thumbnail_sprite', args=('2018-01-31',)))
+                self.assertEqual(result.status_code, 200)
+                self.assertIn('immutable', result['Cache-Control'])
+
+    def test_clip(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        name = '2018-01-31_120000_123.mp4'
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write('1')
+        try:
+            with self.settings(MEDIA_ROOT=folder), \
+                    patch('camera.views.KeyframeIndex.gop_bounds', return_value=(10, 30)), \
+                    patch('camera.views.clip_stream', return_value=iter((b'12', b'34'))) as stream:
+                result = self.client.get(reverse('clip', args=(name,)), dict(start=12, end=25))
+                self.assertEqual(result.status_code, 200)
+                self.assertEqual(b''.join(result.streaming_content), b'1234')
+                self.assertEqual(stream.call_args[0][1:], (10, 20))
+                self.assertIn('2018-01-31_120000_123_10-30.mp4', result['Content-Disposition'])
+                for params in (dict(start='x'), dict(start=-1), dict(start=5, end=2)):
+                    result = self.client.get(reverse('clip', args=(name,)), params)
+                    self.assertEqual(result.status_code, 400)
+        finally:
+            os.unlink(os.path.join(folder, name))
+        result = self.client.get(reverse('clip', args=(name,)))
+        self.assertEqual(result.status_code, 404)
+
+    def test_motion(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        name = '2018-01-31_120000_123.mp4'
+        MotionTrack(2, array('B', (MotionTrack.SENSOR, 0, 40, 100))).save(
+            os.path.join(folder, name + MotionTrack.SUFFIX))
+        try:
+            with self.settings(MEDIA_ROOT=folder, CAMERA_MOTION_PEAKS=1):
+                result = self.client.get(reverse('motion', args=(name,)), dict(bins=2))
+                self.assertEqual(result.status_code, 200)
+                self.assertEqual(result.json(), dict(duration=2, bins=[0, 100], sensor=[0], peaks=[1.5]))
+                self.assertIn('immutable', result['Cache-Control'])
+                result = self.client.get(reverse('motion', args=(name,)), dict(bins=2),
+                                         HTTP_IF_NONE_MATCH=result['ETag'])
+                self.assertEqual(result.status_code, 304)
+                for bins in ('x', 0):
+                    result = self.client.get(reverse('motion', args=(name,)), dict(bins=bins))
+                    self.assertEqual(result.status_code, 400)
+                result = self.client.get(reverse('motion', args=('2018-01-31_130000_123.mp4',)))
+                self.assertEqual(result.status_code, 404)
+        finally:
+            os.unlink(os.path.join(folder, name + MotionTrack.SUFFIX))
+
+    def test_play(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        names = ('2018-01-31_120000_123.mp4', '2018-01-31_120000_123.mp4.proxy.mp4')
+        for name in names:
+            with open(os.path.join(folder, name), 'w') as f:
+                f.write('1')
+        try:
+            with self.settings(MEDIA_ROOT=folder):
+                result = self.client.get(reverse('play', args=(names[0],)))
+                self.assertContains(result, 'src="/media/2018-01-31_120000_123.mp4.proxy.mp4"')
+                self.assertContains(result, 'href="/media/2018-01-31_120000_123.mp4" title="Full quality"')
+                self.assertContains(result, '/motion/2018-01-31_120000_123.mp4')
+                result = self.client.get(reverse('play', args=(names[1],)))
+                self.assertEqual(result.status_code, 404)
+        finally:
+            for name in names:
+                os.unlink(os.path.join(folder, name))
+
+    def export_get(self, params, **kwargs):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        name = '2018-01-31_120000_123.mp4'
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write('1' * 1000)
+        try:
+            with self.settings(CAMERA_STORAGE_FOLDER=folder, CAMERA_EXPORT_RATE=None):
+                result = self.client.get(reverse('export'), params, **kwargs)
+                return result, b''.join(getattr(result, 'streaming_content', ()))
+        finally:
+            os.unlink(os.path.join(folder, name))
+
+    def test_export(self):
+        result, content = self.export_get(dict(start='2018-01-31'))
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(int(result['Content-Length']), len(content))
+        self.assertEqual(len(content), 3 * 512 + 1024)
+        self.assertIn(b'2018-01-31_120000_123.mp4', content)
+        result, content = self.export_get(dict(start='2018-01-30', end='2018-01-30'))
+        self.assertEqual(len(content), 1024)
+        result, content = self.export_get(dict(start='2018-01-31T11:00:00+00:00',
+                                               end='2018-01-31T12:00:00+00:00'))
+        self.assertEqual(len(content), 1024)
+
+    def test_export_range(self):
+        result, content = self.export_get(dict(start='2018-01-31'))
+        etag = result['ETag']
+        result, part = self.export_get(dict(start='2018-01-31'), HTTP_RANGE='bytes=500-')
+        self.assertEqual(result.status_code, 206)
+        self.assertEqual(result['Content-Range'], 'bytes 500-2559/2560')
+        self.assertEqual(part, content[500:])
+        result, part = self.export_get(dict(start='2018-01-31'), HTTP_RANGE='bytes=-10',
+                                       HTTP_IF_RANGE=etag)
+        self.assertEqual(part, content[-10:])
+        result, part = self.export_get(dict(start='2018-01-31'), HTTP_RANGE='bytes=10-19',
+                                       HTTP_IF_RANGE='"other"')
+        self.assertEqual(result.status_code, 200)
+        result, part = self.export_get(dict(start='2018-01-31'), HTTP_RANGE='bytes=5000-')
+        self.assertEqual(result.status_code, 416)
+
+    def test_export_bad_request(self):
+        for params in (dict(), dict(start='x'), dict(start='2018-01-31', end='2018-01-30'),
+                       dict(start='2018-02-31')):
+            result = self.client.get(reverse('export'), params)
+            self.assertEqual(result.status_code, 400)
+
+    def test_activity(self):
+        folder = os.path.join(os.path.dirname(__file__), 'capture')
+        with self.settings(CAMERA_STORAGE_FOLDER=folder):
+            file_manager = FileManager(folder)
+            file_manager.log_activity(True, '2018-01-31_120000_10.mp4')
+            try:
+                result = self.client.get(reverse('activity'))
+                self.assertEqual(result.status_code, 200)
+                result = self.client.get(reverse('activity'), dict(start='2018-01-31'))
+                self.assertEqual(result.status_code, 200)
+                self.assertContains(result, 'media/2018-01-31_120000_10.mp4')
+                result = self.client.get(reverse('activity'), dict(start='2018-01-31', format='json'))
+                self.assertEqual(result.json()['heatmap'],
+                                 [dict(hour='2018-01-31T12:00:00+00:00', recordings=1, seconds=10)])
+                self.assertEqual(len(result.json()['recordings']), 1)
+                result = self.client.get(reverse('activity'), dict(start='x'))
+                self.assertEqual(result.status_code, 400)
+            finally:
+                os.unlink(os.path.join(folder, FileManager.ACTIVITY_FILE))
+
+    def test_node_videos(self):
+        url = reverse('node_videos')
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with self.settings(CAMERA_NODE_TOKEN='secret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Token wrong').status_code, 403)
+            with patch.object(FileManager, 'list_videos', return_value=[]):
+                result = self.client.get(url, HTTP_AUTHORIZATION='Token secret')
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(result.json(), dict(videos=[]))
+
+    def test_cameras(self):
+        self.assertEqual(self.client.get(reverse('cameras')).status_code, 404)
+        nodes = (dict(name='garden', url='http://garden', token='t'),)
+        with self.settings(CAMERA_AGGREGATOR_NODES=nodes):
+            with patch('camera.views.timeline', return_value=([], ['garden'])):
+                result = self.client.get(reverse('cameras'))
+            self.assertContains(result, 'Not available: garden')
+            self.assertContains(result, 'All Cameras Live')
+            result = self.client.get(reverse('cameras_live'))
+            self.assertContains(result, 'data-node="garden"')
+
+    def test_camera_still_frame(self):
+        nodes = (dict(name='garden', url='http://garden', token='t'),)
+        with self.settings(CAMERA_AGGREGATOR_NODES=nodes):
+            with patch('camera.views.node_frame', return_value=b'frame'):
+                result = self.client.get(reverse('camera_still_frame', args=('garden',)))
+                self.assertEqual(result.content, b'frame')
+            with patch('camera.views.node_frame', return_value=None):
+                result = self.client.get(reverse('camera_still_frame', args=('garden',)))
+                self.assertEqual(result.status_code, 504)
+            result = self.client.get(reverse('camera_still_frame', args=('door',)))
+            self.assertEqual(result.status_code, 404)
+
+    def test_camera_file(self):
+        nodes = (dict(name='garden', url='http://garden', token='t'),)
+        remote = Mock()
+        remote.read.side_effect = (b'12', b'34', b'')
+        remote.headers = {'Content-Type': 'video/mp4', 'Content-Length': '4'}
+        with self.settings(CAMERA_AGGREGATOR_NODES=nodes):
+            with patch('camera.aggregator.Node.open', return_value=remote) as node_open:
+                result = self.client.get(reverse('camera_file', args=('garden', 'media', 'a b.mp4')))
+                self.assertEqual(b''.join(result.streaming_content), b'1234')
+                self.assertEqual(node_open.call_args[0], ('media/a%20b.mp4',))
+                self.assertEqual(result['Content-Length'], '4')
+            self.assertEqual(remote.close.call_count, 1)
+            with patch('camera.aggregator.Node.open', side_effect=IOError):
+                result = self.client.get(reverse('camera_file', args=('garden', 'thumbnail', 'a.mp4')))
+                self.assertEqual(result.status_code, 504)
+
     def test_shutdown(self):
         view_url = reverse('shutdown')
         with patch('camera.views.os.system') as osys:
@@ -49,7 +443,8 @@ class TestViews(TestCase):
 
     def test_config_post(self):
         post_data = dict(brightness=11, hflip=True, vflip=True,
-                         contrast=21, days_kept=300, max_mb=1000)
+                         contrast=21, days_kept=300, max_mb=1000,
+                         bitrate=5000, quality=20, intra_period=30)
         url = reverse('camera_config')
         with patch('camera.views.CameraClient') as init:
             result = self.client.post(url, post_data)
@@ -63,3 +458,19 @@ class TestViews(TestCase):
             self.assertEqual(cam_settings.contrast, 21)
             self.assertEqual(cam_settings.days_kept, 300)
             self.assertEqual(cam_settings.max_mb, 1000)
+            self.assertEqual(cam_settings.bitrate, 5000)
+            self.assertEqual(cam_settings.quality, 20)
+            self.assertEqual(cam_settings.intra_period, 30)
+
+    def test_config_storage_plan(self):
+        url = reverse('camera_config')
+        with patch.object(FileManager, 'plan_storage', return_value=None):
+            result = self.client.get(url)
+            self.assertNotContains(result, 'Storage Planner')
+        plan = dict(bytes_per_second=1024, recordings_per_day=2, seconds_per_day=60,
+                    days=12.5, days_at_bitrate=None)
+        with patch.object(FileManager, 'plan_storage', return_value=plan) as plan_storage:
+            result = self.client.get(url)
+            self.assertContains(result, 'Storage Planner')
+            self.assertContains(result, '<span id="plan-days">12.5</span>')
+            self.assertEqual(plan_storage.call_args[0], (256, 17000))
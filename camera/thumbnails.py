@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import struct
+import subprocess
+
+from glob import glob
+from math import ceil
+from typing import List, Tuple
+
+
+class ThumbnailPack:
+    """Append-only store for the thumbnails of one day. Thumbnails are
+    concatenated in a pack file and found through an index file of fixed
+    size records holding the key, offset and length of each one. Records are
+    only written after their thumbnail, so other processes can read the pack
+    while the capture daemon keeps adding to it
+    """
+
+    PACK_SUFFIX = '.pack'
+    INDEX_SUFFIX = '.idx'
+    SPRITE_SUFFIX = '.sprite.jpg'
+    # Key, the YYYY-MM-DD_HHMMSS timestamp of the video, offset and length
+    INDEX_RECORD = struct.Struct('<17sQI')
+
+    def __init__(self, path: str):
+        """
+        :param path: the path of the pack files without their extension
+        """
+        self._path = path
+
+    @property
+    def pack_path(self) -> str:
+        return self._path + self.PACK_SUFFIX
+
+    @property
+    def index_path(self) -> str:
+        return self._path + self.INDEX_SUFFIX
+
+    def sprite_path(self, entries: int) -> str:
+        """Returns the path of the sprite sheet for the first entries of the
+        index. Sprite sheets are never rewritten, they get a new name when
+        the pack grows
+        """
+        return '{}.{}{}'.format(self._path, entries, self.SPRITE_SUFFIX)
+
+    def append(self, key: str, data: bytes):
+        """Adds a thumbnail to the pack
+        :param key: the timestamp of the video the thumbnail belongs to
+        :param data: the JPEG image
+        """
+        with open(self.pack_path, 'ab') as pack:
+            offset = pack.tell()
+            pack.write(data)
+        with open(self.index_path, 'ab') as index:
+            index.write(self.INDEX_RECORD.pack(key.encode('ascii'), offset, len(data)))
+
+    def entries(self) -> List[Tuple[str, int, int]]:
+        """Returns the key, offset and length of the thumbnails in the pack,
+        in the order they were added
+        """
+        try:
+            with open(self.index_path, 'rb') as index:
+                data = index.read()
+        except IOError:
+            return []
+        # A record being written right now is left for the next time
+        data = data[:len(data) - len(data) % self.INDEX_RECORD.size]
+        return [(key.decode('ascii'), offset, length)
+                for key, offset, length in self.INDEX_RECORD.iter_unpack(data)]
+
+    def find(self, key: str) -> Tuple[int, int]:
+        """Returns the position of a thumbnail in the index, its offset and
+        its length, or None if the thumbnail is not in the pack
+        """
+        for position, (entry_key, offset, length) in reversed(list(enumerate(self.entries()))):
+            if entry_key == key:
+                return position, offset, length
+        return None
+
+    def read(self, key: str) -> bytes:
+        """Returns a thumbnail sliced out of the memory mapped pack, or None
+        if it is not in the pack
+        """
+        entry = self.find(key)
+        if entry is None:
+            return None
+        _, offset, length = entry
+        with open(self.pack_path, 'rb') as pack:
+            with mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ) as mapped_pack:
+                return mapped_pack[offset:offset + length]
+
+    def sprite(self, tile: Tuple[int, int], columns: int) -> str:
+        """Returns the path of a sprite sheet with every thumbnail in the
+        pack, in index order, scaled to the tile size and laid out in rows of
+        the given number of columns. It is built with ffmpeg the first time
+        it is asked for, which is usually by the housekeeper right after the
+        pack grows
+        :return the path of the sprite sheet or None if the pack is empty
+        or the sprite sheet could not be built
+        """
+        entries = self.entries()
+        if not entries:
+            return None
+        sprite_path = self.sprite_path(len(entries))
+        if os.path.exists(sprite_path):
+            return sprite_path
+        temp_path = '{}.{}'.format(sprite_path, os.getpid())
+        with open(self.pack_path, 'rb') as pack:
+            with mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ) as mapped_pack:
+                thumbnails = b''.join(mapped_pack[offset:offset + length]
+                                      for _, offset, length in entries)
+        subprocess.run(('ffmpeg',
+                        '-loglevel', 'error',
+                        '-f', 'mjpeg',
+                        '-i', 'pipe:0',
+                        '-vf', 'scale={}:{},tile={}x{}'.format(tile[0], tile[1], columns,
+                                                               ceil(len(entries) / columns)),
+                        '-frames:v', '1',
+                        '-f', 'image2',
+                        '-y', temp_path),
+                       input=thumbnails)
+        if not os.path.exists(temp_path):
+            return None
+        os.replace(temp_path, sprite_path)
+        # Older sprite sheets are of no use anymore
+        for old_sprite in glob(self._path + '.*' + self.SPRITE_SUFFIX):
+            if old_sprite != sprite_path:
+                # Another process may have removed it already
+                try:
+                    os.unlink(old_sprite)
+                except FileNotFoundError:
+                    pass
+        return sprite_path
+
+    def remove(self):
+        """Removes the pack, its index and its sprite sheets
+        """
+        for f in glob(self._path + '.*'):
+            try:
+                os.unlink(f)
+            except IOError:
+                pass
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import subprocess
+
+from datetime import date
+from multiprocessing import Process
+from time import monotonic
+
+from django.conf import settings
+from django.utils.dateparse import parse_date
+from django.utils.timezone import now
+
+from camera.housekeeping import Housekeeper
+
+
+def timelapse_conversion(frames_path: str, timelapse_path: str, framerate: int):
+    """Encodes the frames of a day into its time-lapse, with the options in
+    settings.CAMERA_TIMELAPSE_OUTPUT, and deletes them. Like the videos, the
+    time-lapse only gets its name once it is complete
+    :param frames_path: the JPEG frames, one after the other
+    :param timelapse_path: the resulting video
+    :param framerate: the frame rate of the time-lapse
+    """
+    # See FileManager.PARTIAL_SUFFIX, leftovers are removed on start
+    partial_path = timelapse_path + '.part'
+    process = subprocess.run(('ffmpeg', '-loglevel', 'error',
+                              '-f', 'mjpeg',
+                              '-framerate', str(framerate),
+                              '-i', frames_path,
+                              '-an') +
+                             tuple(settings.CAMERA_TIMELAPSE_OUTPUT) +
+                             ('-f', 'mp4', '-y', partial_path),
+                             preexec_fn=lambda: os.nice(19))
+    if process.returncode == 0 and os.path.exists(partial_path):
+        os.replace(partial_path, timelapse_path)
+        os.unlink(frames_path)
+    else:
+        try:
+            os.unlink(partial_path)
+        except IOError:
+            pass
+
+
+class Timelapse:
+    """Daily time-lapse made of live preview frames. Every so often the
+    latest frame of a live feed is taken, with no capture of its own, and
+    appended to the frames of the day, a plain MJPEG stream. Once the day
+    is over its frames are encoded into a video, which retention manages
+    together with the recordings of the day, see
+    FileManager.apply_storage_policy. Days are UTC days, as in the names of
+    the recordings
+    """
+
+    FRAMES_SUFFIX = '_timelapse.mjpeg'
+    SUFFIX = '_timelapse.mp4'
+    NAME_RE = re.compile('(\\d{4}-\\d{2}-\\d{2})' + re.escape(SUFFIX))
+    FRAMES_RE = re.compile('(\\d{4}-\\d{2}-\\d{2})' + re.escape(FRAMES_SUFFIX))
+    # Bytes of frames kept in memory before they are appended to the card,
+    # so that it gets a few large writes rather than one per frame
+    FLUSH_SIZE = 1024 * 1024
+
+    def __init__(self, file_manager, live_feed, housekeeper: Housekeeper=None,
+                 interval: float=None, framerate: int=None):
+        """
+        :param file_manager: the FileManager of the capture folder
+        :param live_feed: the LiveFeed the frames are taken from
+        :param housekeeper: the housekeeper that writes the frames, by
+        default they are written straight away
+        :param interval: the seconds between frames, by default
+        settings.CAMERA_TIMELAPSE['interval']
+        :param framerate: the frame rate of the time-lapse, by default
+        settings.CAMERA_TIMELAPSE['framerate']
+        """
+        options = settings.CAMERA_TIMELAPSE or dict()
+        self._file_manager = file_manager
+        self._live_feed = live_feed
+        self._housekeeper = housekeeper if housekeeper is not None else Housekeeper()
+        self._interval = interval or options.get('interval', 10)
+        self._framerate = framerate or options.get('framerate', 25)
+        self._next_sample = 0
+        self._day = None
+        self._frames = []
+        self._frames_size = 0
+
+    @classmethod
+    def name(cls, day: date) -> str:
+        return day.isoformat() + cls.SUFFIX
+
+    def frames_path(self, day: date) -> str:
+        return self._file_manager.complete_path(day.isoformat() + self.FRAMES_SUFFIX)
+
+    def sample(self):
+        """Takes the latest frame of the live feed once the interval is over,
+        called every time the live preview is refreshed. The frames of the
+        day before are encoded as soon as the first frame of a day is taken
+        """
+        tick = monotonic()
+        if tick < self._next_sample:
+            return
+        with self._live_feed.latest_snapshot() as snapshot:
+            if snapshot is None:
+                return
+            frame = bytes(snapshot[4:])
+        self._next_sample = tick + self._interval
+        day = now().date()
+        if day != self._day:
+            if self._day is not None:
+                self.flush()
+                self._housekeeper.schedule(self.finish, self._day)
+            self._day = day
+        self._frames.append(frame)
+        self._frames_size += len(frame)
+        if self._frames_size >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Appends the frames taken so far to the frames of the day
+        """
+        if self._frames:
+            self._housekeeper.schedule(self.append, self._day, b''.join(self._frames))
+            self._frames = []
+            self._frames_size = 0
+
+    def append(self, day: date, frames: bytes):
+        frames_path = self.frames_path(day)
+        os.makedirs(os.path.dirname(frames_path), exist_ok=True)
+        with open(frames_path, 'ab') as f:
+            f.write(frames)
+
+    def finish(self, day: date):
+        """Encodes the frames of a day in a process of its own, as videos are
+        """
+        frames_path = self.frames_path(day)
+        if os.path.exists(frames_path):
+            Process(target=self._convert, args=(frames_path, day)).start()
+
+    def _convert(self, frames_path: str, day: date):
+        timelapse_conversion(frames_path, self._file_manager.complete_path(self.name(day)), self._framerate)
+        self._file_manager.bump_generation()
+
+    def finish_pending(self):
+        """Encodes the frames of the days before today that were left when
+        the camera server stopped
+        """
+        today = now().date()
+        for frames_file in self._file_manager.glob('*' + self.FRAMES_SUFFIX):
+            name_parts = self.FRAMES_RE.fullmatch(frames_file.name)
+            if name_parts and name_parts.group(1) < today.isoformat():
+                self.finish(parse_date(name_parts.group(1)))
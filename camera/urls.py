@@ -2,14 +2,36 @@ from django.conf.urls import url
 from django.contrib.auth.decorators import login_required
 from django.urls import path
 from camera.views import browse, still_frame, live_preview, ConfigView, shutdown
-from camera.views import media_file
+from camera.views import media_file, thumbnail, thumbnail_sprite, clip, export
+from camera.views import node_token_required, node_videos, cameras, cameras_live
+from camera.views import camera_still_frame, camera_file, activity, live_stream, live_status, motion, play
 
 
 urlpatterns = [
+    # Node API for the aggregator, and aggregator pages, go first as the
+    # other regular expressions would match their paths too
+    path('api/videos', node_token_required(node_videos), name='node_videos'),
+    path('api/still_frame', node_token_required(still_frame), name='node_still_frame'),
+    url('^api/media/(?P<path>.*)$', node_token_required(media_file), name='node_media_file'),
+    url('^api/thumbnail/(?P<path>.*)$', node_token_required(thumbnail), name='node_thumbnail'),
+    path('cameras', login_required(cameras), name='cameras'),
+    path('cameras/live', login_required(cameras_live), name='cameras_live'),
+    path('cameras/<node>/still_frame', login_required(camera_still_frame), name='camera_still_frame'),
+    url('^cameras/(?P<node>[^/]+)/(?P<kind>media|thumbnail)/(?P<path>.*)$', login_required(camera_file),
+        name='camera_file'),
     path('browse', login_required(browse), name='browse'),
     path('still_frame', login_required(still_frame), name='still_frame'),
     path('live_preview', login_required(live_preview), name='live_preview'),
+    path('live_stream', login_required(live_stream), name='live_stream'),
+    path('live_status', login_required(live_status), name='live_status'),
     path('shutdown', login_required(shutdown), name='shutdown'),
     url('camera_config/$', ConfigView.as_view(), name='camera_config'),
-    url('media/(?P<path>.*)$', login_required(media_file), name='media_file')
+    url('media/(?P<path>.*)$', login_required(media_file), name='media_file'),
+    url('thumbnail/(?P<path>.*)$', login_required(thumbnail), name='thumbnail'),
+    url('sprite/(?P<day>[0-9-]+)$', login_required(thumbnail_sprite), name='thumbnail_sprite'),
+    url('clip/(?P<path>.*)$', login_required(clip), name='clip'),
+    url('motion/(?P<path>.*)$', login_required(motion), name='motion'),
+    url('play/(?P<path>.*)$', login_required(play), name='play'),
+    path('export', login_required(export), name='export'),
+    path('activity', login_required(activity), name='activity')
 ]
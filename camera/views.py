@@ -1,46 +1,540 @@
+import hmac
+import http.client
 import os
+import re
 import subprocess
+import urllib.error
+
+from datetime import datetime, time, timedelta
+from functools import wraps
+from os.path import basename, splitext
+from urllib.parse import quote
 
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
+from django.http import HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.core.cache import cache
 from django.shortcuts import render
-from django.views.decorators.http import require_http_methods
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import is_naive, localtime, make_aware, now, utc
+from django.utils.translation import get_language
+from django.views.decorators.http import condition, require_http_methods
 from django.views.generic.edit import UpdateView
 
-from camera.capture import FileManager
-from camera.client import CameraClient, FeedCommand
+from camera.activity import ActivityIndex
+from camera.aggregator import Node, node_frame, timeline
+from camera.capture import Capture, FileManager, Video
+from camera.client import CameraClient, FeedCommand, PingCommand, StreamCommand
+from camera.clips import KeyframeIndex, clip_stream
+from camera.export import TarExport, export_members
 from camera.management.commands.camera_server import Command
 from camera.models import CameraSettings
+from camera.motion import MotionTrack
 
 from sendfile import sendfile
 
+# ETag of the still frames, made of the rendition index and frame sequence
+STILL_FRAME_ETAG_RE = re.compile(r'"(\d+)-(\d+)"')
+# Day of the thumbnail sprite sheets
+SPRITE_DAY_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+# Single byte range, the only kind of Range request answered
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def browse_etag(request):
+    generation, _ = FileManager(settings.CAMERA_STORAGE_FOLDER, cleanup=False).generation()
+    return '"browse-{}-{}"'.format(get_language(), generation)
+
+
+def browse_last_modified(request):
+    _, modified = FileManager(settings.CAMERA_STORAGE_FOLDER, cleanup=False).generation()
+    return datetime.fromtimestamp(modified, tz=utc) if modified else None
+
+
+def sprite_tiles(file_manager: FileManager, videos: list) -> list:
+    """Adds to each day of the list of videos the URL of its thumbnail
+    sprite sheet, and to each video the position of its thumbnail in it,
+    or None for the thumbnails that are not packed
+    :return a list of tuples with (date, <list of (video, position)>,
+    sprite URL)
+    """
+    tile_width, tile_height = settings.CAMERA_THUMBNAIL_SPRITE_TILE
+    columns = settings.CAMERA_THUMBNAIL_SPRITE_COLUMNS
+    days = []
+    for video_date, video_list in videos:
+        entries = file_manager.thumbnail_pack(basename(video_list[0].file)).entries()
+        positions = {key: index for index, (key, _, _) in enumerate(entries)}
+        tiles = []
+        for video in video_list:
+            index = positions.get(Video.NAME_RE.match(basename(video.file)).group(1))
+            if index is not None:
+                index = '-{}px -{}px'.format(index % columns * tile_width,
+                                             index // columns * tile_height)
+            tiles.append((video, index))
+        sprite = None
+        if entries:
+            sprite = 'sprite/{}?v={}'.format(video_date.isoformat(), len(entries))
+        days.append((video_date, tiles, sprite))
+    return days
+
 
 @require_http_methods(["GET"])
+@condition(etag_func=browse_etag, last_modified_func=browse_last_modified)
 def browse(request):
-    videos = FileManager(settings.CAMERA_STORAGE_FOLDER).list_videos()
-    return render(request, 'browse.html', context=dict(videos=videos))
+    """Lists the videos available. The page is the same for every user and
+    only changes when the generation of the list of videos does, so it is
+    rendered once per generation and answered with a 304 to clients that
+    already have it
+    """
+    file_manager = FileManager(settings.CAMERA_STORAGE_FOLDER, cleanup=False)
+    generation, _ = file_manager.generation()
+    cache_key = 'browse:{}:{}'.format(get_language(), generation)
+    content = cache.get(cache_key)
+    if content is None:
+        timelapses = dict(file_manager.list_timelapses())
+        videos = [(video_date, tiles, sprite, timelapses.get(video_date))
+                  for video_date, tiles, sprite in sprite_tiles(file_manager, file_manager.list_videos())]
+        content = render_to_string('browse.html',
+                                   context=dict(videos=videos,
+                                                tile=settings.CAMERA_THUMBNAIL_SPRITE_TILE),
+                                   request=request)
+        cache.set(cache_key, content, settings.CAMERA_BROWSE_CACHE_TIMEOUT)
+    response = HttpResponse(content)
+    response['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    return response
 
 
 @require_http_methods(["GET"])
 def live_preview(request):
-    return render(request, 'live_preview.html')
+    renditions = [(name, (resize or settings.CAMERA_RESOLUTION)[0])
+                  for name, resize, _ in settings.CAMERA_PREVIEW_RENDITIONS]
+    size = request.GET.get('size')
+    if Capture.rendition_index(size) is None:
+        size = ''
+    stream = None
+    if settings.CAMERA_LIVE_STREAM:
+        stream = settings.CAMERA_LIVE_STREAM_URL or reverse('live_stream')
+    return render(request, 'live_preview.html',
+                  context=dict(renditions=renditions, size=size,
+                               websocket=settings.CAMERA_LIVE_WEBSOCKET, stream=stream))
 
 
 @require_http_methods(["GET"])
 def still_frame(request):
-    feed = FeedCommand()
-    response = HttpResponse(bytes(feed.response), content_type='img/jpg')
+    """Returns the latest live preview frame in the rendition given by the
+    size parameter
+    """
+    size = request.GET.get('size')
+    rendition_index = Capture.rendition_index(size)
+    if rendition_index is None:
+        return HttpResponseBadRequest()
+    known_sequence = None
+    etag = STILL_FRAME_ETAG_RE.match(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag and int(etag.group(1)) == rendition_index:
+        known_sequence = int(etag.group(2))
+    try:
+        feed = FeedCommand(size, known_sequence)
+    except OSError:
+        # The camera server is down or does not answer in time
+        return HttpResponse(status=503)
+    if feed.sequence and feed.sequence == known_sequence:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(bytes(feed.response or b''), content_type='img/jpg')
+    if feed.sequence:
+        response['ETag'] = '"{}-{}"'.format(rendition_index, feed.sequence)
+        # Seconds since the frame was known to show the scene
+        response['X-Frame-Age'] = '{:.1f}'.format(feed.age)
     response['Cache-Control'] = 'max-age=0, must-revalidate'
     return response
 
 
 @require_http_methods(["GET"])
+def live_status(request):
+    """Tells whether the live preview is live, see Capture.health, or 503
+    if the camera server does not answer
+    """
+    try:
+        health = PingCommand().response
+    except OSError:
+        health = None
+    response = JsonResponse(health or dict(stale=True), status=200 if health else 503)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+@require_http_methods(["GET"])
+def live_stream(request):
+    """Streams the live H.264 video as fragmented MP4, for as long as the
+    client keeps reading
+    """
+    if not settings.CAMERA_LIVE_STREAM:
+        raise Http404
+    response = StreamingHttpResponse(StreamCommand().segments(), content_type='video/mp4')
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+def media_path(path: str) -> str:
+    """Returns the full path of a media file, or None if it falls outside
+    the media folder
+    """
+    media_root = os.path.abspath(settings.MEDIA_ROOT)
+    file_path = os.path.abspath(FileManager(media_root, cleanup=False).resolve(path))
+    if os.path.commonpath((media_root, file_path)) != media_root:
+        return None
+    return file_path
+
+
+def media_etag(request, path):
+    try:
+        stat = os.stat(media_path(path))
+    except (OSError, TypeError):
+        return None
+    return '"{:x}-{:x}-{:x}"'.format(stat.st_ino, stat.st_size, int(stat.st_mtime * 1000000))
+
+
+@require_http_methods(["GET"])
+@condition(etag_func=media_etag)
 def media_file(request, path):
     """Wrapper that protects video files from being retrieved by
-    non-authenticated users
+    non-authenticated users. Finished videos and thumbnails never change
+    so browsers are told to keep them, anything else has to be revalidated
+    """
+    file_path = media_path(path)
+    if file_path is None:
+        raise Http404
+    response = sendfile(request, file_path)
+    if FileManager.is_finished(file_path):
+        immutable(response)
+    else:
+        response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@require_http_methods(["GET"])
+def clip(request, path):
+    """Streams the part of a video between the start and end parameters,
+    in seconds from the beginning of the video. The clip is widened to the
+    key frames around them so that it is cut without re-encoding
+    """
+    file_path = media_path(path)
+    if file_path is None or not Video.NAME_RE.match(basename(file_path)) or \
+            not os.path.exists(file_path):
+        raise Http404
+    try:
+        start = float(request.GET.get('start', 0))
+        end = float(request.GET['end']) if 'end' in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest()
+    if start < 0 or (end is not None and end <= start):
+        return HttpResponseBadRequest()
+    clip_start, clip_end = KeyframeIndex(file_path).gop_bounds(start, end)
+    duration = clip_end - clip_start if clip_end is not None else None
+    response = StreamingHttpResponse(clip_stream(file_path, clip_start, duration),
+                                     content_type='video/mp4')
+    clip_name = '{}_{:.0f}-{}.mp4'.format(splitext(basename(file_path))[0], clip_start,
+                                           'end' if clip_end is None else '{:.0f}'.format(clip_end))
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(clip_name)
+    return response
+
+
+def motion_etag(request, path):
+    return media_etag(request, path + MotionTrack.SUFFIX)
+
+
+@require_http_methods(["GET"])
+@condition(etag_func=motion_etag)
+def motion(request, path):
+    """Returns the motion track of a video as JSON, summed up in as many
+    bins as the bins parameter tells for the player to draw its activity
+    bar, with the times the motion sensor fired and the peaks of motion to
+    jump to. It is read from the file next to the video, nothing is decoded
+    """
+    file_path = media_path(path)
+    if file_path is None or not Video.NAME_RE.fullmatch(basename(file_path)):
+        raise Http404
+    try:
+        bins = int(request.GET.get('bins', 100))
+    except ValueError:
+        return HttpResponseBadRequest()
+    if bins < 1:
+        return HttpResponseBadRequest()
+    try:
+        track = MotionTrack.load(file_path + MotionTrack.SUFFIX)
+    except (IOError, ValueError):
+        raise Http404
+    return immutable(JsonResponse(dict(duration=track.duration,
+                                       bins=track.bins(bins),
+                                       sensor=track.sensor_times(),
+                                       peaks=track.peaks(settings.CAMERA_MOTION_PEAKS))))
+
+
+@require_http_methods(["GET"])
+def play(request, path):
+    """Plays a video, its proxy if it has one, above the activity bar drawn
+    from its motion track
+    """
+    file_path = media_path(path)
+    if file_path is None or not Video.NAME_RE.fullmatch(basename(file_path)) or \
+            not os.path.exists(file_path):
+        raise Http404
+    source = path + FileManager.PROXY_SUFFIX if os.path.exists(file_path + FileManager.PROXY_SUFFIX) else path
+    return render(request, 'play.html',
+                  context=dict(name=basename(path),
+                               source=reverse('media_file', args=(source,)),
+                               full_quality=reverse('media_file', args=(path,)) if source != path else None,
+                               motion=reverse('motion', args=(path,))))
+
+
+def parse_export_time(value: str, end: bool=False) -> datetime:
+    """Parses a limit of the export interval, a date, which stands for the
+    whole day as videos are grouped by day in the video list, or a time in
+    the current time zone if it does not give one
+    :param end: whether the limit is the end of the interval
+    :return the time or None if the value is not valid
+    """
+    try:
+        day = parse_date(value)
+        if day is not None:
+            return datetime.combine(day + timedelta(days=1 if end else 0), time(), tzinfo=utc)
+        moment = parse_datetime(value)
+    except ValueError:
+        return None
+    if moment is not None and is_naive(moment):
+        moment = make_aware(moment)
+    return moment
+
+
+@require_http_methods(["GET"])
+def export(request):
+    """Streams a tar archive with the videos, and their thumbnails,
+    recorded between the start and end parameters, both dates or times. It
+    is generated while it is sent, at most at settings.CAMERA_EXPORT_RATE
+    bytes per second, and can be resumed with a Range request
     """
-    return sendfile(request, os.path.join(settings.MEDIA_ROOT, path))
+    start = parse_export_time(request.GET.get('start', ''))
+    end = parse_export_time(request.GET.get('end', request.GET.get('start', '')), end=True)
+    if start is None or end is None or end <= start:
+        return HttpResponseBadRequest()
+    file_manager = FileManager(settings.CAMERA_STORAGE_FOLDER, cleanup=False)
+    archive = TarExport(export_members(file_manager, start, end))
+    size = archive.size
+    etag = archive.etag()
+    first, last = 0, size - 1
+    byte_range = RANGE_RE.match(request.META.get('HTTP_RANGE', ''))
+    if byte_range and request.META.get('HTTP_IF_RANGE', etag) == etag and any(byte_range.groups()):
+        if byte_range.group(1):
+            first = int(byte_range.group(1))
+            if byte_range.group(2):
+                last = min(int(byte_range.group(2)), size - 1)
+        else:   # The last bytes
+            first = max(size - int(byte_range.group(2)), 0)
+        if first > last:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+    response = StreamingHttpResponse(archive.stream(first, last, rate=settings.CAMERA_EXPORT_RATE),
+                                     content_type='application/x-tar')
+    if (first, last) != (0, size - 1):
+        response.status_code = 206
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+    response['Content-Length'] = last - first + 1
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Content-Disposition'] = 'attachment; filename="tusacam_{}_{}.tar"'.format(
+        start.strftime('%Y-%m-%d_%H%M%S'), end.strftime('%Y-%m-%d_%H%M%S'))
+    return response
+
+
+def activity_heatmap(heatmap: dict, start: datetime, end: datetime) -> list:
+    """Lays out the activity of a period as a grid of days by hours, in the
+    current time zone
+    :return a list of tuples with the day and, for each hour, a tuple with
+    its start, end, recordings, seconds and level of activity from 0 to 4
+    """
+    most_seconds = max((seconds for _, seconds in heatmap.values()), default=0)
+    days = []
+    day = localtime(start).date()
+    while day <= localtime(end - timedelta(seconds=1)).date():
+        hours = []
+        for hour in range(24):
+            hour_start = make_aware(datetime.combine(day, time(hour)))
+            recordings, seconds = heatmap.get(hour_start, (0, 0))
+            level = 0 if not seconds else 1 + 3 * seconds // most_seconds
+            hours.append((hour_start, hour_start + timedelta(hours=1), recordings, seconds, min(level, 4)))
+        days.append((day, hours))
+        day += timedelta(days=1)
+    return days
+
+
+@require_http_methods(["GET"])
+def activity(request):
+    """Shows the activity between the start and end parameters, both dates
+    or times, the last settings.CAMERA_ACTIVITY_DAYS days by default, as a
+    heatmap of the seconds recorded per hour and the list of recordings.
+    Given format=json it answers the same as JSON
+    """
+    if 'start' in request.GET or 'end' in request.GET:
+        start = parse_export_time(request.GET.get('start', ''))
+        end = parse_export_time(request.GET.get('end', request.GET.get('start', '')), end=True)
+    else:
+        end = make_aware(datetime.combine(localtime(now()).date() + timedelta(days=1), time()))
+        start = end - timedelta(days=settings.CAMERA_ACTIVITY_DAYS)
+    if start is None or end is None or end <= start:
+        return HttpResponseBadRequest()
+    index = ActivityIndex(FileManager(settings.CAMERA_STORAGE_FOLDER, cleanup=False))
+    heatmap = index.heatmap(start, end)
+    recordings = index.recordings(start, end)[:settings.CAMERA_ACTIVITY_LIST_LIMIT]
+    if request.GET.get('format') == 'json':
+        return JsonResponse(dict(
+            heatmap=[dict(hour=hour.isoformat(), recordings=recordings, seconds=seconds)
+                     for hour, (recordings, seconds) in sorted(heatmap.items())],
+            recordings=[dict(file=recording.file, timestamp=recording.timestamp.isoformat(),
+                             duration=recording.duration)
+                        for recording in recordings]))
+    return render(request, 'activity.html',
+                  context=dict(start=start, end=end, days=activity_heatmap(heatmap, start, end),
+                               recordings=recordings, limit=settings.CAMERA_ACTIVITY_LIST_LIMIT))
+
+
+def immutable(response: HttpResponse) -> HttpResponse:
+    response['Cache-Control'] = 'private, max-age={}, immutable'.format(settings.CAMERA_MEDIA_MAX_AGE)
+    return response
+
+
+@require_http_methods(["GET"])
+def thumbnail(request, path):
+    """Returns the thumbnail of a video, from the pack of its day or, if
+    it is not packed, from its own file
+    """
+    name_parts = Video.NAME_RE.match(basename(path))
+    if name_parts is None:
+        raise Http404
+    key = name_parts.group(1)
+    pack = FileManager(settings.CAMERA_STORAGE_FOLDER, cleanup=False).thumbnail_pack(key)
+    entry = pack.find(key)
+    if entry is None:
+        return media_file(request, '{}.jpg'.format(path))
+    etag = '"{}-{:x}"'.format(key, entry[1])
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(pack.read(key), content_type='image/jpeg')
+    response['ETag'] = etag
+    return immutable(response)
+
+
+@require_http_methods(["GET"])
+def thumbnail_sprite(request, day):
+    """Returns the sprite sheet with the packed thumbnails of a day. Packs
+    only grow, so a sprite sheet is valid for any earlier version of the
+    pack and can be kept by browsers
+    """
+    if not SPRITE_DAY_RE.match(day):
+        raise Http404
+    file_manager = FileManager(settings.CAMERA_STORAGE_FOLDER, cleanup=False)
+    sprite_path = file_manager.thumbnail_pack('{}_'.format(day)).sprite(
+        settings.CAMERA_THUMBNAIL_SPRITE_TILE, settings.CAMERA_THUMBNAIL_SPRITE_COLUMNS)
+    if sprite_path is None:
+        raise Http404
+    return immutable(sendfile(request, sprite_path))
+
+
+def node_token_required(view):
+    """Lets the aggregator use a view, giving the token in
+    settings.CAMERA_NODE_TOKEN instead of logging in. The view is not
+    available at all when there is no token
+    """
+    @wraps(view)
+    def token_view(request, *args, **kwargs):
+        if not settings.CAMERA_NODE_TOKEN:
+            raise Http404
+        if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''),
+                                   'Token {}'.format(settings.CAMERA_NODE_TOKEN)):
+            return HttpResponseForbidden()
+        return view(request, *args, **kwargs)
+    return token_view
+
+
+@require_http_methods(["GET"])
+def node_videos(request):
+    """Lists the videos available for the aggregator
+    """
+    file_manager = FileManager(settings.CAMERA_STORAGE_FOLDER, cleanup=False)
+    videos = [dict(timestamp=video.timestamp.isoformat(),
+                   file=video.file,
+                   duration=video.duration.total_seconds(),
+                   thumbnail=video.thumbnail)
+              for _, day_videos in file_manager.list_videos()
+              for video in day_videos]
+    return JsonResponse(dict(videos=videos))
+
+
+def aggregated_node(name: str=None):
+    """Returns the node with the given name, or all the nodes when there is
+    no name, raising a 404 if there is none
+    """
+    nodes = Node.configured() if name is None else [Node.get(name)]
+    if not nodes or nodes[0] is None:
+        raise Http404
+    return nodes if name is None else nodes[0]
+
+
+@require_http_methods(["GET"])
+def cameras(request):
+    """Lists the videos of all the nodes of the aggregator together
+    """
+    videos, failed = timeline(aggregated_node())
+    return render(request, 'cameras.html', context=dict(videos=videos, failed=failed))
+
+
+@require_http_methods(["GET"])
+def cameras_live(request):
+    return render(request, 'cameras_live.html',
+                  context=dict(nodes=aggregated_node(),
+                               size=settings.CAMERA_AGGREGATOR_PREVIEW_RENDITION))
+
+
+@require_http_methods(["GET"])
+def camera_still_frame(request, node):
+    """Returns the latest live preview frame of a node of the aggregator
+    """
+    size = request.GET.get('size', settings.CAMERA_AGGREGATOR_PREVIEW_RENDITION)
+    frame = node_frame(aggregated_node(node), size)
+    if frame is None:
+        return HttpResponse(status=504)
+    response = HttpResponse(frame, content_type='image/jpeg')
+    response['Cache-Control'] = 'max-age=0, must-revalidate'
+    return response
+
+
+def relay(remote: http.client.HTTPResponse, chunk_size: int=64 * 1024):
+    try:
+        for chunk in iter(lambda: remote.read(chunk_size), b''):
+            yield chunk
+    finally:
+        remote.close()
+
+
+@require_http_methods(["GET"])
+def camera_file(request, node, kind, path):
+    """Relays a video or thumbnail of a node of the aggregator
+    """
+    try:
+        remote = aggregated_node(node).open('{}/{}'.format(kind, quote(path)))
+    except urllib.error.HTTPError as e:
+        return HttpResponse(status=e.code)
+    except (IOError, http.client.HTTPException):
+        return HttpResponse(status=504)
+    response = StreamingHttpResponse(relay(remote), content_type=remote.headers.get('Content-Type'))
+    for header in ('Content-Length', 'Cache-Control', 'ETag'):
+        if remote.headers.get(header):
+            response[header] = remote.headers[header]
+    return response
 
 
 @require_http_methods(["GET"])
@@ -62,6 +556,12 @@ class ConfigView(UpdateView, LoginRequiredMixin):
             camera_settings = CameraSettings.objects.create()
         return camera_settings
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        file_manager = FileManager(settings.CAMERA_STORAGE_FOLDER, cleanup=False)
+        context['plan'] = file_manager.plan_storage(self.object.max_mb, self.object.bitrate)
+        return context
+
     def form_valid(self, form):
         result = super().form_valid(form)
         form.save()
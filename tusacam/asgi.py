@@ -0,0 +1,21 @@
+"""
+ASGI config for tusacam project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``. It only serves the live preview, see
+camera.live.LivePreviewApplication, everything else is served by the WSGI
+application in wsgi.py. Run it with any ASGI server, for instance
+
+    uvicorn tusacam.asgi:application --port 8001
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tusacam.settings")
+django.setup()
+
+from camera.live import LivePreviewApplication  # noqa: E402 Needs the settings
+
+application = LivePreviewApplication()
@@ -59,6 +59,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'camera.context_processors.aggregator',
             ],
         },
     },
@@ -116,18 +117,188 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 CAMERA_STORAGE_FOLDER = '/home/pi/capture'
+# Store the recordings in one folder per day, <YYYY>/<MM>/<DD>, inside the
+# storage folder instead of all in the storage folder. An existing folder
+# can be moved to this layout with the shard_capture_folder command
+CAMERA_STORAGE_SHARDED = False
+# Folder in RAM, such as a tmpfs like '/dev/shm/tusacam', where recordings
+# are written and converted before their final files are copied to the SD
+# card in large sequential writes. None to record straight to the card
+CAMERA_STAGING_FOLDER = None
+# Upper bound in MB of the files in the staging folder. A recording that
+# does not fit is continued on the card
+CAMERA_STAGING_MAX_MB = 64
+# Fraction of the time that housekeeping, such as applying the storage
+# policy, may work on the files while the camera is running. It runs in the
+# background, at a niceness this much higher than the capture loop
+CAMERA_HOUSEKEEPING_BUDGET = 0.25
+CAMERA_HOUSEKEEPING_NICENESS = 10
+# Seconds a rendered browse page is kept in the cache. Pages are invalidated
+# as soon as a video is added or deleted, so this just bounds the memory
+# taken by old pages
+CAMERA_BROWSE_CACHE_TIMEOUT = 24 * 60 * 60
+# Seconds browsers keep the finished videos and thumbnails without asking
+# for them again. Their names are unique and they are never rewritten
+CAMERA_MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+# Whether the thumbnails of each day are appended to a single pack file
+# instead of being stored one file per video
+CAMERA_THUMBNAIL_PACK = False
+# Encoder options of a low resolution copy of each recording, recorded at
+# the same time on another encoder and played by default when browsing,
+# e.g. dict(resize=(640, 360), bitrate=1000000). None for no copy
+CAMERA_PROXY = None
+# Whether a motion track, how much moved in every frame, is recorded next to
+# each recording from the motion vectors of the encoder, for the player to
+# show where the activity is
+CAMERA_MOTION_TRACK = True
+# Number of peaks of motion of a recording the player offers to jump to
+CAMERA_MOTION_PEAKS = 5
+# Daily time-lapse made of the live preview frames of a rendition, one every
+# interval seconds, encoded at the given frame rate once the (UTC) day is
+# over, e.g. dict(rendition='medium', interval=10, framerate=25). None for
+# no time-lapse
+CAMERA_TIMELAPSE = None
+# ffmpeg output options of the daily time-lapses, using the GPU encoder
+CAMERA_TIMELAPSE_OUTPUT = ('-c:v', 'h264_omx', '-b:v', '1M')
+# Size in pixels of each thumbnail in the sprite sheet of a day, and number
+# of thumbnails per row
+CAMERA_THUMBNAIL_SPRITE_TILE = (160, 120)
+CAMERA_THUMBNAIL_SPRITE_COLUMNS = 8
+# Recordings older than this number of days are re-encoded by the
+# reencode_videos command to the given profile, which ends up in their name
+CAMERA_REENCODE_AFTER_DAYS = 7
+CAMERA_REENCODE_PROFILE = 'small'
+# ffmpeg input and output options of each re-encoding profile
+CAMERA_REENCODE_PROFILES = {
+    # Half the resolution at a low bitrate, using the GPU encoder
+    'small': ((), ('-vf', 'scale=iw/2:-2', '-c:v', 'h264_omx', '-b:v', '1M')),
+    # Only the key frames, the rest are not even decoded
+    'keyframes': (('-skip_frame', 'nokey'), ('-vsync', 'vfr', '-c:v', 'h264_omx', '-b:v', '1M')),
+}
+# CPU temperature in Celsius degrees above which nothing is re-encoded
+CAMERA_REENCODE_MAX_TEMPERATURE = 70
+# Maximum bytes per second read for an export of recordings, so that the
+# storage is left to recording most of the time. None for no limit
+CAMERA_EXPORT_RATE = 4 * 1024 * 1024
+# Days of activity shown by default, and most recordings listed, in the
+# activity page
+CAMERA_ACTIVITY_DAYS = 14
+CAMERA_ACTIVITY_LIST_LIMIT = 200
+# S3 compatible store the recordings are copied to by the replicate command,
+# e.g. dict(endpoint='https://s3.eu-west-1.amazonaws.com', region='eu-west-1',
+# bucket='tusacam', access_key='...', secret_key='...', prefix='home/').
+# None to keep the recordings only here
+CAMERA_REPLICATION = None
+# Files larger than this are uploaded in parts of this size, at least 5MB
+CAMERA_REPLICATION_PART_SIZE = 8 * 1024 * 1024
+# Files uploaded at the same time and maximum bytes per second among all
+CAMERA_REPLICATION_CONCURRENCY = 2
+CAMERA_REPLICATION_RATE = 512 * 1024
+# Replicated recordings older than this number of days are removed from the
+# capture folder before the storage policy would. None to leave it to it
+CAMERA_REPLICATION_KEEP_LOCAL_DAYS = None
+# Token other tusacam servers give to use this one as a node of their
+# aggregator. None to not be a node
+CAMERA_NODE_TOKEN = None
+# Nodes shown together by this server, acting as aggregator, each one
+# dict(name='garden', url='https://garden.example.com', token='...')
+CAMERA_AGGREGATOR_NODES = ()
+# Seconds nodes have to answer before they are left out
+CAMERA_AGGREGATOR_TIMEOUT = 3
+# Seconds the lists of videos and the live frames of the nodes are cached
+CAMERA_AGGREGATOR_CACHE_TIMEOUT = 30
+CAMERA_AGGREGATOR_FRAME_CACHE_TIMEOUT = 1
+# Live preview rendition shown for each node
+CAMERA_AGGREGATOR_PREVIEW_RENDITION = 'small'
 MEDIA_ROOT = CAMERA_STORAGE_FOLDER
 MEDIA_URL = 'media/'
 
 STATICFILES_DIRS = ('static',)
 STATIC_ROOT = 'collectstatic'
 CAMERA_SERVER_PORT = 10000
+# Seconds the web app waits for the camera server to answer
+CAMERA_SERVER_TIMEOUT = 5
+# Path of the WebSocket that pushes the live preview, served by the ASGI
+# application in tusacam/asgi.py, e.g. '/live/feed'. None to have the live
+# preview page poll still_frame instead
+CAMERA_LIVE_WEBSOCKET = None
+# Seconds between the requests for new frames to the camera server made by
+# the ASGI application, whatever the number of viewers
+CAMERA_LIVE_FEED_INTERVAL = 0.1
+# Encoder options of the live H.264 stream, played with much less bandwidth
+# and latency than the JPEG still frames by the browsers that support Media
+# Source Extensions, e.g. dict(resize=(640, 480), bitrate=1000000,
+# intra_period=15). Frequent key frames let viewers join and catch up
+# quickly. None for no live stream
+CAMERA_LIVE_STREAM = None
+# Shared memory for the latest frames of the live stream, a few key frame
+# intervals worth
+CAMERA_LIVE_STREAM_BUFFER_SIZE = 2 * 1024 * 1024
+# Seconds a viewer of the live stream may fall behind the camera before it
+# skips to the latest key frame
+CAMERA_LIVE_STREAM_MAX_LAG = 1
+# Path of the live stream served by the ASGI application, e.g.
+# '/live/stream'. None to serve it from the WSGI application, which takes a
+# thread per viewer
+CAMERA_LIVE_STREAM_URL = None
 
 # Camera capture settings
 CAMERA_RESOLUTION = (640, 480)
 CAMERA_FRAMERATE = 25
 # Time in seconds between each frame captured in live preview
 CAMERA_PREVIEW_FREQ = 0.5
+# JPEG quality (1 to 100) of the frames captured for live preview. Together
+# with CAMERA_RESOLUTION it determines the size of the shared buffers that
+# hold the live preview frames
+CAMERA_PREVIEW_QUALITY = 85
+# Hard limit in bytes for each one of the shared live preview buffers, no
+# matter what the resolution and quality are. Frames that do not fit are
+# dropped and counted as overflows. None to take the size needed by the
+# largest rendition of CAMERA_RESOLUTION and CAMERA_PREVIEW_QUALITY
+CAMERA_PREVIEW_MAX_BUFFER_SIZE = None
+# Renditions of the live preview. Each one is captured through the camera
+# hardware resizer into its own shared buffers and is selected with the size
+# parameter of the still_frame view. Every rendition is defined by its name,
+# the (width, height) to resize to or None to keep CAMERA_RESOLUTION and
+# its JPEG quality or None to use CAMERA_PREVIEW_QUALITY
+CAMERA_PREVIEW_RENDITIONS = (
+    ('small', (160, 120), 60),
+    ('medium', (320, 240), 75),
+    ('full', None, None),
+)
+# Rendition served when none is asked for
+CAMERA_PREVIEW_RENDITION = 'full'
+# Seconds after it was last asked for that a rendition is only refreshed
+# every CAMERA_PREVIEW_STATIC_FREQ seconds, each rendition refreshed takes
+# a JPEG encode
+CAMERA_PREVIEW_IDLE_AFTER = 10
+# Adaptive live preview. Before each preview frame a tiny YUV probe is
+# compared with the one of the last frame published and, while the scene
+# does not change, no frame is published and the time between probes
+# doubles up to CAMERA_PREVIEW_STATIC_FREQ seconds. Any change or motion
+# detected brings it back to CAMERA_PREVIEW_FREQ. Needs numpy, without it
+# the preview is captured at a fixed rate
+CAMERA_PREVIEW_ADAPTIVE = True
+CAMERA_PREVIEW_STATIC_FREQ = 4
+# Resolution of the scene probes. Width has to be a multiple of 32 and height
+# a multiple of 16
+CAMERA_SCENE_PROBE_RESOLUTION = (64, 48)
+# Mean absolute difference of the probe luma values, from 0 to 255, above
+# which the scene is considered to have changed
+CAMERA_SCENE_CHANGE_THRESHOLD = 3
+# Seconds a live preview frame may go without being refreshed, or found
+# unchanged, before it is no longer shown as live. Keep it above
+# CAMERA_PREVIEW_STATIC_FREQ, a still scene is only checked that often
+CAMERA_LIVE_STALE_AFTER = 10
+# Seconds the capture loop may be late on its heartbeat, or take to start,
+# before the camera server flags it as stalled and restarts it
+CAMERA_WATCHDOG_TIMEOUT = 10
+# Seconds the camera server waits before restarting a capture loop that
+# failed soon after it was started, doubled every time it fails again up to
+# CAMERA_RESTART_MAX_BACKOFF. A loop that ran for longer than that is
+# restarted straight away
+CAMERA_RESTART_BACKOFF = 0.5
+CAMERA_RESTART_MAX_BACKOFF = 30
 
 # The GPIO port that the motion sensor is attached to, in GPIO.BOARD notation.
 #